@@ -45,6 +45,10 @@ class Ui_MainWindow(object):
         self.calc_Button = QtWidgets.QPushButton(self.centralwidget)
         self.calc_Button.setObjectName("calc_Button")
         self.gridLayout.addWidget(self.calc_Button, 12, 2, 1, 1)
+        self.progressBar = QtWidgets.QProgressBar(self.centralwidget)
+        self.progressBar.setProperty("value", 0)
+        self.progressBar.setObjectName("progressBar")
+        self.gridLayout.addWidget(self.progressBar, 13, 2, 1, 1)
         self.release_label = QtWidgets.QLabel(self.centralwidget)
         self.release_label.setObjectName("release_label")
         self.gridLayout.addWidget(self.release_label, 3, 1, 1, 1)
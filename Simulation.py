@@ -24,8 +24,7 @@ In this class the mutliprocessing is handled.
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 # Flow-Py libraries
-import multiprocessing as mp
-import flow_core as fc
+import flow_pool
 
 # PyQt libraries
 from PyQt5.QtCore import QThread, pyqtSignal
@@ -45,18 +44,15 @@ class Simulation(QThread):
 
         # This part will is for Calculation of the top release cells and erasing the lower ones
         #if __name__ != '__main__':  # needed that it runs on windows, but it doesnt!!! if __name__ == main: would it be.
-        if self.infra_bool:
-            print("{} Processes started.".format(mp.cpu_count() - 1))
-            pool = mp.Pool(mp.cpu_count() - 1)
-            pool.map(fc.calculation, self.optList)
-            pool.close()
-            pool.join()
-        else:
-            print("{} Processes started.".format(mp.cpu_count() - 1))
-            pool = mp.Pool(mp.cpu_count() - 1)
-            pool.map(fc.calculation_effect, self.optList)
-            pool.close()
-            pool.join()
+        print("{} Processes started.".format(flow_pool.default_processes()))
+        failed = flow_pool.run_calculation(self.optList, self.infra_bool, progress=self.progress)
+        if failed:
+            print("Error: {} tiles failed".format(len(failed)))
 
         print("Processes finished")
-        self.finished.emit()
\ No newline at end of file
+        self.finished.emit()
+
+    def progress(self, done, total, eta):
+        """Progress of the workers (see flow_progress) in percent to the
+        progress bar"""
+        self.value_changed.emit(100 * done / total if total else 100.)
\ No newline at end of file
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of Flow-Py on synthetic terrains (see terrain), run from the
+Flow-Py folder:
+
+    python3 -m benchmarks run --out bench.json
+    python3 -m benchmarks compare baseline.json bench.json
+
+- terrain       Synthetic DEMs (inclined plane, cone, channelled valley,
+                fractal terrain, flat plateau) and release layers
+- suite         The benchmarks (Cell.calc_distribution, one tile with
+                calculation/calculation_effect, tileRaster/MergeRaster,
+                strong and weak scaling over the worker processes), the
+                results are saved as JSON
+- compare       Compare the results with a baseline and flag regressions
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
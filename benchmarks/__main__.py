@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command line of the benchmarks, run from the Flow-Py folder:
+
+    python3 -m benchmarks run --out bench.json [--quick] [--only tile,scaling]
+    python3 -m benchmarks compare baseline.json bench.json [--threshold 0.1]
+
+compare exits with 1 if a benchmark is slower than the baseline by more
+than the threshold.
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from benchmarks import suite, terrain, compare
+
+BENCHMARKS = ("calc_distribution", "tile", "tiling", "scaling")
+
+
+def csv(convert):
+    return lambda text: [convert(item) for item in text.split(",")]
+
+
+def run(args):
+    """Run the selected benchmarks and save the results"""
+    engines = args.engines or ["cell", "array", "numba"]
+    settings = {'quick': args.quick, 'engines': engines, 'only': args.only or list(BENCHMARKS)}
+    if args.quick:
+        settings.update(terrains=["plane", "valley"], size=60, densities=[0.005], sizes=[256, 512],
+                        workers=[1, 2], tiles=2, repeat=1)
+    else:
+        settings.update(terrains=list(terrain.TERRAINS), size=100, densities=[0.002, 0.01],
+                        sizes=[512, 1024, 2048], workers=suite.default_workers(), tiles=8, repeat=3)
+    temp_dir = tempfile.mkdtemp(prefix="flowpy_bench_")
+    results = []
+    try:
+        for benchmark in settings['only']:
+            print("Running {} ...".format(benchmark))
+            if benchmark == "calc_distribution":
+                new = suite.bench_calc_distribution(settings['terrains'], settings['size'],
+                                                    repeat=max(settings['repeat'], 3))
+            elif benchmark == "tile":
+                new = suite.bench_tile(os.path.join(temp_dir, ""), settings['terrains'], engines,
+                                       settings['densities'], settings['size'], settings['repeat'])
+            elif benchmark == "tiling":
+                new = suite.bench_tiling(temp_dir, settings['sizes'], repeat=settings['repeat'])
+            elif benchmark == "scaling":
+                new = suite.bench_scaling(os.path.join(temp_dir, ""), settings['workers'], engines[-1],
+                                          settings['size'], tiles=settings['tiles'])
+            else:
+                raise ValueError("Unknown benchmark {}, one of {}".format(benchmark, ", ".join(BENCHMARKS)))
+            for entry in new:
+                print("  {:<70} {:10.4f} s".format(entry['name'], entry['seconds']['min']))
+            results += new
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    suite.write_report(args.out, results, settings)
+    print("Results saved to {}".format(args.out))
+
+
+def run_compare(args):
+    """Print the comparison with the baseline, exit with 1 on regressions"""
+    baseline, current = suite.read_report(args.baseline), suite.read_report(args.current)
+    differences = compare.different_machine(baseline, current)
+    if differences:
+        print("Warning: the runs differ in {}".format(", ".join(differences)))
+    rows = compare.compare(baseline, current, args.threshold, args.stat)
+    print(compare.format_rows(rows))
+    regressions = [row for row in rows if row[4] == "regression"]
+    if regressions:
+        print("{} regressions (slower by more than {:.0%})".format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python3 -m benchmarks", description="Benchmarks of Flow-Py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    parser_run = commands.add_parser("run", help="run the benchmarks and save the results as JSON")
+    parser_run.add_argument("--out", default="bench.json", help="JSON file of the results")
+    parser_run.add_argument("--quick", action="store_true", help="small rasters and one repeat")
+    parser_run.add_argument("--only", type=csv(str), help="comma separated: " + ", ".join(BENCHMARKS))
+    parser_run.add_argument("--engines", type=csv(str), help="comma separated: cell, array, numba "
+                                                             "(scaling uses the last one)")
+    parser_run.set_defaults(function=run)
+    parser_compare = commands.add_parser("compare", help="compare results with a baseline")
+    parser_compare.add_argument("baseline")
+    parser_compare.add_argument("current")
+    parser_compare.add_argument("--threshold", type=float, default=0.1,
+                                help="relative slowdown flagged as regression (default 0.1)")
+    parser_compare.add_argument("--stat", choices=("min", "median", "mean"), default="min")
+    parser_compare.set_defaults(function=run_compare)
+    args = parser.parse_args(argv)
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
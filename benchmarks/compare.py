@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare a benchmark run with a baseline (both saved by suite.write_report).
+A benchmark is a regression if it is slower than the baseline by more than
+the threshold, the min of the repeats is compared by default because it is
+the least disturbed by other load on the machine.
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+def compare(baseline, current, threshold=0.1, stat='min'):
+    """Compare the results of two reports.
+
+    Input parameters:
+        baseline, current   Reports, see suite.write_report
+        threshold   Relative change that is flagged, 0.1 = 10 %
+        stat        Statistic of the repeats that is compared ('min',
+                    'median' or 'mean')
+
+    Output parameters:
+        rows        List of (name, baseline seconds, current seconds, ratio
+                    current / baseline, status), status is "regression",
+                    "improvement", "ok", "new" or "missing"
+    """
+    base = {entry['name']: entry['seconds'][stat] for entry in baseline['results']}
+    rows = []
+    for entry in current['results']:
+        seconds = entry['seconds'][stat]
+        if entry['name'] not in base:
+            rows.append((entry['name'], None, seconds, None, "new"))
+            continue
+        ratio = seconds / base[entry['name']] if base[entry['name']] > 0 else float('inf')
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 - threshold:
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append((entry['name'], base[entry['name']], seconds, ratio, status))
+    names = {entry['name'] for entry in current['results']}
+    rows += [(name, seconds, None, None, "missing") for name, seconds in base.items() if name not in names]
+    return rows
+
+
+def different_machine(baseline, current):
+    """Details of the machine that differ between the reports"""
+    keys = ('platform', 'processor', 'cpu_count', 'python', 'numpy', 'numba')
+    return [key for key in keys if baseline['machine'].get(key) != current['machine'].get(key)]
+
+
+def format_rows(rows):
+    """Table of the rows of compare, one line per benchmark"""
+    def seconds(value):
+        return "-" if value is None else "{:.4f}".format(value)
+
+    width = max([len(row[0]) for row in rows] + [9])
+    lines = ["{:<{}}  {:>10}  {:>10}  {:>7}  {}".format("benchmark", width, "baseline", "current", "ratio",
+                                                       "status")]
+    for name, base, current, ratio, status in rows:
+        lines.append("{:<{}}  {:>10}  {:>10}  {:>7}  {}".format(
+            name, width, seconds(base), seconds(current), "-" if ratio is None else "{:.2f}".format(ratio), status))
+    return "\n".join(lines)
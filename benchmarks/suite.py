@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The benchmarks of Flow-Py. Every benchmark returns a list of results, a
+result is a dict with:
+
+- name      Unique name of the benchmark and its parameters, the key for
+            compare, e.g. "tile/effect/engine=cell/terrain=plane/density=0.005"
+- params    The parameters of the benchmark
+- seconds   min, median and mean of the timed repeats
+- repeat    Number of timed repeats (after one untimed warm up, e.g. for
+            the compilation of the numba engine)
+- extra     Additional numbers (cells, release pixels, speedup, ...)
+
+The results of a run are saved as JSON (see write_report) with the details
+of the machine, so runs on different machines are not compared by mistake.
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import platform
+import statistics
+import subprocess
+import contextlib
+from datetime import datetime
+import numpy as np
+import flow_core as fc
+import flow_array
+import flow_pool
+import split_and_merge as SPAM
+from benchmarks import terrain
+
+CELLSIZE = 10
+NODATA = -9999
+# alpha, exp, flux_threshold, max_z of the benchmarks (avalanche)
+PARAMETERS = (25, 8, 3 * 10 ** -4, 270)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Send stdout (also of the worker processes) to /dev/null"""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+def timed(function, repeat, warmup=1):
+    """Wall time of repeat calls of function in seconds, after warmup calls"""
+    for k in range(warmup):
+        function()
+    times = []
+    for k in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(kind, params, times, **extra):
+    name = "/".join([kind] + ["{}={}".format(key, value) for key, value in params.items()])
+    return {'name': name, 'params': params, 'repeat': len(times),
+            'seconds': {'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times)},
+            'extra': extra}
+
+
+def opt_tuple(temp_dir, i=0, j=0, engine='cell'):
+    alpha, exp, flux_threshold, max_z = PARAMETERS
+    return (i, j, alpha, exp, CELLSIZE, NODATA, flux_threshold, max_z, temp_dir, {'engine': engine})
+
+
+def save_tile(temp_dir, i, j, dem, release, infra=None):
+    """Save the layers as tiles i, j to temp_dir like SPAM.tileRaster"""
+    np.save(temp_dir + "dem_{}_{}".format(i, j), dem)
+    np.save(temp_dir + "init_{}_{}".format(i, j), release)
+    if infra is not None:
+        np.save(temp_dir + "infra_{}_{}".format(i, j), infra)
+
+
+def bench_calc_distribution(terrains, size=100, paths=3, repeat=5):
+    """Cell.calc_distribution of all cells of some paths (calculated once by
+    fc.calc_path, calc_distribution only depends on the state of the cell
+    and its parents), seconds for all cells and per call"""
+    alpha, exp, flux_threshold, max_z = PARAMETERS
+    results = []
+    for name in terrains:
+        dem = terrain.TERRAINS[name](size, size, CELLSIZE)
+        valid = flow_array.valid_mask(dem, NODATA)
+        rows, cols = np.nonzero(terrain.release(dem, paths / dem.size, seed=1))
+        cells = []
+        for row, col in zip(rows[:paths], cols[:paths]):
+            cells += fc.calc_path(dem, row, col, CELLSIZE, alpha, exp, flux_threshold, max_z, valid)
+
+        def run():
+            for cell in cells:
+                cell.calc_distribution()
+        times = timed(run, repeat)
+        results.append(result("calc_distribution", {'terrain': name, 'size': size}, times, cells=len(cells),
+                              per_call=min(times) / max(len(cells), 1)))
+    return results
+
+
+def bench_tile(temp_dir, terrains, engines, densities, size=100, repeat=3):
+    """One tile with fc.calculation_effect (without infrastructure) and
+    fc.calculation (with a road as infrastructure) for every engine and
+    release density"""
+    results = []
+    for name in terrains:
+        dem = terrain.TERRAINS[name](size, size, CELLSIZE)
+        for density in densities:
+            release = terrain.release(dem, density)
+            save_tile(temp_dir, 0, 0, dem, release, terrain.infrastructure(dem))
+            for engine in engines:
+                optTuple = opt_tuple(temp_dir, engine=engine)
+                for mode, function in (("effect", fc.calculation_effect), ("infra", fc.calculation)):
+                    with quiet():
+                        times = timed(lambda: function(optTuple), repeat)
+                    count = np.load(temp_dir + "res_count_0_0.npy") if mode == "effect" else None
+                    extra = {'release_pixels': int(np.count_nonzero(release))}
+                    if count is not None:
+                        extra['cells'] = int(count.sum())
+                        extra['cells_per_second'] = extra['cells'] / min(times)
+                    results.append(result("tile/" + mode, {'engine': engine, 'terrain': name, 'size': size,
+                                                           'density': density}, times, **extra))
+    return results
+
+
+def bench_tiling(temp_dir, sizes, tile=256, overlap=16, repeat=3):
+    """SPAM.tileRaster of a GeoTIFF and SPAM.MergeRaster of the result tiles
+    for rasters of size x size cells"""
+    import rasterio
+    import raster_io as io
+
+    results = []
+    profile = {'crs': rasterio.crs.CRS.from_epsg(32632),
+               'transform': rasterio.transform.from_origin(600000, 5200000, CELLSIZE, CELLSIZE)}
+    for size in sizes:
+        size_dir = os.path.join(temp_dir, "tiling_{}".format(size), "")
+        os.makedirs(size_dir, exist_ok=True)
+        dem_file = size_dir + "dem.tif"
+        io.output_raster(None, dem_file, terrain.fractal(size, size, CELLSIZE), profile)
+        times = timed(lambda: SPAM.tileRaster(dem_file, "dem", size_dir, tile, tile, overlap), repeat)
+        n_tiles = len(glob.glob(size_dir + "dem_*.npy"))
+        results.append(result("tileRaster", {'size': size, 'tile': tile}, times, tiles=n_tiles))
+        for file in glob.glob(size_dir + "dem_*.npy"):
+            np.save(size_dir + "res_z_delta_" + os.path.basename(file)[4:], np.load(file))
+        times = timed(lambda: SPAM.MergeRaster(size_dir, "res_z_delta"), repeat)
+        results.append(result("MergeRaster", {'size': size, 'tile': tile}, times, tiles=n_tiles))
+    return results
+
+
+def bench_scaling(temp_dir, workers, engine='cell', size=100, density=0.01, tiles=8, repeat=1):
+    """flow_pool.run_calculation without infrastructure over the number of
+    worker processes. Strong scaling: the same number of tiles for every
+    number of workers; weak scaling: one tile per worker. Speedup and
+    efficiency are relative to one worker."""
+    dem = terrain.fractal(size, size, CELLSIZE)
+    release = terrain.release(dem, density)
+    for i in range(max(max(workers), tiles)):
+        save_tile(temp_dir, i, 0, dem, release)  # the same work per tile
+    results = []
+    for kind in ("strong", "weak"):
+        base = None
+        for n in workers:
+            n_tiles = tiles if kind == "strong" else n
+            optList = [opt_tuple(temp_dir, i, 0, engine) for i in range(n_tiles)]
+            with quiet():
+                times = timed(lambda: flow_pool.run_calculation(optList, False, processes=n), repeat, warmup=0)
+            base = base if base is not None else min(times)
+            speedup = base / min(times) * (n if kind == "weak" else 1)
+            results.append(result("scaling/" + kind, {'engine': engine, 'workers': n, 'tiles': n_tiles},
+                                  times, speedup=speedup, efficiency=speedup / n))
+    return results
+
+
+def default_workers():
+    """1, 2, 4, ... up to flow_pool.default_processes()"""
+    workers, n = [], 1
+    while n < flow_pool.default_processes():
+        workers.append(n)
+        n *= 2
+    return workers + [flow_pool.default_processes()]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(fc.__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def machine():
+    """Details of the machine and the software of a benchmark run"""
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'numba': numba_version}
+
+
+def write_report(file, results, settings):
+    """Save the results as JSON with the machine and the settings of the run"""
+    with open(file, "w") as f:
+        json.dump({'machine': machine(), 'settings': settings, 'results': results}, f, indent=1)
+
+
+def read_report(file):
+    with open(file) as f:
+        return json.load(f)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic DEMs and release layers for the benchmarks. All DEMs are float32
+arrays with the altitude in m, rows go from north to south. The terrains
+cover the typical cases of the path engines: long narrow paths (valley),
+wide spreading (plane, cone), irregular terrain (fractal) and paths that
+stop at once (plateau).
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import numpy as np
+
+
+def plane(nrows, ncols, cellsize=10, slope=35, base=1000):
+    """Inclined plane dipping to the south with slope in degree"""
+    rows = np.arange(nrows, dtype=np.float64)[:, None]
+    dem = base + (nrows - 1 - rows) * cellsize * math.tan(math.radians(slope))
+    return np.repeat(dem, ncols, axis=1).astype(np.float32)
+
+
+def cone(nrows, ncols, cellsize=10, slope=35, base=1000):
+    """Cone with the peak in the center and slope in degree"""
+    rows, cols = np.mgrid[0:nrows, 0:ncols]
+    radius = np.hypot(rows - (nrows - 1) / 2, cols - (ncols - 1) / 2) * cellsize
+    dem = base + (radius.max() - radius) * math.tan(math.radians(slope))
+    return dem.astype(np.float32)
+
+
+def valley(nrows, ncols, cellsize=10, slope=25, side_slope=35, channel=3, base=1000):
+    """Channelled valley dipping to the south with slope, the sides fall
+    with side_slope to a flat channel of channel cells in the center"""
+    rows, cols = np.mgrid[0:nrows, 0:ncols]
+    across = np.maximum(np.abs(cols - (ncols - 1) / 2) - channel / 2, 0)
+    dem = (base + (nrows - 1 - rows) * cellsize * math.tan(math.radians(slope)) +
+           across * cellsize * math.tan(math.radians(side_slope)))
+    return dem.astype(np.float32)
+
+
+def fractal(nrows, ncols, cellsize=10, relief=300, hurst=0.8, slope=20, base=1000, seed=0):
+    """Fractal terrain (fractional Brownian surface by spectral synthesis)
+    with relief m between the lowest and highest point and the Hurst
+    exponent hurst (roughness), on a plane dipping to the south with slope
+    so the paths have a main direction"""
+    rng = np.random.default_rng(seed)
+    ky = np.fft.fftfreq(nrows)[:, None]
+    kx = np.fft.rfftfreq(ncols)[None, :]
+    k = np.hypot(ky, kx)
+    k[0, 0] = 1
+    amplitude = k ** -(hurst + 1)
+    amplitude[0, 0] = 0
+    spectrum = amplitude * np.exp(2j * np.pi * rng.random(amplitude.shape))
+    surface = np.fft.irfft2(spectrum, s=(nrows, ncols))
+    surface = (surface - surface.min()) / max(surface.max() - surface.min(), 1e-12) * relief
+    return (plane(nrows, ncols, cellsize, slope, base) + surface).astype(np.float32)
+
+
+def plateau(nrows, ncols, cellsize=10, slope=35, size=0.5, base=1000):
+    """Flat plateau covering size of the raster in the center, falling with
+    slope in degree to the borders"""
+    rows, cols = np.mgrid[0:nrows, 0:ncols]
+    dy = np.maximum(np.abs(rows - (nrows - 1) / 2) - size * nrows / 2, 0)
+    dx = np.maximum(np.abs(cols - (ncols - 1) / 2) - size * ncols / 2, 0)
+    distance = np.maximum(dy, dx) * cellsize
+    dem = base + (distance.max() - distance) * math.tan(math.radians(slope))
+    return dem.astype(np.float32)
+
+
+TERRAINS = {'plane': plane, 'cone': cone, 'valley': valley, 'fractal': fractal, 'plateau': plateau}
+
+
+def release(dem, density, seed=0, nodata=-9999):
+    """Release layer like dem with about density (0..1) of the cells as
+    release pixels (value 1), at least one, never at the border"""
+    rng = np.random.default_rng(seed)
+    inner = np.zeros(dem.shape, dtype=bool)
+    inner[1:-1, 1:-1] = True
+    inner &= dem != nodata
+    layer = np.zeros(dem.shape, dtype=np.float32)
+    layer[inner & (rng.random(dem.shape) < density)] = 1
+    if not layer.any():
+        rows, cols = np.nonzero(inner)
+        k = rng.integers(len(rows))
+        layer[rows[k], cols[k]] = 1
+    return layer
+
+
+def infrastructure(dem, value=1):
+    """Infrastructure layer like dem with a row of infrastructure (a road)
+    across the lower third of the raster"""
+    layer = np.zeros(dem.shape, dtype=np.float32)
+    layer[2 * dem.shape[0] // 3, 1:-1] = value
+    return layer
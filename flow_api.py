@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Python interface of Flow-Py for rasters that are already in memory (numpy
+arrays), e.g. in a notebook or another model:
+
+    import flow_api
+    results = flow_api.run(dem, release, cellsize=10, alpha=25, exp=8)
+    results['z_delta'], results['flux'], ...
+
+The arrays are shared with the worker processes (shared memory, see
+SPAM.shareArray) and tiled like a run of main.py, the results of the tiles are
+handed back to the main process and merged in memory. Nothing is written to
+disk unless out_dir is given.
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import logging
+import numpy as np
+import flow_core as fc
+import flow_pool
+import split_and_merge as SPAM
+
+
+def run(dem, release, cellsize, alpha=25, exp=8, flux_threshold=3 * 10 ** -4, max_z=8848, nodata=-9999,
+        infra=None, engine='cell', processes=None, maxTile=None, out_dir=None, profile=None):
+    """Calculate Flow-Py for rasters in memory.
+
+    Input parameters:
+        dem             The digital elevation model (2D array)
+        release         The release layer, release pixels need value > 0
+        cellsize        Size of a cell in m
+        alpha, exp, flux_threshold, max_z   Model parameters, see main.main
+        nodata          No data value of the DEM
+        infra           The infrastructure layer, None for a calculation
+                        without infrastructure
+        engine          'cell', 'array' or 'numba'
+        processes       Number of worker processes, default cpu_count() - 1
+        maxTile         Size of a tile in cells (a target), see SPAM.tileSize
+        out_dir         If given the results are also written to this
+                        folder as GeoTIFFs (like main.py)
+        profile         crs and transform of the output GeoTIFFs (see
+                        io.reference_profile), needed with out_dir
+
+    Output parameters:
+        results     dict layer -> raster like the DEM, the layers of
+                    fc.output_layers ('flux', 'z_delta', 'fp', 'sl' and
+                    'count', 'z_delta_sum' or with infrastructure
+                    'backcalc')
+    """
+    dem, release = np.asarray(dem), np.asarray(release)
+    infra_bool = infra is not None
+    layers = {"dem": dem, "init": release}
+    if infra_bool:
+        layers["infra"] = np.asarray(infra)
+    for name, array in layers.items():
+        if array.ndim != 2 or array.shape != dem.shape:
+            raise ValueError("{} has shape {}, the DEM {}".format(name, array.shape, dem.shape))
+    if engine not in fc.ENGINES:
+        raise ValueError("Unknown engine {}, use one of {}".format(engine, fc.ENGINES))
+    if out_dir is not None and profile is None:
+        raise ValueError("out_dir needs the profile (crs and transform) of the output")
+
+    processes = processes or flow_pool.default_processes()
+    tileCOLS, tileROWS, U = SPAM.tileSizeArray(dem, release, cellsize, nodata, alpha, processes, infra_bool,
+                                               maxTile)
+    windows, nTiles = SPAM.tileWindows(dem.shape[0], dem.shape[1], tileCOLS, tileROWS, U)
+
+    shared, blocks = {}, []
+    try:
+        for name, array in layers.items():
+            block, shared[name] = SPAM.shareArray(array, name, tileCOLS, tileROWS, U, name == "init")
+            blocks.append(block)
+        options = {'engine': engine, 'shared': shared, 'in_memory': True}
+        optList = [(i, j, alpha, exp, cellsize, nodata, flux_threshold, max_z, "", options) for i, j in windows]
+        tiles = {}
+
+        def tile_results(optTuple, results):
+            tiles[(optTuple[0], optTuple[1])] = results
+
+        failed = flow_pool.run_calculation(optList, infra_bool, processes, tile_results=tile_results)
+    finally:
+        SPAM.releaseShared(blocks)
+    if failed:
+        raise RuntimeError("{} tiles failed: {}".format(len(failed), [(t[0], t[1]) for t in failed]))
+
+    names = [layer for layer, output in fc.output_layers(infra_bool)]
+    results = SPAM.mergeArrays(dem.shape, windows, tiles, names)
+    if out_dir is not None:
+        write_results(results, out_dir, profile, infra_bool)
+    return results
+
+
+def write_results(results, out_dir, profile, infra_bool):
+    """Write the results of run to out_dir as GeoTIFFs with the file names
+    of main.py"""
+    import raster_io as io
+    os.makedirs(out_dir, exist_ok=True)
+    for layer, output in fc.output_layers(infra_bool):
+        io.output_raster(None, os.path.join(out_dir, output + ".tif"), results[layer], profile)
+    logging.info("Results written to {}".format(out_dir))
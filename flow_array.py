@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This is the array based path engine, an alternative to the flow class.
+
+A path is stored as a struct of arrays (rows, cols, flux, z_delta, ...)
+instead of one Cell object per raster cell. The spreading to the 8
+neighbours is calculated with plain python floats and lookup tables (see
+Neighbourhood), the results are the same as with the flow class.
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import os
+import zlib
+import numpy as np
+
+# The 8 neighbours in the order of the 3x3 neighbourhood (row by row), without the center
+NEIGHBOUR_ROW = (-1, -1, -1, 0, 0, 1, 1, 1)
+NEIGHBOUR_COL = (-1, 0, 1, -1, 1, -1, 0, 1)
+NEIGHBOUR_DS = tuple(math.sqrt(dy ** 2 + dx ** 2) for dy, dx in zip(NEIGHBOUR_ROW, NEIGHBOUR_COL))
+
+
+def neighbour_index(dy, dx):
+    """Index (0-7) of the neighbour with the row offset dy and col offset dx"""
+    return NEIGHBOUR_ROW.index(dy) + NEIGHBOUR_COL[NEIGHBOUR_ROW.index(dy):].index(dx)
+
+
+def persistence_table():
+    """PERSISTENCE[p][k] is the weight a parent in direction p gives to the
+    neighbour k, the direction straight away from the parent gets 1, the two
+    directions next to it 0.707 (see Cell.calc_persistence)."""
+    ring = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+    table = []
+    for p in range(8):
+        weights = [0.] * 8
+        i = ring.index((-NEIGHBOUR_ROW[p], -NEIGHBOUR_COL[p]))
+        weights[neighbour_index(*ring[i])] = 1.
+        weights[neighbour_index(*ring[i - 1])] = 0.707
+        weights[neighbour_index(*ring[(i + 1) % 8])] = 0.707
+        table.append(tuple(weights))
+    return tuple(table)
+
+
+PERSISTENCE = persistence_table()
+
+
+def np_sum(values):
+    """Sum of a short list of floats, added in the same order as np.sum does
+    it for arrays with less than 16 elements, so results are bit identical to
+    the flow class."""
+    if len(values) < 8:
+        total = 0.
+        for value in values:
+            total += value
+        return total
+    total = (((values[0] + values[1]) + (values[2] + values[3])) +
+             ((values[4] + values[5]) + (values[6] + values[7])))
+    for value in values[8:]:
+        total += value
+    return total
+
+
+def with_center(values):
+    """3x3 neighbourhood (flattened) of the 8 neighbour values with 0 in the center"""
+    return values[:4] + [0.] + values[4:]
+
+
+def valid_mask(dem, nodata):
+    """Boolean array like DEM, True where the 3x3 neighbourhood of a cell is
+    inside the DEM and has no no data, only these cells can be part of a path
+    (same as the check in flow_core.calc_path)."""
+    padded = np.pad(dem, 1, constant_values=nodata)
+    valid = dem != nodata
+    for dy, dx in zip(NEIGHBOUR_ROW, NEIGHBOUR_COL):
+        valid &= padded[1 + dy:1 + dy + dem.shape[0], 1 + dx:1 + dx + dem.shape[1]] != nodata
+    valid[[0, -1], :] = False
+    valid[:, [0, -1]] = False
+    return valid
+
+
+class Neighbourhood:
+    """Everything of the 8 neighbours of a cell that only depends on the DEM,
+    calculated once per tile and vectorized, so the engines only have to look
+    up the values. The 8 values of a cell are next to each other (last axis),
+    in the order of NEIGHBOUR_ROW and NEIGHBOUR_COL.
+
+    Input parameters:
+        dem         The digital elevation model
+        cellsize    Cellsize of the DEM
+        nodata      No data value of the DEM
+
+    Attributes:
+        padded      DEM with a border of one no data cell
+        valid       See valid_mask
+        z_gamma     (rows, cols, 8) altitude of the cell - altitude of the
+                    neighbour, dtype like the DEM (see Cell.calc_z_delta)
+        tan_beta    (rows, cols, 8) tan(beta / 2) of the slope to the
+                    neighbour (see Cell.calc_tanbeta)
+    """
+
+    def __init__(self, dem, cellsize, nodata, z_gamma=None, tan_beta=None):
+        self.cellsize = float(cellsize)
+        self.nodata = float(nodata)
+        self.padded = np.pad(dem, 1, constant_values=nodata)
+        self.valid = valid_mask(dem, nodata)
+        if z_gamma is None:
+            z_gamma = np.zeros(np.shape(dem) + (8,), dtype=dem.dtype)
+            for k, (dy, dx) in enumerate(zip(NEIGHBOUR_ROW, NEIGHBOUR_COL)):
+                z_gamma[:, :, k] = dem - self.padded[1 + dy:1 + dy + dem.shape[0], 1 + dx:1 + dx + dem.shape[1]]
+            distance = np.array(NEIGHBOUR_DS) * self.cellsize
+            tan_beta = np.tan((np.arctan(z_gamma / distance) + np.deg2rad(90)) / 2)
+        self.z_gamma = z_gamma
+        self.tan_beta = tan_beta
+
+    def save(self, file, dem):
+        """Save the neighbourhood rasters of dem (.npz), e.g. next to the tile.
+        The file is written under a temporary name and renamed, so other 
+        processes never load a half written file."""
+        temp = "{}.{}.tmp".format(file, os.getpid())
+        with open(temp, 'wb') as f:
+            np.savez(f, cellsize=self.cellsize, nodata=self.nodata, dem_crc=zlib.crc32(dem.tobytes()),
+                     z_gamma=self.z_gamma, tan_beta=self.tan_beta)
+        os.replace(temp, file)
+
+    @classmethod
+    def load(cls, file, dem, cellsize, nodata):
+        """Load saved neighbourhood rasters, None if the file doesn't exist or
+        was calculated for another DEM, cellsize or no data value."""
+        try:
+            saved = np.load(file)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        with saved:
+            if saved['cellsize'] != float(cellsize) or saved['nodata'] != float(nodata) or \
+                    saved['z_gamma'].shape != np.shape(dem) + (8,) or saved['dem_crc'] != zlib.crc32(dem.tobytes()):
+                return None
+            return cls(dem, cellsize, nodata, saved['z_gamma'], saved['tan_beta'])
+
+
+class Path:
+    """All cells of one path as arrays, cell 0 is the startcell. The arrays
+    grow by doubling, only the first n entries are valid. Parents are stored
+    as edges (child, parent)."""
+
+    def __init__(self, capacity=64, dtype=np.float32):
+        self.n = 0
+        self.n_edges = 0
+        self.rows = np.zeros(capacity, dtype=np.int64)
+        self.cols = np.zeros(capacity, dtype=np.int64)
+        self.flux = np.zeros(capacity)
+        self.z_delta = np.zeros(capacity)
+        self.min_distance = np.zeros(capacity)
+        self.max_gamma = np.zeros(capacity)
+        self.sl_gamma = np.zeros(capacity)
+        # True for the startcell and cells whose first parent is the startcell
+        self.start_persistence = np.zeros(capacity, dtype=bool)
+        # Persistence collected from the parents (dtype like the DEM, as in the flow class)
+        self.persistence = np.zeros((capacity, 8), dtype=dtype)
+        self.no_flow = np.zeros((capacity, 8), dtype=bool)
+        self.edge_child = np.zeros(capacity, dtype=np.int64)
+        self.edge_parent = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, names, size):
+        for name in names:
+            array = getattr(self, name)
+            new = np.zeros((2 * size,) + array.shape[1:], dtype=array.dtype)
+            new[:size] = array
+            setattr(self, name, new)
+
+    def add_cell(self, row, col, flux, z_delta):
+        if self.n == len(self.rows):
+            self._grow(('rows', 'cols', 'flux', 'z_delta', 'min_distance', 'max_gamma', 'sl_gamma',
+                        'start_persistence', 'persistence', 'no_flow'), self.n)
+        idx = self.n
+        self.rows[idx] = row
+        self.cols[idx] = col
+        self.flux[idx] = flux
+        self.z_delta[idx] = z_delta
+        self.min_distance[idx] = np.inf
+        self.n += 1
+        return idx
+
+    def add_parent(self, idx, parent):
+        if self.n_edges == len(self.edge_child):
+            self._grow(('edge_child', 'edge_parent'), self.n_edges)
+        self.edge_child[self.n_edges] = idx
+        self.edge_parent[self.n_edges] = parent
+        self.n_edges += 1
+
+    def upstream_max(self, values):
+        """For every cell the max. of values over all cells below it, i.e. all
+        cells that have it as ancestor. Children are always added after their
+        parents, so one sweep over the edges by descending child is enough."""
+        upstream = np.zeros(self.n, dtype=values.dtype)
+        hit = np.flatnonzero(values > 0)
+        if len(hit) == 0:
+            return upstream
+        child = self.edge_child[:self.n_edges]
+        parent = self.edge_parent[:self.n_edges]
+        below = child <= hit[-1]  # nothing to pass on from cells after the last hit
+        child, parent = child[below], parent[below]
+        order = np.argsort(child, kind='stable')[::-1]
+        upstream_list = upstream.tolist()
+        values_list = values.tolist()
+        for c, p in zip(child[order].tolist(), parent[order].tolist()):
+            down = max(upstream_list[c], values_list[c])
+            if down > upstream_list[p]:
+                upstream_list[p] = down
+        return np.array(upstream_list, dtype=values.dtype)
+
+
+def calc_path(dem, row_idx, col_idx, cellsize, alpha, exp, flux_threshold, max_z_delta, neighbourhood, cell_at):
+    """Spreading of one release pixel over the DEM, same as flow_core.calc_path
+    but with a Path instead of a list of Cells.
+
+    Input parameters:
+        dem             The digital elevation model
+        row_idx         Row index of the release pixel
+        col_idx         Column index of the release pixel
+        cellsize        Cellsize of the DEM
+        alpha, exp, flux_threshold, max_z_delta     Model parameters
+        neighbourhood   Neighbourhood of the DEM
+        cell_at         Array like DEM filled with -1, used to find the cells of
+                        the path by position, it is -1 again on return
+
+    Output parameters:
+        path        Path with all cells, empty if the release pixel is at the
+                    border or next to no data
+    """
+    path = Path(dtype=dem.dtype)
+    if not neighbourhood.valid[row_idx, col_idx]:
+        return path
+
+    exp = int(exp)
+    threshold = float(flux_threshold)
+    max_z_delta = float(max_z_delta)
+    tan_alpha = np.tan(np.deg2rad(float(alpha)))
+    # Same lookup values as in Cell.calc_z_delta
+    z_alpha = [float(ds * cellsize * tan_alpha) for ds in NEIGHBOUR_DS]
+
+    path.add_cell(row_idx, col_idx, 1., 0.)
+    path.start_persistence[0] = True
+    path.min_distance[0] = 0
+    start_altitude = dem[row_idx, col_idx]
+    cell_at[row_idx, col_idx] = 0
+
+    idx = 0
+    while idx < path.n:
+        row = int(path.rows[idx])
+        col = int(path.cols[idx])
+        flux = float(path.flux[idx])
+        z_delta = float(path.z_delta[idx])
+        altitude = dem[row, col]
+        z_gamma = neighbourhood.z_gamma[row, col].tolist()
+        tan_beta_dem = neighbourhood.tan_beta[row, col].tolist()
+
+        if idx > 0:
+            # dh keeps the dtype of the DEM, as in Cell.calc_fp_travelangle and Cell.calc_sl_travelangle
+            dh = start_altitude - altitude
+            path.max_gamma[idx] = np.rad2deg(np.arctan(dh / path.min_distance[idx]))
+            ds = math.sqrt((row_idx - row) ** 2 + (col_idx - col) ** 2) * cellsize
+            path.sl_gamma[idx] = np.rad2deg(np.arctan(dh / ds))
+
+        if path.start_persistence[idx]:
+            persistence = [1.] * 8
+        else:
+            persistence = [0. if no_flow else float(p) for p, no_flow in
+                           zip(path.persistence[idx], path.no_flow[idx])]
+
+        z_delta_neighbour = [0.] * 8
+        tan_beta = [0.] * 8
+        for k in range(8):
+            z_delta_k = z_delta + z_gamma[k] - z_alpha[k]
+            if z_delta_k < 0:
+                z_delta_k = 0.
+            if z_delta_k > max_z_delta:
+                z_delta_k = max_z_delta
+            z_delta_neighbour[k] = z_delta_k
+            if z_delta_k > 0 and persistence[k] > 0:
+                tan_beta[k] = tan_beta_dem[k]
+
+        dist = [0.] * 8
+        if abs(np_sum(with_center(tan_beta))) > 0:
+            tan_beta_exp = [t ** exp for t in tan_beta]
+            sum_tan_beta_exp = np_sum(with_center(tan_beta_exp))
+            r_t = [t / sum_tan_beta_exp for t in tan_beta_exp]
+            if np_sum(with_center(r_t)) > 0:
+                weight = [p * r for p, r in zip(persistence, r_t)]
+                sum_weight = np_sum(with_center(weight))
+                dist = [w / sum_weight * flux for w in weight]
+
+        # Flux below the threshold is spread to the other neighbours, see Cell.calc_distribution
+        count = sum(1 for d in dist if 0 < d < threshold)
+        mass_to_distribute = np_sum([d for d in with_center(dist) if d < threshold])
+        if mass_to_distribute > 0 and count > 0:
+            dist = [d + mass_to_distribute / count if d > threshold else d for d in dist]
+            dist = [0. if d < threshold else d for d in dist]
+        if count > 0 and np_sum(with_center(dist)) < flux:
+            rest = (flux - np_sum(with_center(dist))) / count
+            dist = [d + rest if d > threshold else d for d in dist]
+
+        children = sorted((z_delta_neighbour[k], dist[k], row + NEIGHBOUR_ROW[k], col + NEIGHBOUR_COL[k], k)
+                          for k in range(8) if dist[k] > threshold)
+        for z_delta_k, flux_k, row_k, col_k, k in children:
+            i = cell_at[row_k, col_k]
+            if i < idx:  # Cell is not in the path or is already calculated
+                if not neighbourhood.valid[row_k, col_k]:
+                    continue
+                i = path.add_cell(row_k, col_k, flux_k, z_delta_k)
+                path.start_persistence[i] = idx == 0
+                cell_at[row_k, col_k] = i
+            else:
+                path.flux[i] += flux_k
+                if z_delta_k > path.z_delta[i]:
+                    path.z_delta[i] = z_delta_k
+
+            # The parent lies in the opposite direction of the child
+            parent_k = 7 - k
+            path.add_parent(i, idx)
+            path.min_distance[i] = min(path.min_distance[i], NEIGHBOUR_DS[k] * cellsize + path.min_distance[idx])
+            if not path.start_persistence[i]:
+                path.no_flow[i, parent_k] = True
+                for j, weight in enumerate(PERSISTENCE[parent_k]):
+                    if weight > 0:
+                        path.persistence[i, j] = float(path.persistence[i, j]) + weight * z_delta
+        idx += 1
+
+    cell_at[path.rows[:path.n], path.cols[:path.n]] = -1
+    return path
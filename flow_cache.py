@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content addressed cache of tile results. The key of a tile is the sha1 of the
+content of its input tiles (DEM, release, infrastructure) and the model
+parameters, so the same tile is found again in another run, another
+working directory or a larger overlapping region. The results are saved as
+<key[:2]>/<key>.npz in the cache folder, the cache is limited in size and the
+least recently used entries are removed first (the modification time of an
+entry is updated on every hit).
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import hashlib
+import zipfile
+import numpy as np
+
+VERSION = 1  # change if the results of the model change
+
+
+def cache_key(arrays, parameters):
+    """sha1 of the shape, dtype and content of the arrays and the parameters"""
+    sha1 = hashlib.sha1(repr((VERSION, parameters)).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        sha1.update(repr((array.shape, array.dtype.str)).encode())
+        sha1.update(array.data)
+    return sha1.hexdigest()
+
+
+def cache_file(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + ".npz")
+
+
+def load(cache_dir, key):
+    """Result layers (dict name -> array) of key, None if they are not cached"""
+    file = cache_file(cache_dir, key)
+    try:
+        with np.load(file) as data:
+            layers = {name: data[name] for name in data.files}
+        os.utime(file)
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return None  # not cached, evicted or incomplete
+    return layers
+
+
+def store(cache_dir, key, layers):
+    """Save the result layers of key. The file is written under a temporary
+    name and renamed, other processes never read a part of an entry. The
+    size of the cache is limited once per run with evict."""
+    file = cache_file(cache_dir, key)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    temp_file = "{}.{}.tmp".format(file, os.getpid())
+    with open(temp_file, "wb") as f:
+        np.savez(f, **layers)
+    os.replace(temp_file, file)
+
+
+def evict(cache_dir, max_size):
+    """Remove the least recently used entries until the cache is not larger
+    than max_size bytes, walks the whole cache folder (once at the end of a
+    run, not for every stored tile)"""
+    entries = []
+    for root, dirs, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith(".npz"):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
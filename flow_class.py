@@ -25,6 +25,9 @@ This is the flow class
 import numpy as np
 import math
 
+# Distance to the neighbours in cells, for z_alpha (center 0) and tan_beta (center 1)
+DS_Z_ALPHA = np.array([[np.sqrt(2), 1, np.sqrt(2)], [1, 0, 1], [np.sqrt(2), 1, np.sqrt(2)]])
+DS_TAN_BETA = np.array([[np.sqrt(2), 1, np.sqrt(2)], [1, 1, 1], [np.sqrt(2), 1, np.sqrt(2)]])
 
 class Cell:
     
@@ -90,16 +93,14 @@ class Cell:
     def calc_z_delta(self):
         self.z_delta_neighbour = np.zeros((3, 3))
         self.z_gamma = self.altitude - self.dem_ng
-        ds = np.array([[np.sqrt(2), 1, np.sqrt(2)], [1, 0, 1], [np.sqrt(2), 1, np.sqrt(2)]])
         tan_alpha = np.tan(np.deg2rad(self.alpha))
-        self.z_alpha = ds * self.cellsize * tan_alpha
+        self.z_alpha = DS_Z_ALPHA * self.cellsize * tan_alpha
         self.z_delta_neighbour = self.z_delta + self.z_gamma - self.z_alpha
         self.z_delta_neighbour[self.z_delta_neighbour < 0] = 0
         self.z_delta_neighbour[self.z_delta_neighbour > self.max_z_delta] = self.max_z_delta
            
     def calc_tanbeta(self):
-        ds = np.array([[np.sqrt(2), 1, np.sqrt(2)], [1, 1, 1], [np.sqrt(2), 1, np.sqrt(2)]])
-        distance = ds * self.cellsize
+        distance = DS_TAN_BETA * self.cellsize
         
         beta = np.arctan((self.altitude - self.dem_ng) / distance) + np.deg2rad(90)
         self.tan_beta = np.tan(beta/2)
@@ -4,7 +4,7 @@
 Created on Mon Sep 16 15:15:37 2019
 
 This is the core function for Flow-Py, it handles: 
-- Sorting release pixels by altitude(get_start_idx)
+- Sorting release pixels by altitude(get_start_idx, ReleaseQueue)
 - Splitting function of the release layer for multiprocessing(split_release)
 - Back calculation if infrastructure is hit
 - Calculation of run out, etc. (Creating the cell_list and iterating through
@@ -29,11 +29,21 @@ of DEM, return arrays)
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-import sys
 import numpy as np
-from datetime import datetime
+import time
 import logging
 from flow_class import Cell
+import flow_array
+import flow_cache
+import flow_footprint
+import flow_metrics
+import flow_progress
+import split_and_merge as SPAM
+
+# Result layers of calculation_effect, in the order of calc_effect_tile
+EFFECT_LAYERS = ('z_delta', 'flux', 'count', 'z_delta_sum', 'fp', 'sl')
+# Engines of the path calculation: flow_class.Cell, flow_array.Path, flow_numba
+ENGINES = ('cell', 'array', 'numba')
 
 
 def get_start_idx(dem, release):
@@ -50,71 +60,381 @@ def get_start_idx(dem, release):
         """
     row_list, col_list = np.where(release > 0)  # Gives back the indices of the release areas
     if len(row_list) > 0:
-        altitude_list = []
-        for i in range(len(row_list)):
-            altitude_list.append(dem[row_list[i], col_list[i]])    
-        altitude_list, row_list, col_list = list(zip(*sorted(zip(altitude_list, row_list, col_list), reverse=True)))
-        # Sort this lists by altitude
-    return row_list, col_list   
+        altitude_list = dem[row_list, col_list]
+        # Sort by altitude, ties by row and column, all descending
+        order = np.lexsort((col_list, row_list, altitude_list))[::-1]
+        row_list, col_list = row_list[order], col_list[order]
+    return row_list, col_list
+
+
+class ReleaseQueue:
+    """Release pixels of a tile, handed out highest altitude first.
 
+    The release pixels are sorted once, pixels that are hit by a path are
+    retired via a rank raster, so only the footprint of the last path has to
+    be checked instead of the whole release layer.
 
-def back_calculation(back_cell):
-    """Here the back calculation from a run out pixel that hits a infrastructure
-    to the release pixel is performed.
+    Input parameters:
+        dem         Digital Elevation Model to gain information about altitude
+        release     The release layer, release pixels need int value > 0
+    """
+
+    def __init__(self, dem, release):
+        self.row_list, self.col_list = get_start_idx(dem, release)
+        self.rank = np.full(np.shape(release), -1, dtype=np.int64)
+        self.rank[self.row_list, self.col_list] = np.arange(len(self.row_list))
+        self.retired = np.zeros(len(self.row_list), dtype=bool)
+        self.position = 0
+
+    def __len__(self):
+        return len(self.row_list)
+
+    def pop(self):
+        """Return row and col of the next release pixel that was not hit by a
+        previous path, None if there is none left."""
+        while self.position < len(self.row_list) and self.retired[self.position]:
+            self.position += 1
+        if self.position >= len(self.row_list):
+            return None
+        self.retired[self.position] = True
+        self.position += 1
+        return self.row_list[self.position - 1], self.col_list[self.position - 1]
+
+    def retire(self, rows, cols):
+        """Retire the release pixels at rows, cols (e.g. all pixels of a path
+        with z_delta > 0), so they are not used as start cell anymore."""
+        rank = self.rank[rows, cols]
+        self.retired[rank[rank >= 0]] = True
+
+
+def back_calculation(cell_list, infra, backcalc):
+    """Here the back calculation from the run out pixels that hit a 
+    infrastructure to the release pixel is performed. The cells are visited 
+    once in reverse order (children always come after their parents in 
+    cell_list), every cell passes the max. infrastructure value hit below it
+    on to its parents.
+    
+    Input parameters:
+        cell_list   All cells of one path, starting with the startcell
+        infra       The infrastructure layer
+        backcalc    Array with back calculation, updated in place
+    """
+    hit = [max(infra[cell.rowindex, cell.colindex], 0) for cell in cell_list]
+    if not any(hit):
+        return
+    index = {id(cell): i for i, cell in enumerate(cell_list)}
+    upstream = [0] * len(cell_list)
+    for i in range(len(cell_list) - 1, 0, -1):
+        down = max(upstream[i], hit[i])
+        if down > 0:
+            for parent in cell_list[i].parent:
+                j = index[id(parent)]
+                upstream[j] = max(upstream[j], down)
+    back = [i for i, value in enumerate(upstream) if value > 0]
+    rows = [cell_list[i].rowindex for i in back]
+    cols = [cell_list[i].colindex for i in back]
+    np.maximum.at(backcalc, (rows, cols), np.array([upstream[i] for i in back]).astype(backcalc.dtype))
+
+
+def back_calculation_path(path, infra, backcalc):
+    """Back calculation for a Path of the array engine, every cell on the way
+    from a cell that hits a infrastructure to the release pixel gets the max.
+    infrastructure value (see back_calculation).
     
     Input parameters:
-        hit_cell_list        All cells that hit a Infrastructure
+        path        Path (flow_array) of one release pixel
+        infra       The infrastructure layer
+        backcalc    Array with back calculation, updated in place
+    """
+    rows, cols = path.rows[:path.n], path.cols[:path.n]
+    upstream = path.upstream_max(np.maximum(infra[rows, cols], 0))
+    back = upstream > 0
+    np.maximum.at(backcalc, (rows[back], cols[back]), upstream[back].astype(backcalc.dtype))
+
+
+def add_cells(rows, cols, z_delta, flux, max_gamma, sl_gamma, z_delta_array, flux_array, count_array, z_delta_sum,
+              fp_travelangle_array, sl_travelangle_array):
+    """Reduce the values of all cells of one path into the result arrays in
+    one scatter per array, same as the cell by cell update (np.add.at adds in
+    the order of the cells)."""
+    idx = (rows, cols)
+    np.maximum.at(z_delta_array, idx, z_delta)
+    np.maximum.at(flux_array, idx, flux)
+    np.add.at(count_array, idx, 1)
+    np.add.at(z_delta_sum, idx, z_delta)
+    np.maximum.at(fp_travelangle_array, idx, max_gamma)
+    np.maximum.at(sl_travelangle_array, idx, sl_gamma)
+
+
+def add_path(path, z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array, sl_travelangle_array):
+    """Add all cells of a Path (array engine) to the result arrays."""
+    n = path.n
+    add_cells(path.rows[:n], path.cols[:n], path.z_delta[:n], path.flux[:n], path.max_gamma[:n], path.sl_gamma[:n],
+              z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array, sl_travelangle_array)
+
+
+def add_cell_list(cell_list, z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array,
+                  sl_travelangle_array):
+    """Add all cells of a cell_list (flow class) to the result arrays."""
+    if not cell_list:
+        return
+    add_cells(np.array([cell.rowindex for cell in cell_list]), np.array([cell.colindex for cell in cell_list]),
+              np.array([cell.z_delta for cell in cell_list], dtype=np.float64),
+              np.array([cell.flux for cell in cell_list], dtype=np.float64),
+              np.array([cell.max_gamma for cell in cell_list], dtype=np.float64),
+              np.array([cell.sl_gamma for cell in cell_list], dtype=np.float64),
+              z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array, sl_travelangle_array)
+
+    
+def calc_path(dem, row_idx, col_idx, cellsize, alpha, exp, flux_threshold, max_z_delta, valid):
+    """Spreading of one release pixel over the DEM, every cell of the path is
+    calculated once, in the order it was reached.
+    
+    Input parameters:
+        dem             The digital elevation model
+        row_idx         Row index of the release pixel
+        col_idx         Column index of the release pixel
+        cellsize        Cellsize of the DEM
+        alpha, exp, flux_threshold, max_z_delta     Model parameters
+        valid           flow_array.valid_mask of the DEM, False for cells at
+                        the border or next to no data
         
     Output parameters:
-        Back_list   List of pixels that are on the way to the start cell
-                    Maybe change it to array like DEM?
+        cell_list   List of all cells of the path, starting with the startcell,
+                    empty if the release pixel is at the border or next to
+                    no data
     """
-    #start = time.time()
-    #if len(hit_cell_list) > 1:
-        #hit_cell_list.sort(key=lambda cell: cell.altitude, reverse=False)
-        #print("{} Elements sorted!".format(len(hit_cell_list)))
-    back_list = []
-    for parent in back_cell.parent:
-        if parent not in back_list:
-            back_list.append(parent)
-    for cell in back_list:
-        for parent in cell.parent:
-            # Check if parent already in list
-            if parent not in back_list:
-                back_list.append(parent)
-    #end = time.time()            
-    #print('\n Backcalculation needed: ' + str(end - start) + ' seconds')
-    return back_list
+    cell_list = []
+    if not valid[row_idx, col_idx]:
+        return cell_list
+    dem_ng = dem[row_idx - 1:row_idx + 2, col_idx - 1:col_idx + 2]  # neighbourhood DEM
+
+    startcell = Cell(row_idx, col_idx, dem_ng, cellsize, 1, 0, None,
+                     alpha, exp, flux_threshold, max_z_delta, startcell=True)
+    # If this is a startcell just give a Bool to startcell otherwise the object startcell
+
+    cell_list.append(startcell)
+    # (row, col) -> index in cell_list of the newest cell at this position
+    cell_index = {(row_idx, col_idx): 0}
+
+    for idx, cell in enumerate(cell_list):
+        row, col, flux, z_delta = cell.calc_distribution()
+
+        # Sort this lists by z_delta, to start with the lowest cell
+        for k in np.lexsort((col, row, flux, z_delta)):
+            position = (row[k], col[k])
+            i = cell_index.get(position, -1)
+            if i >= idx:  # Cell already exists and is not calculated yet
+                cell_list[i].add_os(flux[k])
+                cell_list[i].add_parent(cell)
+                if z_delta[k] > cell_list[i].z_delta:
+                    cell_list[i].z_delta = z_delta[k]
+                continue
+
+            if not valid[row[k], col[k]]:
+                continue
+            dem_ng = dem[row[k] - 1:row[k] + 2, col[k] - 1:col[k] + 2]  # neighbourhood DEM
+            cell_index[position] = len(cell_list)
+            cell_list.append(
+                Cell(row[k], col[k], dem_ng, cellsize, flux[k], z_delta[k], cell, alpha, exp, flux_threshold, max_z_delta, startcell))
+    return cell_list
+
+
+def output_layers(infra_bool):
+    """Result layers (res_<layer> tiles) and the name of their output file"""
+    layers = [("flux", "flux"), ("z_delta", "z_delta"), ("fp", "FP_travel_angle"), ("sl", "SL_travel_angle")]
+    if infra_bool:
+        layers.append(("backcalc", "backcalculation"))
+    else:
+        layers += [("count", "cell_counts"), ("z_delta_sum", "z_delta_sum")]
+    return layers
+
+
+def load_tile(optTuple, layer):
+    """Tile i, j (optTuple[0], optTuple[1]) of an input layer ("dem", "init"
+    or "infra"), saved by tileRaster to the temp folder or, if the options 
+    have an entry "shared", shared by shareRaster."""
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    if 'shared' in options:
+        return SPAM.sharedTile(options['shared'][layer], optTuple[0], optTuple[1])
+    return np.load(optTuple[8] + "{}_{}_{}.npy".format(layer, optTuple[0], optTuple[1]))
+
+
+def release_layer(optTuple):
+    """Name of the release layer of a tile, "init" or, if the options have an
+    entry "release", this layer (e.g. only the added release pixels of an
+    incremental update, see flow_update)"""
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    return options.get('release', "init")
+
+
+def load_neighbourhood(temp_dir, optTuple, dem, cellsize, nodata, cache):
+    """Neighbourhood rasters (flow_array.Neighbourhood) of a tile for the array
+    and numba engine. With cache they are saved next to the tile as
+    neighbours_i_j.npz and reused as long as DEM, cellsize and no data match."""
+    file = temp_dir + "neighbours_{}_{}.npz".format(optTuple[0], optTuple[1])
+    neighbourhood = None
+    if cache:
+        neighbourhood = flow_array.Neighbourhood.load(file, dem, cellsize, nodata)
+    if neighbourhood is None:
+        neighbourhood = flow_array.Neighbourhood(dem, cellsize, nodata)
+        if cache:
+            neighbourhood.save(file, dem)
+    return neighbourhood
+
+
+def load_engine(optTuple, dem, cellsize, nodata):
+    """Engine of a tile (options entry "engine", see ENGINES) and what it
+    needs, the numba engine falls back to the array engine if Numba is not
+    installed.
 
-    
-def calculation(optTuple):
-    """This is the core function where all the data handling and calculation is
-    done. 
+    Output parameters:
+        engine          'cell', 'array' or 'numba'
+        numba_path      flow_numba.calc_path for the numba engine, else None
+        valid           flow_array.valid_mask of the DEM for the cell engine
+        neighbourhood   load_neighbourhood for the array and numba engine
+        cell_at         Index of the path cells (array and numba engine)
+    """
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    engine = options.get('engine', 'cell')
+    numba_path, valid, neighbourhood, cell_at = None, None, None, None
+    if engine == 'numba':
+        import flow_numba  # Numba is slow to import, only for the numba engine
+        if flow_numba.numba_available:
+            numba_path = flow_numba.calc_path
+        else:
+            logging.warning("Numba is not installed, using the array engine")
+            engine = 'array'
+    if engine == 'cell':
+        valid = flow_array.valid_mask(dem, nodata)
+    else:
+        neighbourhood = load_neighbourhood(optTuple[8], optTuple, dem, cellsize, nodata,
+                                           options.get('neighbour_cache', False))
+        cell_at = np.full(np.shape(dem), -1, dtype=np.int64)
+    return engine, numba_path, valid, neighbourhood, cell_at
+
+
+def result_dir(optTuple):
+    """Folder of the res_<layer>_i_j.npy of a tile, the temp folder or, if the
+    options have an entry "res_dir" (e.g. one folder per parameter set of a
+    sweep), this folder"""
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    return options.get('res_dir', optTuple[8])
+
+
+def save_results(optTuple, layers):
+    """Save the result arrays of tile i, j (optTuple[0], optTuple[1]) to the 
+    result folder (see result_dir) as res_<layer>_i_j.npy"""
+    for name, array in layers.items():
+        np.save(result_dir(optTuple) + "./res_{}_{}_{}".format(name, optTuple[0], optTuple[1]), array)
+
+
+def result_cache_key(optTuple, infra_bool):
+    """Key of the results of a tile in the result cache: the content of the
+    input tiles and the model parameters (see flow_cache), the entry
+    "cache_key" of the options if it was computed before (see with_cache_key)"""
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    if 'cache_key' in options:
+        return options['cache_key']
+    layers = ("dem", release_layer(optTuple), "infra") if infra_bool else ("dem", release_layer(optTuple))
+    parameters = (infra_bool, float(optTuple[2]), float(optTuple[3]), float(optTuple[4]), float(optTuple[5]),
+                  float(optTuple[6]), float(optTuple[7]), options.get('engine', 'cell'))
+    return flow_cache.cache_key([load_tile(optTuple, layer) for layer in layers], parameters)
+
+
+def with_cache_key(optTuple, infra_bool):
+    """optTuple with the key of its results in the result cache as entry
+    "cache_key" of the options, so the input tiles are hashed once per tile
+    and not again by cached_results and cache_results. optTuple itself if
+    the options have no entry "cache"."""
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    if 'cache' not in options or 'cache_key' in options:
+        return optTuple
+    return tuple(optTuple[:9]) + (dict(options, cache_key=result_cache_key(optTuple, infra_bool)),)
+
+
+def cached_results(optTuple, infra_bool):
+    """Results of a tile from the result cache, if the options have an entry
+    "cache" ({'dir': cache folder, 'max_size': bytes}), None if not cached"""
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    if 'cache' not in options or options.get('footprints', False):
+        return None  # the cache has no footprints
+    return flow_cache.load(options['cache']['dir'], result_cache_key(optTuple, infra_bool))
+
+
+def cache_results(optTuple, infra_bool, layers):
+    """Save the results of a tile to the result cache, see cached_results"""
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    if 'cache' in options:
+        flow_cache.store(options['cache']['dir'], result_cache_key(optTuple, infra_bool), layers)
+
+
+def evict_cache(optList):
+    """Limit the result caches of the tiles of optList to their max_size,
+    once at the end of a run (see flow_cache.evict)"""
+    caches = {}
+    for optTuple in optList:
+        options = optTuple[9] if len(optTuple) > 9 else {}
+        if 'cache' in options:
+            caches[options['cache']['dir']] = options['cache']['max_size']
+    for cache_dir, max_size in caches.items():
+        flow_cache.evict(cache_dir, max_size)
+
+
+def footprint_file(optTuple):
+    """File of the footprints of the paths of a tile (see flow_footprint)"""
+    return result_dir(optTuple) + "footprints_{}_{}.npz".format(optTuple[0], optTuple[1])
+
+
+def backcalculation_tile(optTuple, metrics=None):
+    """Back calculation of a tile from the footprints of its paths (saved by
+    calculation with the option footprints in the temp folder) with the
+    infrastructure layer of the options entry "infra" (default "infra"), the
+    paths are not calculated again. The result is saved as
+    res_backcalc_i_j.npy (see save_results), metrics (a dict) gets the
+    metrics of the tile (see flow_metrics)."""
+    tile_metrics = flow_metrics.TileMetrics()
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    infra = load_tile(optTuple, options.get('infra', "infra"))
+    backcalc = np.zeros(np.shape(infra), dtype=np.int32)
+    footprints = flow_footprint.load(optTuple[8] + "footprints_{}_{}.npz".format(optTuple[0], optTuple[1]))
+    start = time.perf_counter()
+    flow_footprint.back_calculation(footprints, infra, backcalc)
+    tile_metrics.backcalc = time.perf_counter() - start
+    for cells in np.diff(footprints['path_cells']):
+        tile_metrics.path(int(cells))
+    save_results(optTuple, {'backcalc': backcalc})
+    if metrics is not None:
+        metrics.update(tile_metrics.finish())
+    logging.info("finished back calculation {}_{}".format(optTuple[0], optTuple[1]))
+
+
+def calc_infra_tile(optTuple, metrics=None):
+    """Calculation with infrastructure of a tile: the paths of the release
+    pixels, starting with the highest, and the back calculation from the
+    infrastructure they hit. A release pixel hit by a path is no start cell
+    anymore, so the tile is calculated as a whole.
     
     Input parameters:
-        dem         The digital elevation model
-        header      The header of the elevation model
-        forest      The forest layer
-        process     Which process to calculate (Avalanche, Rockfall, SoilSlides)     
-        release     The list of release arrays
-        alpha
-        exp
-        flux_threshold
-        max_z_delta
+        optTuple    See calculation_effect, the tiles "dem", "init" and
+                    "infra" are loaded with load_tile
+        metrics     A dict, gets the metrics of the tile (see flow_metrics)
         
     Output parameters:
-        z_delta     Array like DEM with the max. kinetic Energy Height for every 
-                    pixel
-        flux_array  Array with max. concentration factor saved
-        count_array Array with the number of hits for every pixel
-        elh_sum     Array with the sum of Energy Line Height
-        back_calc   Array with back calculation, still to do!!!
+        results     dict layer -> array like the tile: z_delta (max. energy
+                    line height), z_delta_sum, flux (max. concentration
+                    factor), count (hits of a cell), fp and sl (max. travel
+                    angles) and backcalc (max. infrastructure value that
+                    the paths through a cell hit)
+    
+    With the options entry "footprints" the paths are saved to
+    footprint_file for backcalculation_tile.
         """
-    temp_dir = optTuple[8]
+    tile_metrics = flow_metrics.TileMetrics()
     
-    dem = np.load(temp_dir + "dem_{}_{}.npy".format(optTuple[0], optTuple[1]))
-    release = np.load(temp_dir + "init_{}_{}.npy".format(optTuple[0], optTuple[1]))
-    infra = np.load(temp_dir + "infra_{}_{}.npy".format(optTuple[0], optTuple[1]))
+    dem = load_tile(optTuple, "dem")
+    release = load_tile(optTuple, "init")
+    infra = load_tile(optTuple, "infra")
     
     alpha = float(optTuple[2])
     exp = float(optTuple[3])
@@ -122,6 +442,8 @@ def calculation(optTuple):
     nodata = float(optTuple[5])
     flux_threshold = float(optTuple[6])
     max_z_delta = float(optTuple[7])
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    engine, numba_path, valid, neighbourhood, cell_at = load_engine(optTuple, dem, cellsize, nodata)
     
     z_delta_array = np.zeros_like(dem, dtype=np.float32)
     z_delta_sum = np.zeros_like(dem, dtype=np.float32)
@@ -131,119 +453,98 @@ def calculation(optTuple):
     fp_travelangle_array = np.zeros_like(dem, dtype=np.float32)  # fp = Flow Path
     sl_travelangle_array = np.zeros_like(dem, dtype=np.float32) * 90  # sl = Straight Line
     
-    back_list = []
+    footprints = flow_footprint.Footprints() if options.get('footprints', False) else None
 
     # Core
-    start = datetime.now().replace(microsecond=0)
-    row_list, col_list = get_start_idx(dem, release)
-
-    startcell_idx = 0
-    while startcell_idx < len(row_list):
-        
-        sys.stdout.write('\r' "Calculating Startcell: " + str(startcell_idx + 1) + " of " + str(len(row_list)) + " = " + str(
-            round((startcell_idx + 1) / len(row_list) * 100, 2)) + "%" '\r')
-        sys.stdout.flush()
-
-        cell_list = []
-        row_idx = row_list[startcell_idx]
-        col_idx = col_list[startcell_idx]
-        dem_ng = dem[row_idx - 1:row_idx + 2, col_idx - 1:col_idx + 2]  # neighbourhood DEM
-        if (nodata in dem_ng) or np.size(dem_ng) < 9:
-            startcell_idx += 1
-            continue
-
-        startcell = Cell(row_idx, col_idx, dem_ng, cellsize, 1, 0, None,
-                         alpha, exp, flux_threshold, max_z_delta, startcell=True)
-        # If this is a startcell just give a Bool to startcell otherwise the object startcell
-
-        cell_list.append(startcell)
-
-        for idx, cell in enumerate(cell_list):
-            row, col, flux, z_delta = cell.calc_distribution()
-
-            if len(flux) > 0:
-                # mass, row, col  = list(zip(*sorted(zip( mass, row, col), reverse=False)))
-                
-                z_delta, flux, row, col = list(zip(*sorted(zip(z_delta, flux, row, col), reverse=False)))
-                # Sort this lists by elh, to start with the highest cell
-
-            for i in range(idx, len(cell_list)):  # Check if Cell already exists
-                k = 0
-                while k < len(row):
-                    if row[k] == cell_list[i].rowindex and col[k] == cell_list[i].colindex:
-                        cell_list[i].add_os(flux[k])
-                        cell_list[i].add_parent(cell)
-                        if z_delta[k] > cell_list[i].z_delta:
-                            cell_list[i].z_delta = z_delta[k]
-                        row = np.delete(row, k)
-                        col = np.delete(col, k)
-                        flux = np.delete(flux, k)
-                        z_delta = np.delete(z_delta, k)
-                    else:
-                        k += 1
-
-            for k in range(len(row)):
-                dem_ng = dem[row[k] - 1:row[k] + 2, col[k] - 1:col[k] + 2]  # neighbourhood DEM
-                if (nodata in dem_ng) or np.size(dem_ng) < 9:
-                    continue
-                cell_list.append(
-                    Cell(row[k], col[k], dem_ng, cellsize, flux[k], z_delta[k], cell, alpha, exp, flux_threshold, max_z_delta, startcell))
-
-            z_delta_array[cell.rowindex, cell.colindex] = max(z_delta_array[cell.rowindex, cell.colindex], cell.z_delta)
-            flux_array[cell.rowindex, cell.colindex] = max(flux_array[cell.rowindex, cell.colindex], cell.flux)
-            count_array[cell.rowindex, cell.colindex] += int(1)
-            z_delta_sum[cell.rowindex, cell.colindex] += cell.z_delta
-            fp_travelangle_array[cell.rowindex, cell.colindex] = max(fp_travelangle_array[cell.rowindex, cell.colindex], cell.max_gamma)
-            sl_travelangle_array[cell.rowindex, cell.colindex] = max(sl_travelangle_array[cell.rowindex, cell.colindex], cell.sl_gamma)
-            
-        #Backcalculation
-            if infra[cell.rowindex, cell.colindex] > 0:
-                #backlist = []
-                back_list = back_calculation(cell)
-
-                for back_cell in back_list:
-                    backcalc[back_cell.rowindex, back_cell.colindex] = max(backcalc[back_cell.rowindex, back_cell.colindex],
-                                                                           infra[cell.rowindex, cell.colindex])
-        release[z_delta_array > 0] = 0
-        # Check if i hit a release Cell, if so set it to zero and get again the indexes of release cells
-        row_list, col_list = get_start_idx(dem, release)
-        startcell_idx += 1
-    end = datetime.now().replace(microsecond=0) 
-
-    # Save Calculated tiles
-    np.save(temp_dir + "./res_z_delta_{}_{}".format(optTuple[0], optTuple[1]), z_delta_array)
-    np.save(temp_dir + "./res_z_delta_sum_{}_{}".format(optTuple[0], optTuple[1]), z_delta_sum)
-    np.save(temp_dir + "./res_flux_{}_{}".format(optTuple[0], optTuple[1]), flux_array)    
-    np.save(temp_dir + "./res_count_{}_{}".format(optTuple[0], optTuple[1]), count_array)
-    np.save(temp_dir + "./res_fp_{}_{}".format(optTuple[0], optTuple[1]), fp_travelangle_array)
-    np.save(temp_dir + "./res_sl_{}_{}".format(optTuple[0], optTuple[1]), sl_travelangle_array)
-    np.save(temp_dir + "./res_backcalc_{}_{}".format(optTuple[0], optTuple[1]), backcalc)
-      
-    print('\n Time needed: ' + str(end - start))
-    print("Finished calculation {}_{}".format(optTuple[0], optTuple[1]))
-    
-    
-def calculation_effect(optTuple):
-    """This is the core function where all the data handling and calculation is
-    done. 
+    release_queue = ReleaseQueue(dem, release)
+    progress = flow_progress.Throttle((result_dir(optTuple), optTuple[0], optTuple[1], 0))
+
+    start_idx = release_queue.pop()
+    while start_idx is not None:
+        progress.update(release_queue.position)
+        row_idx, col_idx = start_idx
+        if engine == 'numba':
+            rows, cols, z_delta, flux, edge_child, edge_parent = numba_path(
+                dem, row_idx, col_idx, cellsize, alpha, exp, flux_threshold, max_z_delta, neighbourhood, cell_at,
+                (z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array, sl_travelangle_array),
+                infra, backcalc)
+            tile_metrics.path(len(rows))
+            if footprints is not None:
+                footprints.add(rows, cols, z_delta, flux, edge_child, edge_parent)
+            # Check if i hit a release Cell, if so it is no start cell anymore
+            release_queue.retire(rows[z_delta > 0], cols[z_delta > 0])
+        elif engine == 'array':
+            path = flow_array.calc_path(dem, row_idx, col_idx, cellsize, alpha, exp, flux_threshold, max_z_delta,
+                                        neighbourhood, cell_at)
+            add_path(path, z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array,
+                     sl_travelangle_array)
+            tile_metrics.path(path.n)
+            back_start = time.perf_counter()
+            back_calculation_path(path, infra, backcalc)
+            tile_metrics.backcalc += time.perf_counter() - back_start
+            if footprints is not None:
+                footprints.add_path(path)
+            # Check if i hit a release Cell, if so it is no start cell anymore
+            hit = path.z_delta[:path.n] > 0
+            release_queue.retire(path.rows[:path.n][hit], path.cols[:path.n][hit])
+        else:
+            cell_list = calc_path(dem, row_idx, col_idx, cellsize, alpha, exp, flux_threshold, max_z_delta, valid)
+            add_cell_list(cell_list, z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array,
+                          sl_travelangle_array)
+            tile_metrics.path(len(cell_list))
+
+            #Backcalculation
+            back_start = time.perf_counter()
+            back_calculation(cell_list, infra, backcalc)
+            tile_metrics.backcalc += time.perf_counter() - back_start
+            if footprints is not None:
+                footprints.add_cell_list(cell_list)
+            # Check if i hit a release Cell, if so it is no start cell anymore
+            hit_list = [cell for cell in cell_list if cell.z_delta > 0]
+            release_queue.retire([cell.rowindex for cell in hit_list], [cell.colindex for cell in hit_list])
+        start_idx = release_queue.pop()
+    progress.finish(len(release_queue))
+
+    if footprints is not None:
+        footprints.save(footprint_file(optTuple), np.shape(dem))
+
+    if metrics is not None:
+        metrics.update(tile_metrics.finish(backcalc=engine != 'numba'))
+    return {'z_delta': z_delta_array, 'z_delta_sum': z_delta_sum, 'flux': flux_array, 'count': count_array,
+            'fp': fp_travelangle_array, 'sl': sl_travelangle_array, 'backcalc': backcalc}
+
+
+def calculation(optTuple, metrics=None):
+    """Calculation with infrastructure of a tile (see calc_infra_tile), the
+    results are saved to the temp folder as res_<layer>_i_j.npy."""
+    results = calc_infra_tile(optTuple, metrics)
+    save_results(optTuple, results)
+    cache_results(optTuple, True, results)
+    logging.info("finished calculation {}_{}".format(optTuple[0], optTuple[1]))
+
+
+def calc_effect_tile(optTuple, start=0, stop=None, metrics=None):
+    """Calculation without infrastructure of the release pixels 
+    row_list[start:stop] of a tile (sorted by get_start_idx), all of them by 
+    default. Without infrastructure the paths don't influence each other, so
+    a tile can be split into batches of release pixels and the results 
+    reduced afterwards (see flow_pool).
     
     Input parameters:
-        dem         The digital elevation model
-        release     The list of release arrays
+        optTuple    See calculation_effect
+        start, stop Slice of the sorted release pixels
+        metrics     A dict, gets the metrics of the tile (see flow_metrics)
         
     Output parameters:
-        z_delta        Array like DEM with the max. Energy Line Height for every 
-                    pixel
-        flux_array  Array with max. concentration factor saved
-        count_array Array with the number of hits for every pixel
-        z_delta_sum     Array with the sum of Energy Line Height
-        back_calc   Array with back calculation, still to do!!!
-        """
+        z_delta_array, flux_array, count_array, z_delta_sum,
+        fp_travelangle_array, sl_travelangle_array      Arrays like the tile,
+                                                        see EFFECT_LAYERS
+    """
     
-    temp_dir = optTuple[8]
+    tile_metrics = flow_metrics.TileMetrics()
     
-    dem = np.load(temp_dir + "dem_{}_{}.npy".format(optTuple[0], optTuple[1]))
-    release = np.load(temp_dir + "init_{}_{}.npy".format(optTuple[0], optTuple[1]))
+    dem = load_tile(optTuple, "dem")
+    release = load_tile(optTuple, release_layer(optTuple))
     
     alpha = float(optTuple[2])
     exp = float(optTuple[3])
@@ -251,6 +552,8 @@ def calculation_effect(optTuple):
     nodata = float(optTuple[5])
     flux_threshold = float(optTuple[6])
     max_z_delta = float(optTuple[7])
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    engine, numba_path, valid, neighbourhood, cell_at = load_engine(optTuple, dem, cellsize, nodata)
     
     z_delta_array = np.zeros_like(dem, dtype=np.float32)
     z_delta_sum = np.zeros_like(dem, dtype=np.float32)
@@ -261,83 +564,53 @@ def calculation_effect(optTuple):
     sl_travelangle_array = np.ones_like(dem, dtype=np.float32) * 90  # sl = Straight Line
 
     # Core
-    start = datetime.now().replace(microsecond=0)
     row_list, col_list = get_start_idx(dem, release)
+    row_list, col_list = row_list[start:stop], col_list[start:stop]
+    progress = flow_progress.Throttle((result_dir(optTuple), optTuple[0], optTuple[1], start))
 
     startcell_idx = 0
     while startcell_idx < len(row_list):
-        
-        sys.stdout.write('\r' "Calculating Startcell: " + str(startcell_idx + 1) + " of " + str(len(row_list)) + " = " + str(
-            round((startcell_idx + 1) / len(row_list) * 100, 2)) + "%" '\r')
-        sys.stdout.flush()
-
-        cell_list = []
+        progress.update(startcell_idx)
         row_idx = row_list[startcell_idx]
         col_idx = col_list[startcell_idx]
-        dem_ng = dem[row_idx - 1:row_idx + 2, col_idx - 1:col_idx + 2]  # neighbourhood DEM
-        if (nodata in dem_ng) or np.size(dem_ng) < 9:
-            startcell_idx += 1
-            continue
-
-        startcell = Cell(row_idx, col_idx, dem_ng, cellsize, 1, 0, None,
-                         alpha, exp, flux_threshold, max_z_delta, True)
-        # If this is a startcell just give a Bool to startcell otherwise the object startcell
-
-        cell_list.append(startcell)
-
-        for idx, cell in enumerate(cell_list):
-            row, col, flux, z_delta = cell.calc_distribution()
-
-            if len(flux) > 0:
-                z_delta, flux, row, col = list(zip(*sorted(zip(z_delta, flux, row, col), reverse=False)))  # reverse = True == descending
-
-            for i in range(idx, len(cell_list)):  # Check if Cell already exists
-                k = 0
-                while k < len(row):
-                    if row[k] == cell_list[i].rowindex and col[k] == cell_list[i].colindex:
-                        cell_list[i].add_os(flux[k])
-                        cell_list[i].add_parent(cell)
-                        if z_delta[k] > cell_list[i].z_delta:
-                            cell_list[i].z_delta = z_delta[k]
-
-                        row = np.delete(row, k)
-                        col = np.delete(col, k)
-                        flux = np.delete(flux, k)
-                        z_delta = np.delete(z_delta, k)
-                    else:
-                        k += 1
-
-            for k in range(len(row)):
-                dem_ng = dem[row[k] - 1:row[k] + 2, col[k] - 1:col[k] + 2]  # neighbourhood DEM
-                if (nodata in dem_ng) or np.size(dem_ng) < 9:
-                    continue
-                cell_list.append(
-                    Cell(row[k], col[k], dem_ng, cellsize, flux[k], z_delta[k], cell, alpha, exp, flux_threshold, max_z_delta, startcell))
-
-        for cell in cell_list:
-            z_delta_array[cell.rowindex, cell.colindex] = max(z_delta_array[cell.rowindex, cell.colindex], cell.z_delta)
-            flux_array[cell.rowindex, cell.colindex] = max(flux_array[cell.rowindex, cell.colindex],
-                                                           cell.flux)
-            count_array[cell.rowindex, cell.colindex] += 1
-            z_delta_sum[cell.rowindex, cell.colindex] += cell.z_delta
-            fp_travelangle_array[cell.rowindex, cell.colindex] = max(fp_travelangle_array[cell.rowindex, cell.colindex],
-                                                                     cell.max_gamma)
-            sl_travelangle_array[cell.rowindex, cell.colindex] = max(sl_travelangle_array[cell.rowindex, cell.colindex],
-                                                                     cell.sl_gamma)
+        if engine == 'numba':
+            rows = numba_path(
+                dem, row_idx, col_idx, cellsize, alpha, exp, flux_threshold, max_z_delta, neighbourhood, cell_at,
+                (z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array, sl_travelangle_array))[0]
+            tile_metrics.path(len(rows))
+        elif engine == 'array':
+            path = flow_array.calc_path(dem, row_idx, col_idx, cellsize, alpha, exp, flux_threshold, max_z_delta,
+                                        neighbourhood, cell_at)
+            add_path(path, z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array,
+                     sl_travelangle_array)
+            tile_metrics.path(path.n)
+        else:
+            cell_list = calc_path(dem, row_idx, col_idx, cellsize, alpha, exp, flux_threshold, max_z_delta, valid)
+            add_cell_list(cell_list, z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array,
+                          sl_travelangle_array)
+            tile_metrics.path(len(cell_list))
 
         startcell_idx += 1
+    progress.finish(len(row_list))
+
+    if metrics is not None:
+        metrics.update(tile_metrics.finish(backcalc=False))
+    return z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array, sl_travelangle_array
+
+
+def calculation_effect(optTuple, metrics=None):
+    """Calculation without infrastructure of a tile (see calc_effect_tile),
+    the results are saved to the result folder as res_<layer>_i_j.npy
+    (see save_results) and to the result cache.
     
-    # Save Calculated tiles
-    np.save(temp_dir + "./res_z_delta_{}_{}".format(optTuple[0], optTuple[1]), z_delta_array)
-    np.save(temp_dir + "./res_z_delta_sum_{}_{}".format(optTuple[0], optTuple[1]), z_delta_sum)
-    np.save(temp_dir + "./res_flux_{}_{}".format(optTuple[0], optTuple[1]), flux_array)    
-    np.save(temp_dir + "./res_count_{}_{}".format(optTuple[0], optTuple[1]), count_array)
-    np.save(temp_dir + "./res_fp_{}_{}".format(optTuple[0], optTuple[1]), fp_travelangle_array)
-    np.save(temp_dir + "./res_sl_{}_{}".format(optTuple[0], optTuple[1]), sl_travelangle_array)
+    Input parameters:
+        optTuple    (i, j, alpha, exp, cellsize, nodata, flux_threshold,
+                    max_z_delta, temp_dir, options), the tile i, j of the
+                    temp folder and the options dict (engine, cache, ...)
+        metrics     A dict, gets the metrics of the tile (see flow_metrics)
+        """
+    results = dict(zip(EFFECT_LAYERS, calc_effect_tile(optTuple, metrics=metrics)))
+    save_results(optTuple, results)
+    cache_results(optTuple, False, results)
     
     logging.info("finished calculation {}_{}".format(optTuple[0], optTuple[1])) #ToDo!
-    print("Finished calculation {}_{}".format(optTuple[0], optTuple[1]))
-    
-    end = datetime.now().replace(microsecond=0)        
-    print('\n Time needed: ' + str(end - start))
-    #return z_delta_array, flux_array, count_array, z_delta_sum, backcalc, fp_travelangle_array, sl_travelangle_array
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Footprints of the paths of a tile, saved with the option footprints=true as
+footprints_i_j.npz next to the results of the tile. The paths and the
+release pixels that are used as start cells don't depend on the
+infrastructure layer, so with the footprints the back calculation can be done
+again for another infrastructure layer without calculating the paths
+(see main.backcalc).
+
+A footprint is stored compact and flat for all paths of the tile:
+
+- path_cells        Offsets of the cells of every path (n_paths + 1)
+- rows, cols        Position of the cells in the tile (smallest unsigned int)
+- z_delta, flux     Values of the cells (float32)
+- edge_child, edge_parent   Parents of the cells as edges, index of the
+                    cells in the tile, sorted by child
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import numpy as np
+
+
+class Footprints:
+    """Collects the footprints of the paths of a tile"""
+
+    def __init__(self):
+        self.n = 0
+        self.path_cells = [0]
+        self.rows, self.cols, self.z_delta, self.flux = [], [], [], []
+        self.edge_child, self.edge_parent = [], []
+
+    def add(self, rows, cols, z_delta, flux, edge_child, edge_parent):
+        """Add one path, the edges (child, parent) index the cells of the path"""
+        if len(rows) == 0:
+            return  # release pixel on no data
+        self.rows.append(np.asarray(rows))
+        self.cols.append(np.asarray(cols))
+        self.z_delta.append(np.asarray(z_delta, dtype=np.float32))
+        self.flux.append(np.asarray(flux, dtype=np.float32))
+        self.edge_child.append(np.asarray(edge_child, dtype=np.int64) + self.n)
+        self.edge_parent.append(np.asarray(edge_parent, dtype=np.int64) + self.n)
+        self.n += len(rows)
+        self.path_cells.append(self.n)
+
+    def add_cell_list(self, cell_list):
+        """Add the path of the cell engine (flow_class.Cell)"""
+        index = {id(cell): i for i, cell in enumerate(cell_list)}
+        edges = [(i, index[id(parent)]) for i, cell in enumerate(cell_list) for parent in cell.parent]
+        edge_child, edge_parent = zip(*edges) if edges else ((), ())
+        self.add([cell.rowindex for cell in cell_list], [cell.colindex for cell in cell_list],
+                 [cell.z_delta for cell in cell_list], [cell.flux for cell in cell_list], edge_child, edge_parent)
+
+    def add_path(self, path):
+        """Add the path of the array engine (flow_array.Path)"""
+        self.add(path.rows[:path.n], path.cols[:path.n], path.z_delta[:path.n], path.flux[:path.n],
+                 path.edge_child[:path.n_edges], path.edge_parent[:path.n_edges])
+
+    def save(self, file, shape):
+        """Save the footprints to file (.npz), shape is the shape of the tile"""
+        position = np.min_scalar_type(max(shape))
+
+        def concatenate(arrays, dtype):
+            return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+        edge_child = concatenate(self.edge_child, np.int64)
+        order = np.argsort(edge_child, kind='stable')
+        index = np.min_scalar_type(max(self.n, 1))
+        with open(file + ".tmp", "wb") as f:
+            np.savez(f, shape=np.array(shape), path_cells=np.array(self.path_cells, dtype=np.int64),
+                     rows=concatenate(self.rows, position), cols=concatenate(self.cols, position),
+                     z_delta=concatenate(self.z_delta, np.float32), flux=concatenate(self.flux, np.float32),
+                     edge_child=edge_child[order].astype(index),
+                     edge_parent=concatenate(self.edge_parent, np.int64)[order].astype(index))
+        os.replace(file + ".tmp", file)
+
+
+def load(file):
+    """Footprints of a tile saved by Footprints.save as dict of arrays"""
+    with np.load(file) as data:
+        return {name: data[name] for name in data.files}
+
+
+def upstream_max(n, edge_child, edge_parent, values):
+    """flow_numba.upstream_max, as plain python loop without Numba"""
+    import flow_numba  # Numba is slow to import, only for a back calculation
+    if flow_numba.numba_available:
+        return flow_numba.upstream_max(n, edge_child.astype(np.int64), edge_parent.astype(np.int64),
+                                       values.astype(np.float64))
+    upstream = [0.] * n
+    values = values.tolist()
+    for c, p in zip(edge_child[::-1].tolist(), edge_parent[::-1].tolist()):
+        down = max(upstream[c], values[c])
+        if down > upstream[p]:
+            upstream[p] = down
+    return np.array(upstream)
+
+
+def back_calculation(footprints, infra, backcalc):
+    """Back calculation of all paths of a tile from their footprints, same
+    as fc.back_calculation for every path: every cell on the way from a cell
+    that hits a infrastructure to the release pixel gets the max.
+    infrastructure value.
+
+    Input parameters:
+        footprints  Footprints of the tile, see load
+        infra       The infrastructure layer of the tile
+        backcalc    Array with back calculation, updated in place
+    """
+    rows = footprints['rows'].astype(np.int64)
+    cols = footprints['cols'].astype(np.int64)
+    if len(rows) == 0:
+        return
+    hit = np.maximum(infra[rows, cols], 0)
+    # Only the paths that hit a infrastructure
+    path_hit = np.maximum.reduceat(hit, footprints['path_cells'][:-1]) > 0
+    cell_hit = np.repeat(path_hit, np.diff(footprints['path_cells']))
+    edge_child, edge_parent = footprints['edge_child'], footprints['edge_parent']
+    edges = cell_hit[edge_child]
+    upstream = upstream_max(len(rows), edge_child[edges], edge_parent[edges], hit)
+    back = upstream > 0
+    np.maximum.at(backcalc, (rows[back], cols[back]), upstream[back].astype(backcalc.dtype))
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Job queue of the tiles of a run on a shared filesystem, so the tiles can be
+calculated by workers on any number of hosts that see the result directory
+(main.py --queue, --worker and --coordinate). Every tile is a job, a job is
+a file in temp/jobs/ that moves between the folders of its state:
+
+- pending/<job>.json            waiting, <job> is <rank>_<i>_<j>, rank 0 is
+                                the most expensive tile (most release pixels)
+- running/<job>@<worker>.json   claimed by a worker: renamed from pending/,
+                                the rename is atomic, so only one worker gets
+                                the job. The worker touches the file every
+                                HEARTBEAT seconds while it calculates.
+- done/<job>.json               the res_<layer>_i_j.npy of the tile are in
+                                temp/, with the metrics of the tile
+- failed/<job>.json             failed RETRIES + 1 times, with the error
+
+A worker calculates the tile into its own folder temp/jobs/stage_<worker>/
+and moves the results to temp/ before the job is done, so a tile that is
+calculated twice (a worker that was taken for dead) never leaves half
+written results. The coordinator is the only process that writes the
+manifest: it marks the done tiles, puts the jobs of workers without
+heartbeat for STALE seconds back to pending and merges the results when all
+tiles are done (see main.run_queue).
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import time
+import shutil
+import socket
+import logging
+import threading
+import flow_cache
+import flow_core as fc
+import flow_manifest
+import flow_pool
+
+JOBS = "jobs"
+STATES = ("pending", "running", "done", "failed")
+HEARTBEAT = 10  # s between two touches of the claimed job by its worker
+STALE = 120  # s without heartbeat until a job is put back to pending
+RETRIES = 2  # how often a failed job is put back to pending
+POLL = 2  # s between two looks at the queue
+
+
+def job_dir(temp_dir, state=""):
+    return os.path.join(temp_dir, JOBS, state, "")
+
+
+def worker_name():
+    """Name of the worker in this process, unique over all hosts"""
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+def write_json(path, data):
+    """Write to a temporary file and rename it, the file is never seen half
+    written (see flow_manifest.write_manifest)"""
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def jobs(temp_dir, state):
+    """Names <rank>_<i>_<j> of the jobs in state"""
+    return sorted(name[:-5].split("@")[0] for name in os.listdir(job_dir(temp_dir, state))
+                  if name.endswith(".json"))
+
+
+def job_tile(job):
+    rank, i, j = job.split("_")
+    return int(i), int(j)
+
+
+def opt_tuple(temp_dir, manifest, i, j, res_dir=None):
+    """optTuple of tile i, j of the run of manifest (see main.calculate_runs)"""
+    parameters = manifest['parameters']
+    options = {'engine': manifest['options']['engine'], 'neighbour_cache': manifest['options']['neighbour_cache']}
+    if manifest['options'].get('cache') is not None:
+        options['cache'] = manifest['options']['cache']
+    if manifest['options'].get('footprints', False) and parameters['infra']:
+        options['footprints'] = True
+    if res_dir is not None:
+        options['res_dir'] = res_dir
+    return (i, j, parameters['alpha'], parameters['exp'], parameters['cellsize'], parameters['nodata'],
+            parameters['flux_threshold'], parameters['max_z'], temp_dir, options)
+
+
+def create_jobs(temp_dir, manifest, tiles):
+    """Put the tiles (i, j) that have no job yet into the pending queue, the
+    most expensive first (see flow_pool.plan_work_units)"""
+    for state in STATES:
+        os.makedirs(job_dir(temp_dir, state), exist_ok=True)
+    queued = {job_tile(job) for state in STATES for job in jobs(temp_dir, state)}
+    tiles = [tile for tile in tiles if tile not in queued]
+    costs = [flow_pool.release_count(opt_tuple(temp_dir, manifest, i, j)) for i, j in tiles]
+    rank = len(queued)
+    for k in sorted(range(len(tiles)), key=lambda k: -costs[k]):
+        i, j = tiles[k]
+        write_json(job_dir(temp_dir, "pending") + "{:06d}_{}_{}.json".format(rank, i, j),
+                   {'i': i, 'j': j, 'attempts': 0})
+        rank += 1
+    return len(tiles)
+
+
+def claim(temp_dir, worker):
+    """Claim the first pending job for worker.
+
+    Output parameters:
+        job         Name of the job, None if no job is pending
+        claimed     Path of the claimed job in running/
+    """
+    pending = job_dir(temp_dir, "pending")
+    for name in sorted(name for name in os.listdir(pending) if name.endswith(".json")):
+        claimed = job_dir(temp_dir, "running") + "{}@{}.json".format(name[:-5], worker)
+        try:
+            os.rename(pending + name, claimed)
+        except FileNotFoundError:
+            continue  # claimed by another worker
+        if os.path.exists(job_dir(temp_dir, "done") + name):
+            os.remove(claimed)  # put back to pending while its worker finished it
+            continue
+        return name[:-5], claimed
+    return None, None
+
+
+def release(temp_dir, job, claimed, state, info):
+    """Move a claimed job to state: the job is written to its new state
+    first, then the claim is removed"""
+    write_json(job_dir(temp_dir, state) + job + ".json", info)
+    try:
+        os.remove(claimed)
+    except FileNotFoundError:
+        pass  # already put back by the coordinator
+
+
+def retry_state(info):
+    """State of a job that failed, with one attempt more"""
+    return "pending" if info['attempts'] <= RETRIES else "failed"
+
+
+class Heartbeat(threading.Thread):
+    """Touches the claimed job every interval seconds until stop, so the
+    coordinator sees that its worker is alive"""
+
+    def __init__(self, path, interval=HEARTBEAT):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(temp_dir, manifest, job, worker):
+    """Calculate the tile of a job in the stage folder of worker and move
+    the results to temp_dir, returns the metrics of the tile"""
+    i, j = job_tile(job)
+    stage = job_dir(temp_dir, "stage_" + worker)
+    shutil.rmtree(stage, ignore_errors=True)  # left by a job that failed
+    os.makedirs(stage)
+    infra_bool = manifest['parameters']['infra']
+    optTuple = fc.with_cache_key(opt_tuple(temp_dir, manifest, i, j, stage), infra_bool)
+    metrics = {}
+    cached = fc.cached_results(optTuple, infra_bool)
+    if cached is not None:
+        fc.save_results(optTuple, cached)
+        metrics['cached'] = True
+    elif infra_bool:
+        fc.calculation(optTuple, metrics)
+    else:
+        fc.calculation_effect(optTuple, metrics)
+    for name in os.listdir(stage):
+        os.replace(stage + name, temp_dir + name)
+    return metrics
+
+
+def work(temp_dir, worker=None, poll=POLL):
+    """Worker: claim and calculate jobs of the run in temp_dir until no job
+    is pending or running anymore. A job that raises is put back to pending
+    (at most RETRIES times, then to failed), a worker that dies leaves its
+    claim, which is put back by the coordinator.
+
+    Output parameters:
+        done        Number of jobs done by this worker
+    """
+    worker = worker or worker_name()
+    manifest = flow_manifest.read_manifest(temp_dir)
+    logging.info('Worker {} started'.format(worker))
+    done = 0
+    while True:
+        job, claimed = claim(temp_dir, worker)
+        if job is None:
+            if not jobs(temp_dir, "pending") and not jobs(temp_dir, "running"):
+                break
+            time.sleep(poll)  # jobs of other workers may come back
+            continue
+        info = dict(read_json(claimed), worker=worker)
+        logging.info('Worker {} calculates tile {}_{}'.format(worker, info['i'], info['j']))
+        heartbeat = Heartbeat(claimed)
+        heartbeat.start()
+        try:
+            info['metrics'] = run_job(temp_dir, manifest, job, worker)
+        except Exception as e:
+            logging.exception('Tile {}_{} failed'.format(info['i'], info['j']))
+            info.update(attempts=info['attempts'] + 1, error=repr(e))
+            release(temp_dir, job, claimed, retry_state(info), info)
+            continue
+        finally:
+            heartbeat.stop()
+        release(temp_dir, job, claimed, "done", info)
+        done += 1
+    logging.info('Worker {} finished, {} tiles calculated'.format(worker, done))
+    return done
+
+
+def requeue_stale(temp_dir, seen, timeout=STALE):
+    """Put the running jobs whose file was not touched for timeout seconds
+    (the worker was killed or its host is down) back to pending. seen is a
+    dict claim -> (mtime, time it was first seen), kept between the calls:
+    the mtime is only compared with itself, the clocks of the hosts don't
+    matter."""
+    running = job_dir(temp_dir, "running")
+    now = time.monotonic()
+    for name in os.listdir(running):
+        if not name.endswith(".json"):
+            continue
+        try:
+            mtime = os.stat(running + name).st_mtime
+        except FileNotFoundError:
+            continue
+        if seen.get(name, (None,))[0] != mtime:
+            seen[name] = (mtime, now)
+            continue
+        if now - seen[name][1] < timeout:
+            continue
+        try:
+            info = read_json(running + name)
+        except (FileNotFoundError, ValueError):
+            continue
+        job, worker = name[:-5].split("@")
+        logging.warning('Worker {} of tile {}_{} has no heartbeat, job put back'.format(worker, info['i'],
+                                                                                        info['j']))
+        info.update(attempts=info['attempts'] + 1, error="worker {} has no heartbeat".format(worker))
+        release(temp_dir, job, running + name, retry_state(info), info)
+        del seen[name]
+
+
+def requeue_failed(temp_dir):
+    """Put the failed jobs back to pending with new attempts"""
+    for job in jobs(temp_dir, "failed"):
+        info = read_json(job_dir(temp_dir, "failed") + job + ".json")
+        write_json(job_dir(temp_dir, "pending") + job + ".json", {'i': info['i'], 'j': info['j'], 'attempts': 0})
+        os.remove(job_dir(temp_dir, "failed") + job + ".json")
+
+
+def coordinate(temp_dir, manifest, tile_done=None, progress=None, start_worker=None, workers=0,
+               timeout=STALE, poll=POLL):
+    """Wait until every job is done or failed, the done tiles are set to done
+    in the manifest.
+
+    Input parameters:
+        temp_dir    temp folder of the run, with the jobs
+        manifest    Run manifest, see flow_manifest
+        tile_done   Called with i, j and the metrics of every done tile
+        progress    Called with the number of done tiles, of all tiles and
+                    the estimated time left in s, e.g. a
+                    flow_progress.ProgressLine
+        start_worker    Starts a local worker process (subprocess.Popen),
+                    called workers times, a local worker that dies is
+                    started again while there are jobs
+        timeout     s without heartbeat until a job is put back to pending
+
+    Output parameters:
+        failed      List of the tiles (i, j) that failed
+    """
+    processes = [start_worker() for k in range(workers)]
+    recorded, seen = set(), {}
+    start, done_before = time.monotonic(), None
+    while True:
+        pending, running = jobs(temp_dir, "pending"), jobs(temp_dir, "running")
+        failed, done = jobs(temp_dir, "failed"), jobs(temp_dir, "done")
+        changed = False
+        for job in done:
+            if job in recorded:
+                continue
+            recorded.add(job)
+            i, j = job_tile(job)
+            key = flow_manifest.tile_key(i, j)
+            if manifest['tiles'].get(key) != "done":
+                manifest['tiles'][key] = "done"
+                changed = True
+                if tile_done is not None:
+                    tile_done(i, j, read_json(job_dir(temp_dir, "done") + job + ".json").get('metrics', {}))
+        if changed:
+            flow_manifest.write_manifest(temp_dir, manifest)
+        if progress is not None:
+            total = len(pending) + len(running) + len(failed) + len(done)
+            done_before = len(done) if done_before is None else done_before
+            new = len(done) - done_before
+            progress(len(done), total, (time.monotonic() - start) * (total - len(done)) / new if new else None)
+        if not pending and not running:
+            break
+        requeue_stale(temp_dir, seen, timeout)
+        for k, process in enumerate(processes):
+            if process.poll() not in (None, 0):
+                logging.warning('Local worker exited with {}, started again'.format(process.returncode))
+                processes[k] = start_worker()
+        time.sleep(poll)
+
+    for process in processes:
+        process.wait()
+    failed = [job_tile(job) for job in jobs(temp_dir, "failed") if job not in recorded]
+    for i, j in failed:
+        manifest['tiles'][flow_manifest.tile_key(i, j)] = "failed"
+    flow_manifest.write_manifest(temp_dir, manifest)
+    if manifest['options'].get('cache') is not None:
+        # the workers only store their tiles, the cache is limited once for the run
+        flow_cache.evict(manifest['options']['cache']['dir'], manifest['options']['cache']['max_size'])
+    for name in os.listdir(job_dir(temp_dir)):
+        if name.startswith("stage_"):
+            shutil.rmtree(job_dir(temp_dir, name), ignore_errors=True)
+    return failed
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The run manifest (temp/manifest.json) records everything that is needed to
+resume a run: the model parameters and options, the fingerprints of the input
+rasters, the tiling and the status of every tile ("pending", "done" or
+"failed"). The status of a tile is set to "done" when its res_<layer>_i_j.npy
+are saved, so a resumed run only calculates the missing or failed tiles.
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import hashlib
+from datetime import datetime
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+
+def fingerprint(path, chunk=1 << 20):
+    """Path, size, modification time and sha1 of the content of a file"""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            sha1.update(block)
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+
+
+def changed_inputs(manifest):
+    """Names of the input rasters that are missing or whose content changed
+    since the manifest was written (the modification time is ignored, a
+    copied file with the same content is still the same input)"""
+    changed = []
+    for name, recorded in manifest['inputs'].items():
+        try:
+            current = fingerprint(recorded['path'])
+        except FileNotFoundError:
+            changed.append(name)
+            continue
+        if current['size'] != recorded['size'] or current['sha1'] != recorded['sha1']:
+            changed.append(name)
+    return changed
+
+
+def tile_key(i, j):
+    return "{}_{}".format(i, j)
+
+
+def new_manifest(parameters, options, inputs, tiling):
+    """Manifest of a new run, all tiles are pending.
+
+    Input parameters:
+        parameters  Model parameters (alpha, exp, flux_threshold, max_z,
+                    cellsize, nodata, infra)
+        options     Calculation and output options of main.main
+        inputs      Dict layer name ("dem", "init", "infra") -> fingerprint
+                    of the input raster
+        tiling      Dict with tileCOLS, tileROWS, U and nTiles
+
+    Output parameters:
+        manifest    Dict, see write_manifest
+    """
+    tiling = dict(tiling, tiled=False)
+    nTiles = tiling['nTiles']
+    return {'version': VERSION,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'parameters': parameters,
+            'options': options,
+            'inputs': inputs,
+            'tiling': tiling,
+            'tiles': {tile_key(i, j): "pending" for i in range(nTiles[0] + 1) for j in range(nTiles[1] + 1)}}
+
+
+def read_manifest(temp_dir):
+    with open(os.path.join(temp_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != VERSION:
+        raise ValueError("Unknown manifest version {}".format(manifest.get('version')))
+    return manifest
+
+
+def write_manifest(temp_dir, manifest):
+    """Write the manifest to a temporary file and rename it, a run that is
+    killed while writing leaves the last complete manifest"""
+    path = os.path.join(temp_dir, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def set_tile(temp_dir, manifest, i, j, status):
+    manifest['tiles'][tile_key(i, j)] = status
+    write_manifest(temp_dir, manifest)
+
+
+def pending_tiles(temp_dir, manifest, layers):
+    """Tiles (i, j) that are not done or whose res_<layer>_i_j.npy are missing"""
+    tiles = []
+    for key, status in manifest['tiles'].items():
+        i, j = (int(k) for k in key.split("_"))
+        if status != "done" or not all(os.path.exists(os.path.join(temp_dir, "res_{}_{}_{}.npy".format(layer, i, j)))
+                                       for layer in layers):
+            tiles.append((i, j))
+    return tiles
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Performance metrics of a run. Every worker measures the tiles it calculates
+(TileMetrics, see flow_core), the metrics are sent back with the results
+(flow_pool) and collected with the time of the phases of the run (tiling,
+compute, merge, output) in a JSON report, report_<time>.json next to the
+log_<time>.txt of the run (RunReport).
+
+The metrics of a tile are a dict:
+
+- wall, cpu         Wall and CPU time of the calculation in s
+- start_cells       Number of calculated paths (release pixels)
+- path_cells        Total number of cells of the paths
+- max_path_cells    Cells of the largest path
+- cells_per_second  path_cells / wall
+- backcalc          Time of the back calculation in s (with infrastructure,
+                    None for the numba engine, it is part of the path there)
+- rss, peak_rss     Resident set size of the worker at the end of the tile
+                    and its peak so far in bytes (psutil), None without psutil
+- units             Number of work units (batches) of the tile
+- cached            True if the results were taken from the result cache
+- failed            True if the tile failed every retry
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import contextlib
+from datetime import datetime
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows, psutil has peak_wset there
+
+
+def memory():
+    """Current and peak resident set size of this process in bytes, (None,
+    None) without psutil"""
+    if psutil is None:
+        return None, None
+    info = psutil.Process().memory_info()
+    peak = getattr(info, 'peak_wset', None)
+    if peak is None and resource is not None:
+        # ru_maxrss is in kB on Linux, in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return info.rss, max(peak or 0, info.rss)
+
+
+class TileMetrics:
+    """Measures the calculation of a tile (or a batch of its release pixels)
+    from its creation to finish"""
+
+    def __init__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.start_cells = 0
+        self.path_cells = 0
+        self.max_path_cells = 0
+        self.backcalc = 0.
+
+    def path(self, cells):
+        """A path with cells cells was calculated"""
+        self.start_cells += 1
+        self.path_cells += cells
+        if cells > self.max_path_cells:
+            self.max_path_cells = cells
+
+    def finish(self, backcalc=True):
+        """The metrics of the tile as dict (see the module), backcalc False
+        if the back calculation was not measured"""
+        wall = time.perf_counter() - self.wall
+        rss, peak_rss = memory()
+        return {'wall': wall, 'cpu': time.process_time() - self.cpu, 'start_cells': self.start_cells,
+                'path_cells': self.path_cells, 'max_path_cells': self.max_path_cells,
+                'cells_per_second': self.path_cells / wall if wall > 0 else None,
+                'backcalc': self.backcalc if backcalc else None, 'rss': rss, 'peak_rss': peak_rss, 'units': 1}
+
+
+def combine(metrics):
+    """Metrics of a tile from the metrics of its work units"""
+    if len(metrics) == 1:
+        return metrics[0]
+
+    def values(key):
+        return [m[key] for m in metrics if m.get(key) is not None]
+
+    combined = {key: sum(values(key)) for key in ('wall', 'cpu', 'start_cells', 'path_cells', 'units')}
+    combined['max_path_cells'] = max(values('max_path_cells'), default=0)
+    combined['cells_per_second'] = combined['path_cells'] / combined['wall'] if combined['wall'] > 0 else None
+    combined['backcalc'] = sum(values('backcalc')) if values('backcalc') else None
+    for key in ('rss', 'peak_rss'):
+        combined[key] = max(values(key), default=None)
+    return combined
+
+
+class RunReport:
+    """JSON report of a run: the time of its phases and the metrics of every
+    tile, written to file (report_<time>.json next to log_<time>.txt)"""
+
+    def __init__(self, file, command, parameters=None):
+        self.file = file
+        self.start = time.perf_counter()
+        self.report = {'command': command, 'started': datetime.now().isoformat(timespec='seconds'),
+                       'parameters': parameters, 'phases': {}, 'tiles': {}}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time of the with block to the phase name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        phases = self.report['phases']
+        phases[name] = phases.get(name, 0) + seconds
+
+    def tile(self, key, metrics):
+        self.report['tiles'][key] = metrics
+
+    def summary(self):
+        """Totals of the calculated tiles and the 5 slowest tiles"""
+        all_tiles = self.report['tiles'].values()
+        tiles = {key: m for key, m in self.report['tiles'].items() if 'wall' in m}
+        compute = self.report['phases'].get('compute')
+        path_cells = sum(m['path_cells'] for m in tiles.values())
+        return {'tiles': len(all_tiles), 'cached_tiles': sum(m.get('cached', False) for m in all_tiles),
+                'failed_tiles': sum(m.get('failed', False) for m in all_tiles),
+                'start_cells': sum(m['start_cells'] for m in tiles.values()),
+                'path_cells': path_cells,
+                'max_path_cells': max((m['max_path_cells'] for m in tiles.values()), default=0),
+                'cpu': sum(m['cpu'] for m in tiles.values()),
+                'cells_per_second': path_cells / compute if compute else None,
+                'peak_rss': max((m['peak_rss'] for m in tiles.values() if m.get('peak_rss') is not None),
+                                default=None),
+                'slowest_tiles': sorted(tiles, key=lambda key: -tiles[key]['wall'])[:5]}
+
+    def write(self):
+        """Write the report, again after every call (atomic, see
+        flow_manifest.write_manifest)"""
+        self.report['finished'] = datetime.now().isoformat(timespec='seconds')
+        self.report['total'] = time.perf_counter() - self.start
+        self.report['summary'] = self.summary()
+        with open(self.file + ".tmp", "w") as f:
+            json.dump(self.report, f, indent=1)
+        os.replace(self.file + ".tmp", self.file)
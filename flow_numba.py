@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This is the compiled path engine, the spreading of one release pixel
+(same as flow_array.calc_path), the merging of cells that are reached more
+than once, the back calculation and the update of the result arrays of the
+tile are compiled with Numba.
+
+Numba is optional, if it isn't installed numba_available is False and
+flow_core uses the array engine instead.
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import numpy as np
+from flow_array import NEIGHBOUR_ROW, NEIGHBOUR_COL, NEIGHBOUR_DS, PERSISTENCE
+
+try:
+    from numba import njit
+    numba_available = True
+except ImportError:
+    numba_available = False
+
+    def njit(*args, **kwargs):
+        """Without Numba the functions stay plain python (and are not used)"""
+        return lambda function: function
+
+NEIGHBOUR_ROW_ARRAY = np.array(NEIGHBOUR_ROW, dtype=np.int64)
+NEIGHBOUR_COL_ARRAY = np.array(NEIGHBOUR_COL, dtype=np.int64)
+NEIGHBOUR_DS_ARRAY = np.array(NEIGHBOUR_DS)
+PERSISTENCE_ARRAY = np.array(PERSISTENCE)
+
+
+@njit(cache=True)
+def _sum(values, n):
+    """Sum of the first n values in the order of np.sum (see flow_array.np_sum)"""
+    if n < 8:
+        total = 0.
+        for i in range(n):
+            total += values[i]
+        return total
+    total = (((values[0] + values[1]) + (values[2] + values[3])) +
+             ((values[4] + values[5]) + (values[6] + values[7])))
+    for i in range(8, n):
+        total += values[i]
+    return total
+
+
+@njit(cache=True)
+def _sum_with_center(values):
+    """np.sum of the 3x3 neighbourhood of the 8 neighbour values with 0 in the center"""
+    return (((values[0] + values[1]) + (values[2] + values[3])) +
+            ((0. + values[4]) + (values[5] + values[6]))) + values[7]
+
+
+@njit(cache=True)
+def _before(k, c, z_delta_neighbour, dist):
+    """True if neighbour k comes before c, ordered by z_delta, flux, row, col"""
+    if z_delta_neighbour[k] != z_delta_neighbour[c]:
+        return z_delta_neighbour[k] < z_delta_neighbour[c]
+    if dist[k] != dist[c]:
+        return dist[k] < dist[c]
+    return k < c  # neighbours are ordered by row and col
+
+
+@njit(cache=True)
+def _grow(array, n):
+    new = np.zeros((2 * n,) + array.shape[1:], dtype=array.dtype)
+    new[:n] = array[:n]
+    return new
+
+
+@njit(cache=True)
+def _path(dem, row_idx, col_idx, cellsize, valid, z_gamma_dem, tan_beta_dem, alpha, exp, threshold, max_z_delta, cell_at,
+          z_delta_array, flux_array, count_array, z_delta_sum, fp_travelangle_array, sl_travelangle_array,
+          infra, backcalc, dem_float32):
+    capacity = 64
+    rows = np.zeros(capacity, dtype=np.int64)
+    cols = np.zeros(capacity, dtype=np.int64)
+    flux = np.zeros(capacity)
+    z_delta = np.zeros(capacity)
+    min_distance = np.zeros(capacity)
+    max_gamma = np.zeros(capacity)
+    sl_gamma = np.zeros(capacity)
+    start_persistence = np.zeros(capacity, dtype=np.bool_)
+    persistence = np.zeros((capacity, 8), dtype=dem.dtype)
+    no_flow = np.zeros((capacity, 8), dtype=np.bool_)
+    edge_child = np.zeros(capacity, dtype=np.int64)
+    edge_parent = np.zeros(capacity, dtype=np.int64)
+    n = 0
+    n_edges = 0
+
+    if not valid[row_idx, col_idx]:
+        return rows[:0], cols[:0], z_delta[:0], flux[:0], edge_child[:0], edge_parent[:0]
+
+    tan_alpha = np.tan(np.deg2rad(alpha))
+    z_alpha = NEIGHBOUR_DS_ARRAY * cellsize * tan_alpha
+    rad2deg32 = np.float32(180.) / np.float32(np.pi)
+
+    rows[0] = row_idx
+    cols[0] = col_idx
+    flux[0] = 1.
+    start_persistence[0] = True
+    n = 1
+    start_altitude = dem[row_idx, col_idx]
+    cell_at[row_idx, col_idx] = 0
+
+    z_delta_neighbour = np.zeros(8)
+    pers = np.zeros(8)
+    tan_beta = np.zeros(8)
+    tan_beta_exp = np.zeros(8)
+    r_t = np.zeros(8)
+    weight = np.zeros(8)
+    dist = np.zeros(8)
+    below = np.zeros(9)
+    children = np.zeros(8, dtype=np.int64)
+
+    idx = 0
+    while idx < n:
+        row = rows[idx]
+        col = cols[idx]
+        altitude = dem[row, col]
+        z_gamma = z_gamma_dem[row, col]
+
+        if idx > 0:
+            dh = start_altitude - altitude
+            max_gamma[idx] = np.rad2deg(np.arctan(dh / min_distance[idx]))
+            ds = math.sqrt((row_idx - row) ** 2 + (col_idx - col) ** 2) * cellsize
+            # Same dtype as the DEM, see Cell.calc_sl_travelangle
+            if dem_float32:
+                sl_gamma[idx] = np.arctan(np.float32(dh) / np.float32(ds)) * rad2deg32
+            else:
+                sl_gamma[idx] = np.rad2deg(np.arctan(dh / ds))
+
+        for k in range(8):
+            if start_persistence[idx]:
+                pers[k] = 1.
+            elif no_flow[idx, k]:
+                pers[k] = 0.
+            else:
+                pers[k] = persistence[idx, k]
+
+        for k in range(8):
+            z_delta_k = z_delta[idx] + z_gamma[k] - z_alpha[k]
+            if z_delta_k < 0:
+                z_delta_k = 0.
+            if z_delta_k > max_z_delta:
+                z_delta_k = max_z_delta
+            z_delta_neighbour[k] = z_delta_k
+            tan_beta[k] = 0.
+            if z_delta_k > 0 and pers[k] > 0:
+                tan_beta[k] = tan_beta_dem[row, col, k]
+
+        for k in range(8):
+            dist[k] = 0.
+        if abs(_sum_with_center(tan_beta)) > 0:
+            for k in range(8):
+                tan_beta_exp[k] = tan_beta[k] ** exp
+            sum_tan_beta_exp = _sum_with_center(tan_beta_exp)
+            for k in range(8):
+                r_t[k] = tan_beta_exp[k] / sum_tan_beta_exp
+            if _sum_with_center(r_t) > 0:
+                for k in range(8):
+                    weight[k] = pers[k] * r_t[k]
+                sum_weight = _sum_with_center(weight)
+                for k in range(8):
+                    dist[k] = weight[k] / sum_weight * flux[idx]
+
+        # Flux below the threshold is spread to the other neighbours, see Cell.calc_distribution
+        count = 0
+        n_below = 0
+        for k in range(9):  # 3x3 neighbourhood with the center
+            if k < 4:
+                d = dist[k]
+            elif k == 4:
+                d = 0.
+            else:
+                d = dist[k - 1]
+            if 0 < d < threshold:
+                count += 1
+            if d < threshold:
+                below[n_below] = d
+                n_below += 1
+        mass_to_distribute = _sum(below, n_below)
+        if mass_to_distribute > 0 and count > 0:
+            for k in range(8):
+                if dist[k] > threshold:
+                    dist[k] += mass_to_distribute / count
+            for k in range(8):
+                if dist[k] < threshold:
+                    dist[k] = 0.
+        if count > 0 and _sum_with_center(dist) < flux[idx]:
+            rest = (flux[idx] - _sum_with_center(dist)) / count
+            for k in range(8):
+                if dist[k] > threshold:
+                    dist[k] += rest
+
+        # Children sorted by z_delta, flux, row, col (insertion sort)
+        n_children = 0
+        for k in range(8):
+            if dist[k] > threshold:
+                i = n_children
+                while i > 0:
+                    c = children[i - 1]
+                    if not _before(k, c, z_delta_neighbour, dist):
+                        break
+                    children[i] = c
+                    i -= 1
+                children[i] = k
+                n_children += 1
+
+        for c in range(n_children):
+            k = children[c]
+            row_k = row + NEIGHBOUR_ROW_ARRAY[k]
+            col_k = col + NEIGHBOUR_COL_ARRAY[k]
+            i = cell_at[row_k, col_k]
+            if i < idx:  # Cell is not in the path or is already calculated
+                if not valid[row_k, col_k]:
+                    continue
+                if n == len(rows):
+                    rows = _grow(rows, n)
+                    cols = _grow(cols, n)
+                    flux = _grow(flux, n)
+                    z_delta = _grow(z_delta, n)
+                    min_distance = _grow(min_distance, n)
+                    max_gamma = _grow(max_gamma, n)
+                    sl_gamma = _grow(sl_gamma, n)
+                    start_persistence = _grow(start_persistence, n)
+                    persistence = _grow(persistence, n)
+                    no_flow = _grow(no_flow, n)
+                i = n
+                rows[i] = row_k
+                cols[i] = col_k
+                flux[i] = dist[k]
+                z_delta[i] = z_delta_neighbour[k]
+                min_distance[i] = np.inf
+                start_persistence[i] = idx == 0
+                cell_at[row_k, col_k] = i
+                n += 1
+            else:
+                flux[i] += dist[k]
+                if z_delta_neighbour[k] > z_delta[i]:
+                    z_delta[i] = z_delta_neighbour[k]
+
+            if n_edges == len(edge_child):
+                edge_child = _grow(edge_child, n_edges)
+                edge_parent = _grow(edge_parent, n_edges)
+            edge_child[n_edges] = i
+            edge_parent[n_edges] = idx
+            n_edges += 1
+
+            # The parent lies in the opposite direction of the child
+            parent_k = 7 - k
+            min_distance[i] = min(min_distance[i], NEIGHBOUR_DS_ARRAY[k] * cellsize + min_distance[idx])
+            if not start_persistence[i]:
+                no_flow[i, parent_k] = True
+                for j in range(8):
+                    if PERSISTENCE_ARRAY[parent_k, j] > 0:
+                        persistence[i, j] += PERSISTENCE_ARRAY[parent_k, j] * z_delta[idx]
+        idx += 1
+
+    for i in range(n):
+        cell_at[rows[i], cols[i]] = -1
+        z_delta_array[rows[i], cols[i]] = max(z_delta_array[rows[i], cols[i]], z_delta[i])
+        flux_array[rows[i], cols[i]] = max(flux_array[rows[i], cols[i]], flux[i])
+        count_array[rows[i], cols[i]] += 1
+        z_delta_sum[rows[i], cols[i]] += z_delta[i]
+        fp_travelangle_array[rows[i], cols[i]] = max(fp_travelangle_array[rows[i], cols[i]], max_gamma[i])
+        sl_travelangle_array[rows[i], cols[i]] = max(sl_travelangle_array[rows[i], cols[i]], sl_gamma[i])
+
+    if infra.size > 0:
+        # Reverse sweep over the edges, children are always added after their
+        # parents, every cell passes the max. infrastructure value below it on
+        order = np.argsort(edge_child[:n_edges], kind='mergesort')
+        upstream = np.zeros(n)
+        for k in range(n_edges - 1, -1, -1):
+            c = edge_child[order[k]]
+            p = edge_parent[order[k]]
+            down = max(upstream[c], max(infra[rows[c], cols[c]], 0.))
+            if down > upstream[p]:
+                upstream[p] = down
+        for i in range(n):
+            if upstream[i] > 0:
+                backcalc[rows[i], cols[i]] = max(backcalc[rows[i], cols[i]], int(upstream[i]))
+
+    return rows[:n], cols[:n], z_delta[:n], flux[:n], edge_child[:n_edges], edge_parent[:n_edges]
+
+
+@njit(cache=True)
+def upstream_max(n, edge_child, edge_parent, values):
+    """For every cell of the paths the max. of values over all cells below
+    it, the edges are sorted by child and every child comes after its parents
+    (see flow_array.Path.upstream_max)"""
+    upstream = np.zeros(n)
+    for k in range(len(edge_child) - 1, -1, -1):
+        c = edge_child[k]
+        p = edge_parent[k]
+        down = max(upstream[c], values[c])
+        if down > upstream[p]:
+            upstream[p] = down
+    return upstream
+
+
+def calc_path(dem, row_idx, col_idx, cellsize, alpha, exp, flux_threshold, max_z_delta, neighbourhood, cell_at,
+              results, infra=None, backcalc=None):
+    """Spreading of one release pixel over the DEM, the cells of the path are
+    added to the result arrays of the tile right away.
+
+    Input parameters:
+        dem             The digital elevation model
+        row_idx         Row index of the release pixel
+        col_idx         Column index of the release pixel
+        cellsize        Cellsize of the DEM
+        alpha, exp, flux_threshold, max_z_delta     Model parameters
+        neighbourhood   flow_array.Neighbourhood of the DEM
+        cell_at         Array like DEM filled with -1 (see flow_array.calc_path)
+        results         z_delta_array, flux_array, count_array, z_delta_sum,
+                        fp_travelangle_array, sl_travelangle_array of the tile
+        infra           The infrastructure layer, None without back calculation
+        backcalc        Array with back calculation, None without infrastructure
+
+    Output parameters:
+        rows, cols, z_delta, flux       Position, z_delta and flux of all
+                                        cells of the path
+        edge_child, edge_parent         Parents of the cells as edges
+    """
+    if infra is None:
+        infra = np.zeros((0, 0), dtype=np.float32)
+        backcalc = np.zeros((0, 0), dtype=np.int32)
+    return _path(dem, int(row_idx), int(col_idx), float(cellsize), neighbourhood.valid, neighbourhood.z_gamma,
+                 neighbourhood.tan_beta, float(alpha), float(int(exp)), float(flux_threshold), float(max_z_delta),
+                 cell_at, *results, infra, backcalc, dem.dtype == np.float32)
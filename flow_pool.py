@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this module the calculation of the tiles is distributed over the process
+pool. The tiles are split into work units of release pixels:
+
+- Without infrastructure the paths don't influence each other, tiles with
+many release pixels are split into batches of release pixels, the results of
+the batches are reduced per tile (SPAM.LAYER_REDUCE) and saved as res_<layer>_i_j.npy
+- With infrastructure the release pixels that are hit by a path are erased,
+so the release pixels of a tile depend on each other and every tile is one
+work unit
+
+The work units are handed out in order, the most expensive first, so no
+worker waits for one big tile at the end of the run. A work unit that fails,
+or whose worker is killed (e.g. out of memory), doesn't stop the run: it is
+retried on its own in a fresh process and only the tiles that still fail are
+returned. The workers report their progress through a queue (see
+flow_progress).
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import functools
+import logging
+import multiprocessing as mp
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+import flow_core as fc
+import flow_metrics
+import flow_progress
+import split_and_merge as SPAM
+
+
+def default_processes():
+    """Number of worker processes, one core is left for the main process"""
+    return max(mp.cpu_count() - 1, 1)
+
+
+def release_count(optTuple):
+    """Number of release pixels of a tile, the estimated cost of the tile"""
+    release = fc.load_tile(optTuple, fc.release_layer(optTuple))
+    return int(np.count_nonzero(release > 0))
+
+
+def plan_work_units(optList, infra_bool, processes, units_per_process=4, min_batch=256):
+    """Split the tiles into work units, most expensive first.
+
+    Input parameters:
+        optList             One optTuple per tile (see fc.calculation)
+        infra_bool          True if the calculation is with infrastructure
+        processes           Number of worker processes
+        units_per_process   Batches per process the release pixels are
+                            split into, more units balance better but every
+                            unit loads its tile again
+        min_batch           Min. number of release pixels of a batch
+
+    Output parameters:
+        units       List of (optTuple, infra_bool, start, stop), the release
+                    pixels start:stop of the tile (sorted by fc.get_start_idx),
+                    stop is None for a whole tile
+        sizes       Number of release pixels of every unit
+    """
+    counts = {}  # the tiles of a sweep are shared by all parameter sets
+    for optTuple in optList:
+        tile = (optTuple[8], fc.release_layer(optTuple), optTuple[0], optTuple[1])
+        if tile not in counts:
+            counts[tile] = release_count(optTuple)
+    costs = [counts[(optTuple[8], fc.release_layer(optTuple), optTuple[0], optTuple[1])] for optTuple in optList]
+    batch = max(min_batch, math.ceil(sum(costs) / (processes * units_per_process)))
+    units, sizes = [], []
+    for k in sorted(range(len(optList)), key=lambda k: -costs[k]):
+        if infra_bool or costs[k] <= batch:
+            units.append((optList[k], infra_bool, 0, None))
+            sizes.append(costs[k])
+        else:
+            # Batches of about the same size instead of a small remainder,
+            # every batch has at least batch release pixels
+            n_batches = max(1, costs[k] // batch)
+            bounds = np.linspace(0, costs[k], n_batches + 1).round().astype(int)
+            units.extend((optList[k], infra_bool, int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]))
+            sizes.extend(int(stop - start) for start, stop in zip(bounds[:-1], bounds[1:]))
+    return units, sizes
+
+
+def run_work_unit(unit):
+    """Calculate one work unit in a worker process. Whole tiles are saved by
+    fc.calculation/fc.calculation_effect, for a batch only the cells that
+    were hit are returned to be reduced with the other batches of the tile.
+    If the options have an entry "in_memory" nothing is saved, the results
+    of every unit are returned.
+
+    Output parameters:
+        optTuple    optTuple of the tile
+        hits        None for a saved tile, a dict layer -> array for a
+                    whole tile with infrastructure, otherwise (index, 
+                    values): the flat index of the hit cells of the tile and
+                    their values per layer of fc.EFFECT_LAYERS
+        metrics     Metrics of the unit, see flow_metrics
+    """
+    optTuple, infra_bool, start, stop = unit
+    options = optTuple[9] if len(optTuple) > 9 else {}
+    in_memory = options.get('in_memory', False)
+    metrics = {}
+    if infra_bool:
+        if in_memory:
+            return optTuple, fc.calc_infra_tile(optTuple, metrics), metrics
+        fc.calculation(optTuple, metrics)
+        return optTuple, None, metrics
+    if stop is None and not in_memory:
+        fc.calculation_effect(optTuple, metrics)
+        return optTuple, None, metrics
+    results = fc.calc_effect_tile(optTuple, start, stop, metrics)
+    index = np.flatnonzero(results[fc.EFFECT_LAYERS.index('count')])
+    return optTuple, (index, [array.ravel()[index] for array in results]), metrics
+
+
+def tile_key(optTuple):
+    """Tile i, j and its result folder, the same tile of different parameter
+    sets is a different tile"""
+    return fc.result_dir(optTuple), optTuple[0], optTuple[1]
+
+
+def empty_effect_results(optTuple):
+    """Result arrays of a tile without any path, see fc.calc_effect_tile"""
+    shape = np.shape(fc.load_tile(optTuple, "dem"))
+    results = {name: np.zeros(shape, dtype=np.float32) for name in fc.EFFECT_LAYERS}
+    results['count'] = np.zeros(shape, dtype=np.int32)
+    results['sl'] += 90
+    return results
+
+
+def run_isolated(call, unit, initargs=()):
+    """Run one work unit in its own worker process, a crash of the process
+    only fails this unit"""
+    with ProcessPoolExecutor(1, initializer=flow_progress.init_worker, initargs=initargs or (None,)) as executor:
+        return executor.submit(call, unit).result()
+
+
+def run_units(executor, call, units, collect):
+    """Submit the work units to the executor and call collect(optTuple, hits,
+    metrics) in the main process for every finished unit.
+
+    Output parameters:
+        failed      List of the work units that raised an exception
+    """
+    failed = []
+    futures = {executor.submit(call, unit): unit for unit in units}
+    for future in as_completed(futures):
+        unit = futures[future]
+        try:
+            optTuple, hits, metrics = future.result()
+        except Exception as e:
+            logging.error("Work unit of tile {}_{} (release pixels {}:{}) failed: {!r}".format(
+                unit[0][0], unit[0][1], unit[2], unit[3], e))
+            failed.append(unit)
+            continue
+        collect(optTuple, hits, metrics)
+    return failed
+
+
+def run_with_retries(units, call, collect, processes, retries, progress_queue=None):
+    """Run the work units with call in a process pool, failed units are
+    retried on their own (run_isolated) up to retries times. The workers
+    send their progress to progress_queue (see flow_progress).
+
+    Output parameters:
+        failed      List of the work units that failed every retry
+    """
+    initargs = (progress_queue,)
+    with ProcessPoolExecutor(processes, initializer=flow_progress.init_worker, initargs=initargs) as executor:
+        failed = run_units(executor, call, units, collect)
+    for attempt in range(retries):
+        if not failed:
+            break
+        logging.warning("Retrying {} failed work units on their own, attempt {}".format(len(failed), attempt + 1))
+        with ThreadPoolExecutor(processes) as executor:
+            failed = run_units(executor, functools.partial(run_isolated, call, initargs=initargs), failed, collect)
+    return failed
+
+
+def run_calculation(optList, infra_bool, processes=None, tile_done=None, retries=2, tile_results=None,
+                    progress=None):
+    """Calculate all tiles of optList with a process pool, the results are
+    saved to the temp folder as res_<layer>_i_j.npy (see fc.save_results).
+    Tiles that are in the result cache (see fc.cached_results) are not
+    calculated again.
+
+    Input parameters:
+        optList     One optTuple per tile (see fc.calculation)
+        infra_bool  True if the calculation is with infrastructure
+        processes   Number of worker processes, default cpu_count() - 1
+        tile_done   Called with the optTuple and the metrics (see
+                    flow_metrics) of a tile when its results are saved
+        retries     How often a failed work unit is retried on its own
+        tile_results    Called with the optTuple and the results (dict 
+                    layer -> array) of a tile instead of saving them, for
+                    the options entry "in_memory" (see run_work_unit)
+        progress    Called with the number of release pixels done, of all
+                    release pixels and the estimated time left in s, at
+                    most every flow_progress.INTERVAL seconds, e.g. a
+                    flow_progress.ProgressLine
+
+    Output parameters:
+        failed      List of the optTuples of the tiles that failed every retry
+    """
+    processes = processes or default_processes()
+    save_results = tile_results or fc.save_results
+    # The cache keys of all tiles at once, hashing releases the GIL
+    with ThreadPoolExecutor(processes) as executor:
+        optList = list(executor.map(functools.partial(fc.with_cache_key, infra_bool=infra_bool), optList))
+    todo = []
+    for optTuple in optList:
+        cached = fc.cached_results(optTuple, infra_bool)
+        if cached is None:
+            todo.append(optTuple)
+            continue
+        save_results(optTuple, cached)
+        if tile_done is not None:
+            tile_done(optTuple, {'cached': True})
+    if len(todo) < len(optList):
+        logging.info('{} tiles from the result cache'.format(len(optList) - len(todo)))
+    units, sizes = plan_work_units(todo, infra_bool, processes)
+    logging.info('{} tiles split into {} work units'.format(len(todo), len(units)))
+    remaining = Counter(tile_key(unit[0]) for unit in units)
+    partial = {}
+    unit_metrics = {tile: [] for tile in remaining}
+
+    def collect(optTuple, hits, metrics):
+        tile = tile_key(optTuple)
+        unit_metrics[tile].append(metrics)
+        if isinstance(hits, dict):
+            partial[tile] = hits
+        elif hits is not None:
+            if tile not in partial:
+                partial[tile] = empty_effect_results(optTuple)
+            index, values = hits
+            for name, value in zip(fc.EFFECT_LAYERS, values):
+                layer = partial[tile][name].reshape(-1)
+                layer[index] = SPAM.LAYER_REDUCE[name](layer[index], value)
+        remaining[tile] -= 1
+        if remaining[tile] == 0:
+            if tile in partial:
+                results = partial.pop(tile)
+                save_results(optTuple, results)
+                fc.cache_results(optTuple, infra_bool, results)
+                logging.info("finished calculation {}_{}".format(optTuple[0], optTuple[1]))
+            metrics = flow_metrics.combine(unit_metrics.pop(tile))
+            if tile_done is not None:
+                tile_done(optTuple, metrics)
+
+    if progress is None:
+        failed = run_with_retries(units, run_work_unit, collect, processes, retries)
+    else:
+        with flow_progress.Aggregator(sum(sizes), progress) as aggregator:
+            failed = run_with_retries(units, run_work_unit, collect, processes, retries, aggregator.queue)
+    failed_tiles = {tile_key(unit[0]): unit[0] for unit in failed}
+    for tile, optTuple in failed_tiles.items():
+        partial.pop(tile, None)
+        logging.error("Tile {}_{} of {} failed".format(optTuple[0], optTuple[1], tile[0]))
+    fc.evict_cache(todo)
+    return list(failed_tiles.values())
+
+
+def run_backcalc_unit(unit):
+    metrics = {}
+    fc.backcalculation_tile(unit[0], metrics)
+    return unit[0], None, metrics
+
+
+def run_backcalculation(optList, processes=None, retries=2, tile_done=None):
+    """Back calculation of all tiles of optList from the footprints of their
+    paths (see fc.backcalculation_tile) with a process pool, tile_done is
+    called with the optTuple and the metrics of every finished tile.
+
+    Output parameters:
+        failed      List of the optTuples of the tiles that failed every retry
+    """
+    processes = processes or default_processes()
+    units = [(optTuple, True, 0, None) for optTuple in optList]
+
+    def collect(optTuple, hits, metrics):
+        if tile_done is not None:
+            tile_done(optTuple, metrics)
+
+    failed = run_with_retries(units, run_backcalc_unit, collect, processes, retries)
+    return [unit[0] for unit in failed]
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Progress of the calculation. The workers count the release pixels of their
+work unit and send the count through a multiprocessing queue, at most every
+INTERVAL seconds (Throttle, see flow_core). One Aggregator thread in the
+main process sums the counts of all work units and reports the progress
+with the estimated time left, at most every INTERVAL seconds, to the
+command line (ProgressLine) or the progress bar of the GUI (Simulation).
+
+A count is the number of release pixels of a work unit that are done (with
+infrastructure also the ones that were hit by a path and are no start cell
+anymore), a retried unit counts from 0 again, the highest count of every
+unit is used.
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import queue
+import threading
+import multiprocessing as mp
+
+INTERVAL = 0.5  # s between two progress messages of a worker and two reports
+
+_queue = None  # progress queue of the worker process, see init_worker
+
+
+def init_worker(progress_queue):
+    """Initializer of the worker processes, the counts of the work units are
+    sent to progress_queue"""
+    global _queue
+    _queue = progress_queue
+
+
+class Throttle:
+    """Sends the count of a work unit to the main process, at most every
+    interval seconds and only if the worker has a progress queue.
+
+    Input parameters:
+        key         Key of the work unit (tile and first release pixel)
+    """
+
+    def __init__(self, key, interval=INTERVAL):
+        self.key = key
+        self.interval = interval
+        self.last = time.monotonic()
+
+    def update(self, count):
+        """count release pixels of the unit are done"""
+        if _queue is not None and time.monotonic() - self.last >= self.interval:
+            self.send(count)
+
+    def send(self, count):
+        _queue.put((self.key, count))
+        self.last = time.monotonic()
+
+    def finish(self, count):
+        """The unit is done with count release pixels"""
+        if _queue is not None:
+            self.send(count)
+
+
+class Aggregator:
+    """Sums the counts of the work units sent by the workers (see Throttle)
+    in a thread of the main process and calls report(done, total, eta) at
+    most every interval seconds and once at the end, eta is the estimated
+    time left in s (None before the first count). Used as context manager
+    around the process pool, its queue is passed to the workers with
+    init_worker.
+
+    Input parameters:
+        total       Number of release pixels of all work units
+        report      Called with the progress, e.g. a ProgressLine
+    """
+
+    def __init__(self, total, report, interval=INTERVAL):
+        self.total = total
+        self.report = report
+        self.interval = interval
+        self.queue = mp.Queue()
+        self.counts = {}
+        self.done = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.queue.put(None)
+        self.thread.join()
+        self.queue.close()
+
+    def run(self):
+        last = time.monotonic()
+        while True:
+            try:
+                message = self.queue.get(timeout=self.interval)
+            except queue.Empty:
+                message = ()
+            if message is None:
+                break
+            if message:
+                key, count = message
+                if count > self.counts.get(key, 0):
+                    self.done += count - self.counts.get(key, 0)
+                    self.counts[key] = count
+            if time.monotonic() - last >= self.interval:
+                self.report(self.done, self.total, self.eta())
+                last = time.monotonic()
+        self.report(self.done, self.total, self.eta())
+
+    def eta(self):
+        """Time left in s at the mean rate so far"""
+        if self.done == 0:
+            return None
+        elapsed = time.monotonic() - self.start
+        return max(self.total - self.done, 0) * elapsed / self.done
+
+
+def format_time(seconds):
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressLine:
+    """Prints the progress of an Aggregator on one line of the terminal,
+    close() ends the line"""
+
+    def __init__(self, stream=None, unit="release pixels"):
+        self.stream = stream or sys.stdout
+        self.unit = unit
+        self.width = 0
+
+    def __call__(self, done, total, eta):
+        text = "Calculating: {} of {} {} = {:.1f}%".format(done, total, self.unit,
+                                                          100 * done / total if total else 100.)
+        if eta is not None:
+            text += ", time left {}".format(format_time(eta))
+        self.stream.write('\r' + text.ljust(self.width))
+        self.stream.flush()
+        self.width = len(text)
+
+    def close(self):
+        if self.width:
+            self.stream.write('\n')
+            self.stream.flush()
+            self.width = 0
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental update of the results of a run without infrastructure to an
+edited release layer (see main.update). Without infrastructure the paths of
+the release pixels don't influence each other and the result layers are
+max or sum reductions of the paths (SPAM.LAYER_REDUCE), so:
+
+- a tile with added release pixels gets the paths of the added pixels
+(saved as init_add_i_j.npy) reduced into its results
+- a tile with removed release pixels calculates the paths of the removed
+pixels (init_rem_i_j.npy) for their footprint, the cells they reached. A
+removed path can't be taken out of the max layers, so in the footprint the
+results are replaced by the paths of the remaining release pixels that can
+reach it (init_reach_i_j.npy, see reach_release), outside of the footprint
+the removed paths added nothing
+- all other tiles keep their results
+
+
+    Copyright (C) <2020>  <Michael Neuhauser>
+    Michael.Neuhauser@bfw.gv.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import math
+import numpy as np
+import split_and_merge as SPAM
+
+
+def diff_release(temp_dir, nTiles):
+    """Compare the release tiles of the run (init_i_j.npy) with the tiles of
+    the new release layer (init_new_i_j.npy).
+
+    Output parameters:
+        added       Tiles (i, j) with added release pixels, the added pixels
+                    are saved as init_add_i_j.npy
+        removed     Tiles (i, j) with removed release pixels, the removed
+                    pixels are saved as init_rem_i_j.npy
+    """
+    added, removed = [], []
+    for i in range(nTiles[0] + 1):
+        for j in range(nTiles[1] + 1):
+            old_tile = np.load(temp_dir + "init_{}_{}.npy".format(i, j))
+            new_tile = np.load(temp_dir + "init_new_{}_{}.npy".format(i, j))
+            old, new = old_tile > 0, new_tile > 0
+            if np.any(old & ~new):
+                np.save(temp_dir + "init_rem_{}_{}".format(i, j), np.where(old & ~new, old_tile, 0))
+                removed.append((i, j))
+            if np.any(new & ~old):
+                np.save(temp_dir + "init_add_{}_{}".format(i, j), np.where(new & ~old, new_tile, 0))
+                added.append((i, j))
+    return added, removed
+
+
+def reach_release(dem, release, footprint, alpha, cellsize):
+    """Release pixels whose paths can reach a cell of footprint. Like the
+    overlap of SPAM.tileSize, a path gets at most (altitude of the release
+    pixel - lowest altitude of the footprint) / tan(alpha) plus one cell
+    far, a release pixel reaches the footprint if it has a footprint cell in
+    the square of that radius (summed area table of the footprint).
+
+    Input parameters:
+        dem         DEM tile
+        release     Release tile, release pixels need value > 0
+        footprint   Boolean tile, the cells to reach
+
+    Output parameters:
+        reach       Release tile with only the release pixels that can
+                    reach the footprint
+    """
+    reach = np.zeros_like(release)
+    rows, cols = np.nonzero(release > 0)
+    if len(rows) == 0 or not footprint.any():
+        return reach
+    tan = math.tan(math.radians(float(alpha)))
+    if tan <= 0:
+        radius = np.full(len(rows), max(dem.shape))
+    else:
+        drop = np.maximum(dem[rows, cols] - dem[footprint].min(), 0)
+        radius = np.ceil(drop / tan / cellsize).astype(np.int64) + 1
+    table = np.zeros((dem.shape[0] + 1, dem.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = footprint.cumsum(0).cumsum(1)
+    sY, eY = np.clip(rows - radius, 0, dem.shape[0]), np.clip(rows + radius + 1, 0, dem.shape[0])
+    sX, eX = np.clip(cols - radius, 0, dem.shape[1]), np.clip(cols + radius + 1, 0, dem.shape[1])
+    hit = table[eY, eX] - table[sY, eX] - table[eY, sX] + table[sY, sX] > 0
+    reach[rows[hit], cols[hit]] = release[rows[hit], cols[hit]]
+    return reach
+
+
+def save_reach_release(temp_dir, rem_dir, i, j, alpha, cellsize):
+    """Save the kept release pixels (in the release layer of the run and in
+    the new one) of tile i, j that can reach the footprint of the removed
+    paths (res_count of rem_dir) as init_reach_i_j.npy, returns their
+    number. The added pixels are reduced into the results separately."""
+    dem = np.load(temp_dir + "dem_{}_{}.npy".format(i, j))
+    release = np.load(temp_dir + "init_new_{}_{}.npy".format(i, j))
+    release = np.where(np.load(temp_dir + "init_{}_{}.npy".format(i, j)) > 0, release, 0)
+    footprint = np.load(rem_dir + "res_count_{}_{}.npy".format(i, j)) > 0
+    reach = reach_release(dem, release, footprint, alpha, cellsize)
+    np.save(temp_dir + "init_reach_{}_{}".format(i, j), reach)
+    return int(np.count_nonzero(reach > 0))
+
+
+def save_atomic(file, array):
+    """np.save to a temporary file that is renamed, a killed run never
+    leaves a half written result tile"""
+    with open(file + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(file + ".tmp", file)
+
+
+def add_results(temp_dir, add_dir, i, j, layers):
+    """Reduce the results of the added release pixels of tile i, j (in
+    add_dir) into the results of the tile (SPAM.LAYER_REDUCE)"""
+    for name in layers:
+        file = temp_dir + "res_{}_{}_{}.npy".format(name, i, j)
+        results = np.load(file)
+        added = np.load(add_dir + "res_{}_{}_{}.npy".format(name, i, j))
+        save_atomic(file, SPAM.LAYER_REDUCE[name](results, added).astype(results.dtype))
+
+
+def replace_footprint(temp_dir, rem_dir, reach_dir, i, j, layers):
+    """Replace the results of tile i, j in the footprint of the removed paths
+    (rem_dir) with the results of the release pixels that reach it
+    (reach_dir), see save_reach_release"""
+    footprint = np.load(rem_dir + "res_count_{}_{}.npy".format(i, j)) > 0
+    for name in layers:
+        file = temp_dir + "res_{}_{}_{}.npy".format(name, i, j)
+        results = np.load(file)
+        reach = np.load(reach_dir + "res_{}_{}_{}.npy".format(name, i, j))
+        save_atomic(file, np.where(footprint, reach, results).astype(results.dtype))
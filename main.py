@@ -22,401 +22,147 @@ Created on Mon May  7 14:23:00 2018
 # import standard libraries
 import os
 import sys
-import psutil
-import numpy as np
+import shutil
+import itertools
+import subprocess
 from datetime import datetime
-from multiprocessing import cpu_count
-import multiprocessing as mp
 import logging
-from xml.etree import ElementTree as ET
-import pickle
 
-# Flow-Py Libraries
-import raster_io as io
-import Simulation as Sim
+# Flow-Py Libraries, raster_io (rasterio) is imported where rasters are
+# read, the GUI (PyQt5) only with --gui: worker processes that import this 
+# module start without them
 import flow_core as fc
+import flow_jobs
+import flow_metrics
+import flow_pool
+import flow_progress
+import flow_manifest
+import flow_update
 import split_and_merge as SPAM
 
-# Libraries for GUI, PyQt5
-from PyQt5.QtCore import pyqtSlot, QCoreApplication
-from PyQt5.QtWidgets import QFileDialog, QMessageBox, QMainWindow, QApplication
 
-from Flow_GUI import Ui_MainWindow
+def parse_options(kwargs):
+    """Calculation and output options of the command line (see readme),
+    None if an option is invalid"""
+    if 'engine' in kwargs:
+        engine = kwargs.get('engine')
+        if engine not in fc.ENGINES:
+            print("Error: unknown engine {}, use one of: {}".format(engine, ", ".join(fc.ENGINES)))
+            return None
+    else:
+        engine = 'cell'  # 'cell' = flow_class.Cell, 'array' = flow_array.Path, 'numba' = flow_numba
 
+    if 'neighbour_cache' in kwargs:
+        neighbour_cache = kwargs.get('neighbour_cache') in ('1', 'true', 'True', 'yes')
+    else:
+        neighbour_cache = False  # save the neighbourhood rasters of every tile as neighbours_i_j.npz
 
-class Flow_Py_EXEC():
+    if 'shared_memory' in kwargs:
+        shared_memory = kwargs.get('shared_memory') in ('1', 'true', 'True', 'yes')
+    else:
+        shared_memory = False  # input rasters in shared memory instead of tiles in the temp folder
+
+    cog = kwargs.get('output') == 'cog'  # output=cog: Cloud Optimized GeoTIFFs with overviews
+    compress = kwargs.get('compress')  # e.g. compress=deflate or compress=zstd
+    quantize = {}  # e.g. quantize=flux:0.0001,z_delta:0.01, layer saved as integer steps
+    if 'quantize' in kwargs:
+        for item in kwargs.get('quantize').split(','):
+            layer, scale = item.split(':')
+            quantize[layer] = float(scale)
+
+    # e.g. cache=/data/flowpy_cache cache_size=20: results of tiles with the same inputs and
+    # parameters are taken from the cache, at most cache_size GB (default 10)
+    cache = None
+    if 'cache' in kwargs:
+        cache = {'dir': kwargs.get('cache'), 'max_size': int(float(kwargs.get('cache_size', 10)) * 1024 ** 3)}
+
+    # footprints=true: save the footprints of the paths, --backcalc redoes the back calculation for a new
+    # infrastructure layer without calculating the paths (only with infrastructure)
+    footprints = kwargs.get('footprints') in ('1', 'true', 'True', 'yes')
+
+    return {'engine': engine, 'neighbour_cache': neighbour_cache, 'shared_memory': shared_memory,
+            'cog': cog, 'compress': compress, 'quantize': quantize, 'cache': cache, 'footprints': footprints}
+
+
+def create_result_dir(directory):
+    """Create res_<time>/temp/ in the working directory and start the log file
+    in res_<time>/, returns the result directory and the name of the run
+    (<time>, for the log file and the report)"""
+    time_string = datetime.now().strftime("%Y%m%d_%H%M%S")
+    res_path = directory + 'res_{}/'.format(time_string)
+    os.makedirs(res_path + 'temp/', exist_ok=True)
+    setup_logging(res_path + 'log_{}.txt'.format(time_string))
+    return res_path, time_string
 
-    def __init__(self):
-        
-        app = QApplication(sys.argv) 
-        MainWindow = QMainWindow()
-        self.ui = Ui_MainWindow()
-        self.ui.setupUi(MainWindow)
-        
-        # self.showMaximized()
-        #self.ui.setWindowTitle("Flow-Py")
-        #self.ui.setWindowIcon(QIcon('logo.jpg'))
-
-        self.directory = os.getcwd()
-
-        self.ui.alpha_Edit.setText('25')
-        self.ui.exp_Edit.setText('8')
-        self.ui.flux_Edit.setText('0.0003')
-        self.ui.z_Edit.setText('8848')
-
-        self.ui.wDir_Button.clicked.connect(self.open_wDir)
-        self.ui.DEM_Button.clicked.connect(self.open_dhm)
-        self.ui.Release_Button.clicked.connect(self.open_release)
-        self.ui.infra_Button.clicked.connect(self.open_infra)
-        #self.ui.forest_Button.clicked.connect(self.open_forest)
-        #self.ui.process_Box.currentIndexChanged.connect(self.processChanged)
-        self.ui.calc_Button.clicked.connect(self.calculation)
-        self.ui.actionSave.triggered.connect(self.save)
-        self.ui.actionLoad.triggered.connect(self.load)
-        self.ui.actionQuit.triggered.connect(self.quit)
-
-        self.calc_class = None
-        self.prot_for_bool = False
-        self.infra_bool = False
-        self.threads_calc = 0
-        self.progress_value = 0
-        self.cpu_count = 1
-        self.thread_list = []
-        self.start_list = []
-        self.end_list = []
-        for i in range(self.cpu_count):
-            self.thread_list.append(0)
-            self.start_list.append(0)
-            self.end_list.append(0)
-            
-        # show the constructed window
-        MainWindow.show()
-        sys.exit(app.exec_())
-            
-    def set_gui_bool(self, bool):
-        self.ui.calc_Button.setEnabled(bool)
-        self.ui.wDir_lineEdit.setEnabled(bool)
-        self.ui.DEM_lineEdit.setEnabled(bool)
-        self.ui.release_lineEdit.setEnabled(bool)
-        self.ui.infra_lineEdit.setEnabled(bool)
-
-    def save(self):
-        """Save the input paths"""
-        name = QFileDialog.getSaveFileName(None, 'Save File',
-                                           ".xml")[0]
-        if len(name) != 0:
-
-            root = ET.Element('root')
-            wdir = ET.SubElement(root, 'wDir')
-            dhm = ET.SubElement(root, 'DHM')
-            release = ET.SubElement(root, 'Release')
-            infra = ET.SubElement(root, 'Infrastructure')
-            forest = ET.SubElement(root, 'Forest')
-    
-            wdir.set('Directory', 'Working')
-            dhm.set('Directory', 'DHM')
-            release.set('Directory', 'Release')
-            infra.set('Directory', 'Infrastructure')
-            forest.set('Directory', 'Forest')
-    
-            wdir.text = self.ui.wDir_lineEdit.text()
-            dhm.text = self.ui.DEM_lineEdit.text()
-            release.text = self.ui.release_lineEdit.text()
-            infra.text = self.ui.infra_lineEdit.text()
-            #forest.text = self.ui.forest_lineEdit.text()
-    
-            tree = ET.ElementTree(root)
-            tree.write(name)
 
-    def load(self):
-        xml_file = QFileDialog.getOpenFileNames(None, 'Open xml',
-                                                self.directory,
-                                                "xml (*.xml);;All Files (*.*)")[0]
+def setup_logging(log_file):
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
 
-        if len(xml_file) != 0:
-            tree = ET.parse(xml_file[0])
-            root = tree.getroot()
-    
-            try:
-                self.ui.wDir_lineEdit.setText(root[0].text)
-                self.directory = root[0].text
-            except:
-                print("No Working Directory Path in File!")
-    
-            try:
-                self.ui.DEM_lineEdit.setText(root[1].text)
-            except:
-                print("No DEM Path in File!")
-    
-            try:
-                self.ui.release_lineEdit.setText(root[2].text)
-            except:
-                print("No Release Path in File!")
-    
-            try:
-                self.ui.infra_lineEdit.setText(root[3].text)
-            except:
-                print("No Infrastructure Path in File!")
-    
-            try:
-                self.ui.forest_lineEdit.setText(root[4].text)
-            except:
-                print("No Forest Path in File!")
-
-    def quit(self):
-        QCoreApplication.quit()
-
-    def open_wDir(self):
-        """Open the Working Directory, where results are stored"""
-        directory = QFileDialog.getExistingDirectory(None, 'Open Working Directory',
-                                                          self.directory,
-                                                          QFileDialog.ShowDirsOnly)
-        if len(directory) != 0:
-            self.directory = directory
-            self.ui.wDir_lineEdit.setText(self.directory)
-
-    def open_dhm(self):
-        """Open digital elevation model"""
-        dem_file = QFileDialog.getOpenFileNames(None, 'Open DEM',
-                                                self.directory,
-                                                "ascii (*.asc);;tif (*.tif);;All Files (*.*)")
-        if len(dem_file[0]) != 0:
-            dem = dem_file[0]
-            self.ui.DEM_lineEdit.setText(dem[0])
-
-    def open_release(self):
-        """Open release layer"""
-        release_file = QFileDialog.getOpenFileNames(None, 'Open Release',
-                                                    self.directory,
-                                                    "ascii (*.asc);;tif (*.tif);;All Files (*.*)")
-        if len(release_file[0]) != 0:
-            release = release_file[0]
-            self.ui.release_lineEdit.setText(release[0])
-
-    def open_infra(self):
-        """Open infrastructure layer"""
-        infra_file = QFileDialog.getOpenFileNames(None, 'Open Infrastructure Layer',
-                                                  self.directory,
-                                                  "ascii (*.asc);;tif (*.tif);;All Files (*.*)")
-        if len(infra_file[0]) != 0:
-            infra = infra_file[0]
-            self.ui.infra_lineEdit.setText(infra[0])
-
-    def update_progressBar(self, float, thread, start, end):
-        self.thread_list[thread] = float
-        self.start_list[thread] = start
-        self.end_list[thread] = end
-
-        self.progress_value = sum(self.thread_list) / len(self.thread_list)
-        self.progressBar.setValue(self.progress_value)
-        for i in range(len(self.thread_list)):
-            sys.stdout.write(
-                "Thread {}: Startcell {} of {} = {}%"'\n'.format(i + 1, self.start_list[i], self.end_list[i],
-                                                                 self.thread_list[i]))
-            sys.stdout.flush()
-        for i in range(len(self.thread_list)):
-            sys.stdout.write('\x1b[1A' + '\x1b[2K')  # Go 1 line up and erase that line
-
-    @staticmethod
-    def showdialog(path):
-        msg = QMessageBox()
-        msg.setIcon(QMessageBox.Critical)
-        msg.setText("No " + path + " set")
-        msg.setWindowTitle("Error")
-        msg.setStandardButtons(QMessageBox.Ok)
-        msg.exec_()
-
-    def calculation(self):
-        self.start = datetime.now().replace(microsecond=0)
-
-        # Check if input is ok
-        if self.ui.wDir_lineEdit.text() == '':
-            self.showdialog('Working Directory')
-            return
-        if self.ui.DEM_lineEdit.text() == '':
-            self.showdialog('DEM Layer')
-            return
-        if self.ui.release_lineEdit.text() == '':
-            self.showdialog('Release Layer')
-            return
-        # Disable all input line Edits and Buttons
-        self.set_gui_bool(False)
-
-        # Create result directory
-        time_string = datetime.now().strftime("%Y%m%d_%H%M%S")
-        try:
-            os.makedirs(self.ui.wDir_lineEdit.text() + '/res_{}/'.format(time_string))
-            self.res_dir = ('/res_{}/'.format(time_string))
-        except FileExistsError:
-            self.res_dir = ('/res_{}/'.format(time_string))
-        
-        directory = self.ui.wDir_lineEdit.text()
-        try:
-            os.makedirs(directory + self.res_dir + 'temp/')
-            temp_dir = (directory + self.res_dir + 'temp/')
-        except FileExistsError:
-            temp_dir = (directory + self.res_dir + 'temp/')
-
-        self.temp_dir = temp_dir
-            # Setup logger
-
-        for handler in logging.root.handlers[:]:
-            logging.root.removeHandler(handler)
-
-        logging.basicConfig(level=logging.INFO,
-                            format='%(asctime)s %(levelname)-8s %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            filename=(self.directory + self.res_dir + 'log_{}.txt').format(time_string),
-                            filemode='w')
-
-        # Start of Calculation
-        logging.info('Start Calculation')
-        # Read in raster files
-        try:
-            dem, header = io.read_raster(self.ui.DEM_lineEdit.text())
-            logging.info('DEM File: {}'.format(self.ui.DEM_lineEdit.text()))
-        except FileNotFoundError:
-            print("Wrong filepath or filename")
-            self.set_gui_bool(True)
-            return
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)-8s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        filename=log_file,
+                        filemode='w')
 
-        try:
-            release, release_header = io.read_raster(self.ui.release_lineEdit.text())
-            logging.info('Release File: {}'.format(self.ui.release_lineEdit.text()))
-        except FileNotFoundError:
-            print("Wrong filepath or filename")
-            self.set_gui_bool(True)
-            return
-
-        # Check if Layers have same size!!!
-        if header['ncols'] == release_header['ncols'] and header['nrows'] == release_header['nrows']:
-            print("DEM and Release Layer ok!")
+
+def check_inputs(dem_path, release_path, infra_path):
+    """Read the headers of the input rasters and check that they match.
+
+    Output parameters:
+        header      Header of the DEM, None if an input is missing or
+                    doesn't match the DEM
+        infra_bool  True if there is an infrastructure layer
+    """
+    import raster_io as io
+    infra_bool = False
+    try:
+        header = io.read_header(dem_path)
+        logging.info('DEM File: {}'.format(dem_path))
+    except FileNotFoundError:
+        print("DEM: Wrong filepath or filename")
+        return None, infra_bool
+
+    try:
+        release_header = io.read_header(release_path)
+        logging.info('Release File: {}'.format(release_path))
+    except FileNotFoundError:
+        print("Wrong filepath or filename")
+        return None, infra_bool
+
+    # Check if Layers have same size!!!
+    if header['ncols'] == release_header['ncols'] and header['nrows'] == release_header['nrows']:
+        print("DEM and Release Layer ok!")
+    else:
+        print("Error: Release Layer doesn't match DEM!")
+        return None, infra_bool
+
+    try:
+        infra_header = io.read_header(infra_path)
+        if header['ncols'] == infra_header['ncols'] and header['nrows'] == infra_header['nrows']:
+            print("Infra Layer ok!")
+            infra_bool = True
+            logging.info('Infrastructure File: {}'.format(infra_path))
         else:
-            print("Error: Release Layer doesn't match DEM!")
-            self.set_gui_bool(True)
-            return
+            print("Error: Infra Layer doesn't match DEM!")
+            return None, infra_bool
+    except:
+        pass  # no infrastructure layer
 
-        try:
-            infra, infra_header = io.read_raster(self.ui.infra_lineEdit.text())
-            if header['ncols'] == infra_header['ncols'] and header['nrows'] == infra_header['nrows']:
-                print("Infra Layer ok!")
-                self.infra_bool = True
-                logging.info('Infrastructure File: {}'.format(self.ui.infra_lineEdit.text()))
-            else:
-                print("Error: Infra Layer doesn't match DEM!")
-                self.set_gui_bool(True)
-                return
-        except:
-            infra = np.zeros_like(dem)
-
-        logging.info('Files read in')
-        
-        cellsize = header["cellsize"]
-        nodata = header["noDataValue"]
-        del dem, release, infra
-        
-        tileCOLS = int(15000 / cellsize)
-        tileROWS = int(15000 / cellsize)
-        U = int(5000 / cellsize) # 5km overlap
-        
-        logging.info("Start Tiling.")
-        
-        SPAM.tileRaster(self.ui.DEM_lineEdit.text(), "dem", temp_dir, tileCOLS, tileROWS, U)
-        SPAM.tileRaster(self.ui.release_lineEdit.text(), "init", temp_dir, tileCOLS, tileROWS, U, isInit=True)
-        if self.infra_bool:
-            SPAM.tileRaster(self.ui.infra_lineEdit.text(), "infra", temp_dir, tileCOLS, tileROWS, U)
-            
-        nTiles = pickle.load(open(temp_dir + "nTiles", "rb"))
-
-        alpha = self.ui.alpha_Edit.text()
-        exp = self.ui.exp_Edit.text()
-        flux_threshold = self.ui.flux_Edit.text()
-        max_z = self.ui.z_Edit.text()
-        
-        logging.info('Alpha Angle: {}'.format(alpha))
-        logging.info('Exponent: {}'.format(exp))
-        logging.info('Flux Threshold: {}'.format(flux_threshold))
-        logging.info('Max Z_delta: {}'.format(max_z))
-        logging.info
-        
-# =============================================================================
-#         self.z_delta = np.zeros_like(dem, dtype=np.float32)
-#         self.flux = np.zeros_like(dem, dtype=np.float32)
-#         self.cell_counts = np.zeros_like(dem, dtype=np.int32)
-#         self.z_delta_sum = np.zeros_like(dem, dtype=np.float32)
-#         self.backcalc = np.zeros_like(dem, dtype=np.int32)
-#         self.fp_ta = np.zeros_like(dem, dtype=np.float32)
-#         self.sl_ta = np.zeros_like(dem, dtype=np.float32)
-# =============================================================================
-        
-        optList = []
-        # das hier ist die batch-liste, die von mulitprocessing
-        # abgearbeitet werden muss - sieht so aus:
-        # [(0,0,alpha,exp,cellsize,-9999.),
-        # (0,1,alpha,exp,cellsize,-9999.),
-        # etc.]
-           
-        for i in range(nTiles[0]+1):
-            for j in range(nTiles[1]+1):
-                optList.append((i, j, alpha, exp, cellsize, nodata, flux_threshold, max_z, temp_dir))
-
-        # Calculation
-        self.calc_class = Sim.Simulation(optList, self.infra_bool)
-        self.calc_class.finished.connect(self.thread_finished)
-        logging.info('Multiprocessing starts, used cores: {}'.format(cpu_count() - 1))
-        self.calc_class.start()
-
-    def thread_finished(self):
-        logging.info('Calculation finished, getting results.')
-        # Merge calculated tiles
-        self.z_delta = SPAM.MergeRaster(self.temp_dir, "res_z_delta")
-        self.flux = SPAM.MergeRaster(self.temp_dir, "res_flux")
-        self.cell_counts = SPAM.MergeRaster(self.temp_dir, "res_count")
-        self.z_delta_sum = SPAM.MergeRaster(self.temp_dir, "res_z_delta_sum")
-        self.fp_ta = SPAM.MergeRaster(self.temp_dir, "res_fp")
-        self.sl_ta = SPAM.MergeRaster(self.temp_dir, "res_sl")
-        if self.infra_bool:
-            self.backcalc = SPAM.MergeRaster(self.temp_dir, "res_backcalc")
-        self.output()
-
-    def output(self):
-        # time_string = datetime.now().strftime("%Y%m%d_%H%M%S")
-        logging.info('Writing Output Files')
-        io.output_raster(self.ui.DEM_lineEdit.text(),
-                         self.directory + self.res_dir + "flux{}".format(self.ui.outputBox.currentText()),
-                         self.flux)
-        io.output_raster(self.ui.DEM_lineEdit.text(),
-                         self.directory + self.res_dir + "z_delta{}".format(self.ui.outputBox.currentText()),
-                         self.z_delta)
-        io.output_raster(self.ui.DEM_lineEdit.text(),
-                         self.directory + self.res_dir + "FP_travel_angle{}".format(self.ui.outputBox.currentText()),
-                         self.fp_ta)
-        io.output_raster(self.ui.DEM_lineEdit.text(),
-                         self.directory + self.res_dir + "SL_travel_angle{}".format(self.ui.outputBox.currentText()),
-                         self.sl_ta)
-        if not self.infra_bool:
-            io.output_raster(self.ui.DEM_lineEdit.text(),
-                             self.directory + self.res_dir + "cell_counts{}".format(self.ui.outputBox.currentText()),
-                             self.cell_counts)
-            io.output_raster(self.ui.DEM_lineEdit.text(),
-                             self.directory + self.res_dir + "z_delta_sum{}".format(self.ui.outputBox.currentText()),
-                             self.z_delta_sum)
-        if self.infra_bool:
-            io.output_raster(self.ui.DEM_lineEdit.text(),
-                             self.directory + self.res_dir + "backcalculation{}".format(self.ui.outputBox.currentText()),
-                             self.backcalc)
-
-        print("Calculation finished")
-        end = datetime.now().replace(microsecond=0)
-        logging.info('Calculation needed: ' + str(end - self.start) + ' seconds')
-
-        # Handle GUI
-        #self.ui.progressBar.setValue(100)
-        self.set_gui_bool(True)
-
-
-def main(args, kwargs):
-    
+    logging.info('Headers read in')
+    return header, infra_bool
+
+
+def input_fingerprints(dem_path, release_path, infra_path, infra_bool):
+    inputs = {"dem": dem_path, "init": release_path}
+    if infra_bool:
+        inputs["infra"] = infra_path
+    return {name: flow_manifest.fingerprint(path) for name, path in inputs.items()}
+
+
+def main(args, kwargs, queue=False):
+    """Run the model for one parameter set, with queue the tiles are
+    calculated by workers on any host through the job queue (see run_queue)"""
 
     alpha = args[0]
     exp = args[1]
@@ -445,34 +191,22 @@ def main(args, kwargs):
                 # Rockfall = 50
                 # Soil Slide = 12
 
+    options = parse_options(kwargs)
+    if options is None:
+        return
+    processes = flow_pool.default_processes()
+    if queue:
+        # e.g. workers=4 total_workers=64: 4 workers on this host, 64 on all hosts (for the tile size)
+        workers = int(kwargs.get('workers', 0))
+        processes = max(int(kwargs.get('total_workers', workers)), 1)
+        options['shared_memory'] = False  # the other hosts read the tiles from the temp folder
+
     print("Starting...")
     print("...")
 
     start = datetime.now().replace(microsecond=0)
-    infra_bool = False
-    # Create result directory
-    time_string = datetime.now().strftime("%Y%m%d_%H%M%S")
-    try:
-        os.makedirs(directory + 'res_{}/'.format(time_string))
-        res_dir = ('res_{}/'.format(time_string))
-    except FileExistsError:
-        res_dir = ('res_{}/'.format(time_string))
-        
-    try:
-        os.makedirs(directory + res_dir + 'temp/')
-        temp_dir = (directory + res_dir + 'temp/')
-    except FileExistsError:
-        temp_dir = (directory + res_dir + 'temp/')
-
-    # Setup logger
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-
-    logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s %(levelname)-8s %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S',
-                        filename=(directory + res_dir + 'log_{}.txt').format(time_string),
-                        filemode='w')
+    # Create result directory and setup logger
+    res_path, name = create_result_dir(directory)
 
     # Start of Calculation
     logging.info('Start Calculation')
@@ -480,131 +214,631 @@ def main(args, kwargs):
     logging.info('Exponent: {}'.format(exp))
     logging.info('Flux Threshold: {}'.format(flux_threshold))
     logging.info('Max Z_delta: {}'.format(max_z))
-    logging.info
+    logging.info('Options: {}'.format(options))
     # Read in raster files
-    try:
-        dem, header = io.read_raster(dem_path)
-        logging.info('DEM File: {}'.format(dem_path))
-    except FileNotFoundError:
-        print("DEM: Wrong filepath or filename")
+    header, infra_bool = check_inputs(dem_path, release_path, infra_path)
+    if header is None:
         return
+    
+    cellsize = header["cellsize"]
+    nodata = header["noDataValue"]
+    parameters = {'alpha': alpha, 'exp': exp, 'flux_threshold': flux_threshold, 'max_z': max_z,
+                  'cellsize': cellsize, 'nodata': nodata, 'infra': infra_bool}
+    report = flow_metrics.RunReport(res_path + 'report_{}.json'.format(name), 'queue' if queue else 'run', parameters)
+
+    with report.phase('tiling'):
+        # a job of the queue is a whole tile, like a tile with infrastructure
+        tileCOLS, tileROWS, U = SPAM.tileSize(dem_path, release_path, alpha, processes, infra_bool or queue)
+    nTiles = SPAM.tileWindows(header['nrows'], header['ncols'], tileCOLS, tileROWS, U)[1]
+
+    # The manifest records the run, a run that dies is continued with --resume
+    tiling = {'tileCOLS': int(tileCOLS), 'tileROWS': int(tileROWS), 'U': int(U),
+              'nTiles': [int(n) for n in nTiles]}
+    manifest = flow_manifest.new_manifest(parameters, options, input_fingerprints(dem_path, release_path,
+                                                                                  infra_path, infra_bool), tiling)
+    flow_manifest.write_manifest(res_path + 'temp/', manifest)
 
     try:
-        release, release_header = io.read_raster(release_path)
-        logging.info('Release File: {}'.format(release_path))
-    except FileNotFoundError:
-        print("Wrong filepath or filename")
-        return
+        if queue:
+            finished = run_queue(res_path, manifest, report, workers, float(kwargs.get('stale', flow_jobs.STALE)))
+        else:
+            finished = run_manifest(res_path, manifest, report)
+        if finished:
+            print("Calculation finished")
+            print("...")
+    finally:
+        report.write()
+    end = datetime.now().replace(microsecond=0)
+    logging.info('Calculation needed: ' + str(end - start) + ' seconds')
 
-    # Check if Layers have same size!!!
-    if header['ncols'] == release_header['ncols'] and header['nrows'] == release_header['nrows']:
-        print("DEM and Release Layer ok!")
-    else:
-        print("Error: Release Layer doesn't match DEM!")
+
+def sweep(args, kwargs):
+    """Run every combination of the comma separated parameter lists alpha,
+    exp, flux and max_z with the same DEM and release layer. The inputs are
+    tiled once (with the overlap of the smallest alpha) and the tiles of all
+    parameter sets are calculated with one process pool, each parameter set
+    gets its own result directory (with manifest, so it can be resumed) in
+    res_<time>/.
+
+    Input parameters:
+        args        working directory, path to DEM, path to release layer
+        kwargs      alpha=25,30 exp=8 flux=0.0003,0.003 max_z=270 and the
+                    options of main
+    """
+    directory, dem_path, release_path = args[:3]
+    infra_path = kwargs.get('infra')
+    grid = [kwargs.get('alpha', '25').split(','), kwargs.get('exp', '8').split(','),
+            kwargs.get('flux', '0.0003').split(','),
+            kwargs.get('max_z', '8848').split(',')]
+    options = parse_options(kwargs)
+    if options is None:
         return
+    parameter_sets = list(itertools.product(*grid))
 
-    try:
-        infra, infra_header = io.read_raster(infra_path)
-        if header['ncols'] == infra_header['ncols'] and header['nrows'] == infra_header['nrows']:
-            print("Infra Layer ok!")
-            infra_bool = True
-            logging.info('Infrastructure File: {}'.format(infra_path))
-        else:
-            print("Error: Infra Layer doesn't match DEM!")
-            return
-    except:
-        infra = np.zeros_like(dem)
+    print("Starting sweep of {} parameter sets...".format(len(parameter_sets)))
+    start = datetime.now().replace(microsecond=0)
+    res_path, name = create_result_dir(directory)
+    report = flow_metrics.RunReport(res_path + 'report_{}.json'.format(name), 'sweep',
+                                    {'alpha': grid[0], 'exp': grid[1], 'flux_threshold': grid[2], 'max_z': grid[3]})
+    logging.info('Start Sweep, {} parameter sets'.format(len(parameter_sets)))
+    logging.info('Alpha Angles: {}, Exponents: {}, Flux Thresholds: {}, Max Z_delta: {}'.format(*grid))
+    logging.info('Options: {}'.format(options))
+    header, infra_bool = check_inputs(dem_path, release_path, infra_path)
+    if header is None:
+        return
 
-    del dem, release, infra
-    logging.info('Files read in')
-    
     cellsize = header["cellsize"]
     nodata = header["noDataValue"]
-    
-    tileCOLS = int(15000 / cellsize)
-    tileROWS = int(15000 / cellsize)
-    U = int(5000 / cellsize) # 5km overlap
-    
+    # The smallest alpha has the longest run out and so the largest overlap
+    alpha_min = min(grid[0], key=float)
+    with report.phase('tiling'):
+        tileCOLS, tileROWS, U = SPAM.tileSize(dem_path, release_path, alpha_min, flow_pool.default_processes(),
+                                              infra_bool)
+    nTiles = SPAM.tileWindows(header['nrows'], header['ncols'], tileCOLS, tileROWS, U)[1]
+    tiling = {'tileCOLS': int(tileCOLS), 'tileROWS': int(tileROWS), 'U': int(U),
+              'nTiles': [int(n) for n in nTiles]}
+    inputs = input_fingerprints(dem_path, release_path, infra_path, infra_bool)
+
+    runs = []
+    for alpha, exp, flux, max_z in parameter_sets:
+        set_path = res_path + 'alpha{}_exp{}_flux{}_max_z{}/'.format(alpha, exp, flux, max_z)
+        os.makedirs(set_path + 'temp/', exist_ok=True)
+        # the tiles are in res_<time>/temp/, the layout is needed to merge the results
+        SPAM.tileLayout(set_path + 'temp/', header['nrows'], header['ncols'], tileCOLS, tileROWS, U)
+        parameters = {'alpha': alpha, 'exp': exp, 'flux_threshold': float(flux), 'max_z': max_z,
+                      'cellsize': cellsize, 'nodata': nodata, 'infra': infra_bool}
+        manifest = flow_manifest.new_manifest(parameters, options, inputs, tiling)
+        flow_manifest.write_manifest(set_path + 'temp/', manifest)
+        runs.append((set_path, manifest))
+
+    try:
+        with report.phase('tiling'):
+            shared, blocks = tile_inputs(res_path + 'temp/', runs[0][1])
+        finished = calculate_runs(res_path + 'temp/', runs, report, shared, blocks)
+    finally:
+        report.write()
+    print("Sweep finished, {} of {} parameter sets merged".format(sum(finished), len(runs)))
+    end = datetime.now().replace(microsecond=0)
+    logging.info('Sweep needed: ' + str(end - start) + ' seconds')
+
+
+def input_layers(manifest):
+    """(path, name, isInit) of the input rasters of a run"""
+    return [(manifest['inputs'][name]['path'], name, name == "init")
+            for name in ("dem", "init", "infra") if name in manifest['inputs']]
+
+
+def tile_inputs(temp_dir, manifest):
+    """Tile the input rasters of a run into temp_dir or, with the option
+    shared_memory, share them.
+
+    Output parameters:
+        shared      Dict layer -> shared raster (see SPAM.shareRaster), None
+                    if the rasters are tiled
+        blocks      Shared memory blocks, to be released after the calculation
+    """
+    tiling = manifest['tiling']
     logging.info("Start Tiling.")
     print("Start Tiling...")
-    
-    SPAM.tileRaster(dem_path, "dem", temp_dir, tileCOLS, tileROWS, U)
-    SPAM.tileRaster(release_path, "init", temp_dir, tileCOLS, tileROWS, U, isInit=True)
-    if infra_bool:
-        SPAM.tileRaster(infra_path, "infra", temp_dir, tileCOLS, tileROWS, U)
-    
-    print("Finished Tiling...")    
-    nTiles = pickle.load(open(temp_dir + "nTiles", "rb"))
+    shared, blocks = None, []
+    if manifest['options']['shared_memory']:
+        shared = {}
+        for path, name, isInit in input_layers(manifest):
+            block, shared[name] = SPAM.shareRaster(path, name, temp_dir, tiling['tileCOLS'], tiling['tileROWS'],
+                                                   tiling['U'], isInit)
+            blocks.append(block)
+    else:
+        SPAM.tileRasters(input_layers(manifest), temp_dir, tiling['tileCOLS'], tiling['tileROWS'], tiling['U'])
+    print("Finished Tiling...")
+    return shared, blocks
+
+
+def run_manifest(res_path, manifest, report):
+    """Tile the inputs of the run (if they aren't tiled yet), calculate the
+    tiles that are not done and merge the results into the output files.
+
+    Input parameters:
+        res_path    Result directory of the run, with the temp folder
+        manifest    Run manifest, see flow_manifest
+        report      flow_metrics.RunReport of the run
+
+    Output parameters:
+        finished    False if tiles failed, the run can be resumed later
+    """
+    temp_dir = res_path + 'temp/'
+    shared, blocks = None, []
+    if manifest['options']['shared_memory'] or not manifest['tiling']['tiled']:
+        with report.phase('tiling'):
+            shared, blocks = tile_inputs(temp_dir, manifest)
+        if shared is None:
+            manifest['tiling']['tiled'] = True
+            flow_manifest.write_manifest(temp_dir, manifest)
+    return calculate_runs(temp_dir, [(res_path, manifest)], report, shared, blocks)[0]
+
+
+def run_queue(res_path, manifest, report, workers=0, stale=flow_jobs.STALE):
+    """Calculate the tiles of a run with the job queue in its temp folder
+    (see flow_jobs): the inputs are tiled to the temp folder, every pending
+    tile becomes a job and this process coordinates the workers until all
+    tiles are done, then the results are merged. Workers are started with
+    python3 main.py --worker res_path on any host that sees res_path, the
+    first workers are started here.
+
+    Input parameters:
+        res_path    Result directory of the run, with the temp folder
+        manifest    Run manifest, see flow_manifest
+        report      flow_metrics.RunReport of the run
+        workers     Number of worker processes started on this host
+        stale       s without heartbeat until the job of a worker is given
+                    to another worker
+
+    Output parameters:
+        finished    False if tiles failed, continue with --coordinate
+    """
+    temp_dir = res_path + 'temp/'
+    if not manifest['tiling']['tiled']:
+        with report.phase('tiling'):
+            tile_inputs(temp_dir, manifest)
+        manifest['tiling']['tiled'] = True
+        flow_manifest.write_manifest(temp_dir, manifest)
+    result_layers = [layer for layer, output in fc.output_layers(manifest['parameters']['infra'])]
+    tiles = flow_manifest.pending_tiles(temp_dir, manifest, result_layers)
+    flow_jobs.create_jobs(temp_dir, manifest, tiles)
+    logging.info('{} tile jobs, {} local workers'.format(len(tiles), workers))
+    print("{} tiles to calculate, start workers on other hosts with: python3 main.py --worker {}".format(
+        len(tiles), os.path.abspath(res_path)))
+
+    def tile_done(i, j, metrics):
+        report.tile(flow_manifest.tile_key(i, j), metrics)
+
+    def start_worker():
+        # the local workers log to temp/jobs/ like the others, their output would break the progress line
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', res_path],
+                                stdout=subprocess.DEVNULL)
+
+    progress = flow_progress.ProgressLine(unit="tiles")
+    try:
+        with report.phase('compute'):
+            failed = flow_jobs.coordinate(temp_dir, manifest, tile_done, progress, start_worker, workers, stale)
+    finally:
+        progress.close()
+    if failed:
+        for i, j in failed:
+            report.tile(flow_manifest.tile_key(i, j), {'failed': True})
+        logging.error('{} tiles failed, results not merged'.format(len(failed)))
+        print("Error: {} tiles failed, continue the run with: python3 main.py --coordinate {}".format(len(failed),
+                                                                                                    res_path))
+        return False
+    merge_run(res_path, manifest, report)
+    return True
+
+
+def coordinate(res_path, kwargs):
+    """Coordinate the job queue of a run again (see run_queue), e.g. after
+    the coordinator was stopped or tiles failed: failed jobs are pending
+    again and the results are merged when all tiles are done."""
+    res_path = os.path.join(res_path, '')
+    temp_dir = res_path + 'temp/'
+    try:
+        manifest = flow_manifest.read_manifest(temp_dir)
+    except FileNotFoundError:
+        print("Error: no run manifest in {}".format(temp_dir))
+        return
+
+    start = datetime.now().replace(microsecond=0)
+    name = 'coordinate_' + datetime.now().strftime("%Y%m%d_%H%M%S")
+    setup_logging(res_path + 'log_{}.txt'.format(name))
+    logging.info('Coordinate job queue of {}'.format(res_path))
+    changed = flow_manifest.changed_inputs(manifest)
+    if changed:
+        logging.error('Input rasters changed: {}'.format(', '.join(changed)))
+        print("Error: input rasters changed since the run was started: {}".format(', '.join(changed)))
+        return
+    if os.path.isdir(flow_jobs.job_dir(temp_dir, "failed")):
+        flow_jobs.requeue_failed(temp_dir)
+    report = flow_metrics.RunReport(res_path + 'report_{}.json'.format(name), 'coordinate', manifest['parameters'])
+    try:
+        if run_queue(res_path, manifest, report, int(kwargs.get('workers', 0)),
+                     float(kwargs.get('stale', flow_jobs.STALE))):
+            print("Calculation finished")
+    finally:
+        report.write()
+    end = datetime.now().replace(microsecond=0)
+    logging.info('Calculation needed: ' + str(end - start) + ' seconds')
 
+
+def worker(res_path):
+    """Worker of the job queue of a run (see run_queue): calculates tiles
+    until no tile is left, on any host that sees res_path"""
+    temp_dir = os.path.join(res_path, '') + 'temp/'
+    if not os.path.isdir(flow_jobs.job_dir(temp_dir, "pending")):
+        print("Error: no job queue in {}, start the run with --queue".format(temp_dir))
+        return
+    name = flow_jobs.worker_name()
+    setup_logging(flow_jobs.job_dir(temp_dir) + 'log_{}.txt'.format(name))
+    done = flow_jobs.work(temp_dir, name)
+    print("Worker {} finished, {} tiles calculated".format(name, done))
+
+
+def calculate_runs(temp_dir, runs, report, shared=None, blocks=()):
+    """Calculate the pending tiles of one or more runs with the same input
+    tiles in one process pool and merge the results of every run. A run
+    saves its res_<layer>_i_j.npy to its own temp folder.
+
+    Input parameters:
+        temp_dir    Folder of the input tiles
+        runs        List of (result directory, manifest)
+        report      flow_metrics.RunReport, gets the metrics of the tiles
+                    and the time of the calculation and the merge
+        shared      Shared input rasters, see tile_inputs
+        blocks      Shared memory blocks, released after the calculation
+
+    Output parameters:
+        finished    Per run, False if tiles failed and the run can be
+                    resumed later
+    """
+    infra_bool = runs[0][1]['parameters']['infra']
+    result_layers = [layer for layer, output in fc.output_layers(infra_bool)]
+    manifests = {}
     optList = []
     # das hier ist die batch-liste, die von mulitprocessing
     # abgearbeitet werden muss - sieht so aus:
     # [(0,0,alpha,exp,cellsize,-9999.),
     # (0,1,alpha,exp,cellsize,-9999.),
     # etc.]
-       
-    for i in range(nTiles[0]+1):
-        for j in range(nTiles[1]+1):
-            optList.append((i, j, alpha, exp, cellsize, nodata, flux_threshold, max_z, temp_dir))
+    for res_path, manifest in runs:
+        run_dir = res_path + 'temp/'
+        manifests[run_dir] = manifest
+        parameters = manifest['parameters']
+        options = {'engine': manifest['options']['engine'], 'neighbour_cache': manifest['options']['neighbour_cache']}
+        if shared is not None:
+            options['shared'] = shared
+        if manifest['options'].get('cache') is not None:
+            options['cache'] = manifest['options']['cache']
+        if manifest['options'].get('footprints', False) and infra_bool:
+            options['footprints'] = True
+        if run_dir != temp_dir:
+            options['res_dir'] = run_dir
+        for i, j in flow_manifest.pending_tiles(run_dir, manifest, result_layers):
+            optList.append((i, j, parameters['alpha'], parameters['exp'], parameters['cellsize'], parameters['nodata'],
+                            parameters['flux_threshold'], parameters['max_z'], temp_dir, options))
+
+    def report_key(optTuple):
+        # the tiles of a sweep are reported per parameter set
+        key = flow_manifest.tile_key(optTuple[0], optTuple[1])
+        if len(runs) == 1:
+            return key
+        return os.path.basename(os.path.dirname(os.path.dirname(fc.result_dir(optTuple)))) + '/' + key
+
+    def tile_done(optTuple, metrics):
+        run_dir = fc.result_dir(optTuple)
+        flow_manifest.set_tile(run_dir, manifests[run_dir], optTuple[0], optTuple[1], "done")
+        report.tile(report_key(optTuple), metrics)
 
     # Calculation
-    logging.info('Multiprocessing starts, used cores: {}'.format(cpu_count() - 1))
-    print("{} Processes started and {} calculations to perform.".format(mp.cpu_count() - 1, len(optList)))
-    pool = mp.Pool(mp.cpu_count() - 1)
-        
-    if infra_bool:
-        pool.map(fc.calculation, optList)
-    else:       
-        pool.map(fc.calculation_effect, optList)
-
-    pool.close()
-    pool.join()
+    logging.info('Multiprocessing starts, used cores: {}'.format(flow_pool.default_processes()))
+    print("{} Processes started and {} calculations to perform.".format(flow_pool.default_processes(), len(optList)))
+    progress = flow_progress.ProgressLine()
+    try:
+        with report.phase('compute'):
+            failed = flow_pool.run_calculation(optList, infra_bool, tile_done=tile_done, progress=progress)
+    finally:
+        progress.close()
+        SPAM.releaseShared(blocks)
+    for optTuple in failed:
+        run_dir = fc.result_dir(optTuple)
+        flow_manifest.set_tile(run_dir, manifests[run_dir], optTuple[0], optTuple[1], "failed")
+        report.tile(report_key(optTuple), {'failed': True})
 
     logging.info('Calculation finished, merging results.')
-    
-    # Merge calculated tiles
-    z_delta = SPAM.MergeRaster(temp_dir, "res_z_delta")
-    flux = SPAM.MergeRaster(temp_dir, "res_flux")
-    cell_counts = SPAM.MergeRaster(temp_dir, "res_count")
-    z_delta_sum = SPAM.MergeRaster(temp_dir, "res_z_delta_sum")
-    fp_ta = SPAM.MergeRaster(temp_dir, "res_fp")
-    sl_ta = SPAM.MergeRaster(temp_dir, "res_sl")
-    if infra_bool:
-        backcalc = SPAM.MergeRaster(temp_dir, "res_backcalc")
-    
-    # time_string = datetime.now().strftime("%Y%m%d_%H%M%S")
-    logging.info('Writing Output Files')
+    finished = []
+    for res_path, manifest in runs:
+        n_failed = sum(status == "failed" for status in manifest['tiles'].values())
+        if n_failed:
+            logging.error('{} tiles of {} failed, results not merged'.format(n_failed, res_path))
+            print("Error: {} tiles failed, continue the run with: python3 main.py --resume {}".format(n_failed,
+                                                                                                    res_path))
+            finished.append(False)
+            continue
+        merge_run(res_path, manifest, report)
+        finished.append(True)
+    return finished
+
+
+def merge_run(res_path, manifest, report):
+    """Merge the result tiles of a run in one pass and write them block by
+    block to the output files, the time of merging and writing is added to
+    the phases merge and output of the report"""
+    logging.info('Writing Output Files of {}'.format(res_path))
     output_format = '.tif'
-    io.output_raster(dem_path,
-                     directory + res_dir + "flux{}".format(output_format),
-                     flux)
-    io.output_raster(dem_path,
-                     directory + res_dir + "z_delta{}".format(output_format),
-                     z_delta)
-    io.output_raster(dem_path,
-                     directory + res_dir + "FP_travel_angle{}".format(output_format),
-                     fp_ta)
-    io.output_raster(dem_path,
-                     directory + res_dir + "SL_travel_angle{}".format(output_format),
-                     sl_ta)
-    if not infra_bool:  # if no infra
-        io.output_raster(dem_path,
-                         directory + res_dir + "cell_counts{}".format(output_format),
-                         cell_counts)
-        io.output_raster(dem_path,
-                         directory + res_dir + "z_delta_sum{}".format( output_format),
-                         z_delta_sum)
-    if infra_bool:  # if infra
-        io.output_raster(dem_path,
-                         directory + res_dir + "backcalculation{}".format(output_format),
-                         backcalc)
-
-    print("Calculation finished")
-    print("...")
+    options = manifest['options']
+    result_layers, outputs = zip(*fc.output_layers(manifest['parameters']['infra']))
+    timings = {}
+    SPAM.mergeToFiles(res_path + 'temp/', result_layers, manifest['inputs']['dem']['path'],
+                      [res_path + output + output_format for output in outputs],
+                      cog=options['cog'], compress=options['compress'], quantize=options['quantize'],
+                      timings=timings)
+    for phase, seconds in timings.items():
+        report.add_time(phase, seconds)
+
+
+def resume(res_path):
+    """Continue a run from its manifest: the tiles of the inputs and the
+    res_<layer>_i_j.npy of the finished tiles are reused, only the missing or
+    failed tiles are calculated before the results are merged."""
+    res_path = os.path.join(res_path, '')
+    try:
+        manifest = flow_manifest.read_manifest(res_path + 'temp/')
+    except FileNotFoundError:
+        print("Error: no run manifest in {}temp/".format(res_path))
+        return
+
+    start = datetime.now().replace(microsecond=0)
+    name = 'resume_' + datetime.now().strftime("%Y%m%d_%H%M%S")
+    setup_logging(res_path + 'log_{}.txt'.format(name))
+    logging.info('Resume Calculation of {}'.format(res_path))
+    changed = flow_manifest.changed_inputs(manifest)
+    if changed:
+        logging.error('Input rasters changed: {}'.format(', '.join(changed)))
+        print("Error: input rasters changed since the run was started: {}".format(', '.join(changed)))
+        return
+    done = sum(status == "done" for status in manifest['tiles'].values())
+    logging.info('{} of {} tiles done'.format(done, len(manifest['tiles'])))
+    print("Resuming run, {} of {} tiles done".format(done, len(manifest['tiles'])))
+
+    report = flow_metrics.RunReport(res_path + 'report_{}.json'.format(name), 'resume', manifest['parameters'])
+    try:
+        if run_manifest(res_path, manifest, report):
+            print("Calculation finished")
+            print("...")
+    finally:
+        report.write()
     end = datetime.now().replace(microsecond=0)
     logging.info('Calculation needed: ' + str(end - start) + ' seconds')
 
 
+def update(res_path, release_path):
+    """Update the results of a finished run without infrastructure to an
+    edited release layer, instead of calculating all tiles again (see
+    flow_update): tiles with added release pixels only calculate the paths of
+    the added pixels, tiles with removed release pixels calculate the paths
+    of the removed pixels and of the release pixels that can reach them, all
+    other tiles keep their results. The results of the run are replaced
+    by the updated results."""
+    import raster_io as io
+    res_path = os.path.join(res_path, '')
+    temp_dir = res_path + 'temp/'
+    try:
+        manifest = flow_manifest.read_manifest(temp_dir)
+    except FileNotFoundError:
+        print("Error: no run manifest in {}".format(temp_dir))
+        return
+
+    start = datetime.now().replace(microsecond=0)
+    name = 'update_' + datetime.now().strftime("%Y%m%d_%H%M%S")
+    setup_logging(res_path + 'log_{}.txt'.format(name))
+    logging.info('Update of {} to Release File: {}'.format(res_path, release_path))
+    if manifest['parameters']['infra']:
+        print("Error: with infrastructure the release pixels depend on each other, start a new run")
+        return
+    if any(status != "done" for status in manifest['tiles'].values()):
+        print("Error: the run isn't finished, resume it first")
+        return
+    changed = flow_manifest.changed_inputs(manifest)
+    if 'dem' in changed:
+        print("Error: the DEM changed since the run, start a new run")
+        return
+    header = io.read_header(manifest['inputs']['dem']['path'])
+    release_header = io.read_header(release_path)
+    if header['ncols'] != release_header['ncols'] or header['nrows'] != release_header['nrows']:
+        print("Error: Release Layer doesn't match DEM!")
+        return
+
+    tiling = manifest['tiling']
+    if not tiling['tiled'] and 'init' in changed:
+        print("Error: the release layer of the run was changed and it has no release tiles, start a new run")
+        return
+    report = flow_metrics.RunReport(res_path + 'report_{}.json'.format(name), 'update', manifest['parameters'])
+    with report.phase('tiling'):
+        if not tiling['tiled']:
+            # shared memory run, the previous release layer has to be tiled again
+            SPAM.tileRasters(input_layers(manifest), temp_dir, tiling['tileCOLS'], tiling['tileROWS'], tiling['U'])
+            tiling['tiled'] = True
+            flow_manifest.write_manifest(temp_dir, manifest)
+        SPAM.tileRasters([(release_path, "init_new", True)], temp_dir, tiling['tileCOLS'], tiling['tileROWS'],
+                         tiling['U'])
+    added, removed = flow_update.diff_release(temp_dir, tiling['nTiles'])
+    logging.info('Tiles with added release pixels: {}, with removed release pixels: {}'.format(len(added),
+                                                                                               len(removed)))
+    print("{} tiles with added and {} tiles with removed release pixels".format(len(added), len(removed)))
+
+    # Calculate the added and the removed paths next to the results of the run, then the paths of the
+    # remaining release pixels that reach the footprint of the removed paths
+    add_dir, rem_dir, reach_dir = temp_dir + 'update_add/', temp_dir + 'update_rem/', temp_dir + 'update_reach/'
+    for run_dir in (add_dir, rem_dir, reach_dir):
+        os.makedirs(run_dir, exist_ok=True)
+    parameters = manifest['parameters']
+    options = {'engine': manifest['options']['engine'], 'neighbour_cache': manifest['options']['neighbour_cache']}
+    if manifest['options'].get('cache') is not None:
+        options['cache'] = manifest['options']['cache']
+
+    def opt_list(tiles, release, run_dir):
+        return [(i, j, parameters['alpha'], parameters['exp'], parameters['cellsize'], parameters['nodata'],
+                 parameters['flux_threshold'], parameters['max_z'], temp_dir,
+                 dict(options, release=release, res_dir=run_dir)) for i, j in tiles]
+
+    def tile_done(optTuple, metrics):
+        report.tile(os.path.basename(os.path.dirname(fc.result_dir(optTuple))) + '/' +
+                    flow_manifest.tile_key(optTuple[0], optTuple[1]), metrics)
+
+    progress = flow_progress.ProgressLine()
+    try:
+        with report.phase('compute'):
+            failed = flow_pool.run_calculation(opt_list(added, "init_add", add_dir) +
+                                               opt_list(removed, "init_rem", rem_dir), False,
+                                               tile_done=tile_done, progress=progress)
+            if not failed and removed:
+                n_reach = sum(flow_update.save_reach_release(temp_dir, rem_dir, i, j, parameters['alpha'],
+                                                             parameters['cellsize']) for i, j in removed)
+                logging.info('{} release pixels reach the removed paths'.format(n_reach))
+                progress.close()
+                print("{} release pixels reach the removed paths and are calculated again".format(n_reach))
+                failed = flow_pool.run_calculation(opt_list(removed, "init_reach", reach_dir), False,
+                                                   tile_done=tile_done, progress=progress)
+    finally:
+        progress.close()
+    if failed:
+        logging.error('{} tiles failed, results not updated'.format(len(failed)))
+        print("Error: {} tiles failed, the results of the run are not updated".format(len(failed)))
+        report.write()
+        return
+
+    # The updated tiles are pending until their results are replaced, if the
+    # update is killed, --resume calculates them again with the new release layer
+    manifest['inputs']['init'] = flow_manifest.fingerprint(release_path)
+    updated = sorted(set(added) | set(removed))
+    for i, j in updated:
+        manifest['tiles'][flow_manifest.tile_key(i, j)] = "pending"
+    tiling['tiled'] = False
+    flow_manifest.write_manifest(temp_dir, manifest)
+    layers = [layer for layer, output in fc.output_layers(False)]
+    for i, j in updated:
+        if (i, j) in removed:
+            flow_update.replace_footprint(temp_dir, rem_dir, reach_dir, i, j, layers)
+        if (i, j) in added:
+            flow_update.add_results(temp_dir, add_dir, i, j, layers)
+        flow_manifest.set_tile(temp_dir, manifest, i, j, "done")
+    for key in manifest['tiles']:
+        os.replace(temp_dir + "init_new_{}.npy".format(key), temp_dir + "init_{}.npy".format(key))
+    tiling['tiled'] = True
+    flow_manifest.write_manifest(temp_dir, manifest)
+    for run_dir in (add_dir, rem_dir, reach_dir):
+        shutil.rmtree(run_dir)
+
+    if added or removed:
+        merge_run(res_path, manifest, report)
+    report.write()
+    print("Update finished")
+    end = datetime.now().replace(microsecond=0)
+    logging.info('Update needed: ' + str(end - start) + ' seconds')
+
+
+def backcalc(res_path, infra_path):
+    """Back calculation of a finished run with infrastructure (and the option
+    footprints=true) for a new infrastructure layer. The paths don't depend
+    on the infrastructure layer, so only the back calculation is done again
+    from the saved footprints of the paths (see flow_footprint) and
+    backcalculation.tif of the run is replaced."""
+    import raster_io as io
+    res_path = os.path.join(res_path, '')
+    temp_dir = res_path + 'temp/'
+    try:
+        manifest = flow_manifest.read_manifest(temp_dir)
+    except FileNotFoundError:
+        print("Error: no run manifest in {}".format(temp_dir))
+        return
+
+    start = datetime.now().replace(microsecond=0)
+    name = 'backcalc_' + datetime.now().strftime("%Y%m%d_%H%M%S")
+    setup_logging(res_path + 'log_{}.txt'.format(name))
+    logging.info('Back calculation of {} with Infrastructure File: {}'.format(res_path, infra_path))
+    if not manifest['parameters']['infra'] or not manifest['options'].get('footprints', False):
+        print("Error: the run has no footprints, run it with infrastructure and footprints=true")
+        return
+    if any(status != "done" for status in manifest['tiles'].values()):
+        print("Error: the run isn't finished, resume it first")
+        return
+    changed = flow_manifest.changed_inputs(manifest)
+    if 'dem' in changed or 'init' in changed:
+        print("Error: DEM or release layer changed since the run, start a new run")
+        return
+    header = io.read_header(manifest['inputs']['dem']['path'])
+    infra_header = io.read_header(infra_path)
+    if header['ncols'] != infra_header['ncols'] or header['nrows'] != infra_header['nrows']:
+        print("Error: Infra Layer doesn't match DEM!")
+        return
+
+    report = flow_metrics.RunReport(res_path + 'report_{}.json'.format(name), 'backcalc', manifest['parameters'])
+    tiling = manifest['tiling']
+    with report.phase('tiling'):
+        SPAM.tileRasters([(infra_path, "infra_new", False)], temp_dir, tiling['tileCOLS'], tiling['tileROWS'],
+                         tiling['U'])
+    new_dir = temp_dir + 'backcalc_new/'
+    os.makedirs(new_dir, exist_ok=True)
+    parameters = manifest['parameters']
+    optList = []
+    for key in manifest['tiles']:
+        i, j = (int(k) for k in key.split("_"))
+        optList.append((i, j, parameters['alpha'], parameters['exp'], parameters['cellsize'], parameters['nodata'],
+                        parameters['flux_threshold'], parameters['max_z'], temp_dir,
+                        {'infra': "infra_new", 'res_dir': new_dir}))
+    print("{} Processes started and {} back calculations to perform.".format(flow_pool.default_processes(),
+                                                                           len(optList)))
+
+    def tile_done(optTuple, metrics):
+        report.tile(flow_manifest.tile_key(optTuple[0], optTuple[1]), metrics)
+
+    with report.phase('compute'):
+        failed = flow_pool.run_backcalculation(optList, tile_done=tile_done)
+    if failed:
+        logging.error('{} tiles failed, back calculation not updated'.format(len(failed)))
+        print("Error: {} tiles failed, the back calculation of the run is not updated".format(len(failed)))
+        report.write()
+        return
+
+    # Replace the infrastructure layer of the run, the manifest first: if the
+    # replacement is killed, the inputs are tiled again by --resume
+    manifest['inputs']['infra'] = flow_manifest.fingerprint(infra_path)
+    tiled, tiling['tiled'] = tiling['tiled'], False
+    flow_manifest.write_manifest(temp_dir, manifest)
+    for key in manifest['tiles']:
+        os.replace(new_dir + "res_backcalc_{}.npy".format(key), temp_dir + "res_backcalc_{}.npy".format(key))
+        os.replace(temp_dir + "infra_new_{}.npy".format(key), temp_dir + "infra_{}.npy".format(key))
+    tiling['tiled'] = tiled
+    flow_manifest.write_manifest(temp_dir, manifest)
+    shutil.rmtree(new_dir)
+
+    options = manifest['options']
+    timings = {}
+    SPAM.mergeToFiles(temp_dir, ["backcalc"], manifest['inputs']['dem']['path'],
+                      [res_path + "backcalculation.tif"], cog=options['cog'], compress=options['compress'],
+                      quantize=options['quantize'], timings=timings)
+    for phase, seconds in timings.items():
+        report.add_time(phase, seconds)
+    report.write()
+    print("Back calculation finished")
+    end = datetime.now().replace(microsecond=0)
+    logging.info('Back calculation needed: ' + str(end - start) + ' seconds')
+
+
+# Arguments of the commands that take a result directory, printed if they are missing
+USAGE = {'--resume': "path_to_result_directory",
+         '--update': "path_to_result_directory path_to_new_release",
+         '--backcalc': "path_to_result_directory path_to_new_infrastructure",
+         '--worker': "path_to_result_directory",
+         '--coordinate': "path_to_result_directory [workers=N] [stale=seconds]"}
+
+
 if __name__ == '__main__':
     #mp.set_start_method('spawn') # used in Windows
     argv = sys.argv[1:]
@@ -619,7 +853,35 @@ if __name__ == '__main__':
     	print("Too few input arguments!!!")
     	sys.exit(1)
     if len(argv) == 1 and argv[0] == '--gui':
+        try:
+            from flow_gui import Flow_Py_EXEC
+        except ImportError as e:
+            print("The GUI needs PyQt5 ({}), the terminal version runs without it".format(e))
+            sys.exit(1)
         Flow_Py_EXEC()
+    elif len(argv) == 2 and argv[0] == '--resume':
+        resume(argv[1])
+    elif len(argv) == 3 and argv[0] == '--update':
+        update(argv[1], argv[2])
+    elif len(argv) == 3 and argv[0] == '--backcalc':
+        backcalc(argv[1], argv[2])
+    elif len(argv) == 2 and argv[0] == '--worker':
+        worker(argv[1])
+    elif len(argv) >= 2 and argv[0] == '--coordinate':
+        coordinate(argv[1], {kw[0]: kw[1] for kw in [ar.split('=') for ar in argv[2:] if ar.find('=') > 0]})
+    elif argv[0] in USAGE:
+        print("Too few input arguments!!! Usage: python3 main.py {} {}".format(argv[0], USAGE[argv[0]]))
+        sys.exit(1)
+    elif argv[0] == '--queue':
+        args=[arg for arg in argv[1:] if arg.find('=')<0]
+        kwargs={kw[0]:kw[1] for kw in [ar.split('=') for ar in argv if ar.find('=')>0]}
+
+        main(args, kwargs, queue=True)
+    elif argv[0] == '--sweep':
+        args=[arg for arg in argv[1:] if arg.find('=')<0]
+        kwargs={kw[0]:kw[1] for kw in [ar.split('=') for ar in argv if ar.find('=')>0]}
+
+        sweep(args, kwargs)
     else:
         args=[arg for arg in argv if arg.find('=')<0]
         kwargs={kw[0]:kw[1] for kw in [ar.split('=') for ar in argv if ar.find('=')>0]}
@@ -628,3 +890,7 @@ if __name__ == '__main__':
     
 # example dam: python3 main.py 25 8 ./examples/dam/ ./examples/dam/dam_010m_standard_cr100_sw250_f2500.20.6_n0.asc ./examples/dam/release_dam.tif
 # example dam: python3 main.py 25 8 ./examples/dam/ ./examples/dam/dam_010m_standard_cr100_sw250_f2500.20.6_n0.asc ./examples/dam/release_dam.tif infra=./examples/dam/infra.tif flux=0.0003 max_z=270
+# resume a run: python3 main.py --resume ./examples/dam/res_20201010_101010/
+# parameter sweep: python3 main.py --sweep ./examples/dam/ ./examples/dam/dam_010m_standard_cr100_sw250_f2500.20.6_n0.asc ./examples/dam/release_dam.tif alpha=20,25,30 exp=8,10 max_z=270
+# update a run to an edited release layer: python3 main.py --update ./examples/dam/res_20201010_101010/ ./examples/dam/release_dam_edited.tif
+# back calculation for a new infrastructure layer: python3 main.py --backcalc ./examples/dam/res_20201010_101010/ ./examples/dam/infra_new.tif
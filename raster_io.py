@@ -24,16 +24,13 @@ This file is for reading and writing raster files
 """
 
 import rasterio
+import rasterio.shutil
+from rasterio.windows import Window
+import numpy as np
 import sys
 
-def read_header(input_file):
-    #Reads in the header of the raster file, input: filepath
-
-    raster = rasterio.open(input_file)
-    if raster is None:
-        print('Unable to open {}'.format(input_file))
-        sys.exit(1)
-
+def get_header(raster):
+    """Header of an open rasterio dataset"""
     header = {}
     header['ncols'] = raster.width
     header['nrows'] = raster.height
@@ -44,41 +41,115 @@ def read_header(input_file):
     return header
 
 
+def read_header(input_file):
+    #Reads in the header of the raster file, input: filepath
+
+    with rasterio.open(input_file) as raster:
+        if raster is None:
+            print('Unable to open {}'.format(input_file))
+            sys.exit(1)
+        return get_header(raster)
+
+
 def read_raster(input_file):
 
-    header = read_header(input_file)
-    raster = rasterio.open(input_file)
-    my_array = raster.read(1)
+    with rasterio.open(input_file) as raster:
+        header = get_header(raster)
+        my_array = raster.read(1)
 
     return my_array, header
 
 
-def output_raster(file, file_out, raster):
-    """Input is the original file, path to new file, raster_data
+def read_windows(input_file, windows):
+    """Read parts of a raster, the file is opened once and only the windows
+    are read.
+    
+    Input parameters:
+        input_file  path to the raster
+        windows     dict key -> ((row_start, row_stop), (col_start, col_stop)),
+                    stops larger than the raster are cut like slices
+        
+    Output parameters:
+        Generator of (key, array)
+    """
+    with rasterio.open(input_file) as raster:
+        for key, ((row_start, row_stop), (col_start, col_stop)) in windows.items():
+            window = Window.from_slices((row_start, min(row_stop, raster.height)),
+                                        (col_start, min(col_stop, raster.width)))
+            yield key, raster.read(1, window=window)
+
+
+def read_blocks(input_file, block_rows=1024):
+    """Read a raster in blocks of block_rows rows, generator of 
+    (row_start, array)"""
+    with rasterio.open(input_file) as raster:
+        for row_start in range(0, raster.height, block_rows):
+            window = Window(0, row_start, raster.width, min(block_rows, raster.height - row_start))
+            yield row_start, raster.read(1, window=window)
+
+
+def reference_profile(file):
+    """crs and transform of the reference raster, read once for all outputs"""
+    with rasterio.open(file) as raster_trans:
+        try:
+            crs = rasterio.crs.CRS.from_dict(raster_trans.crs.data)
+        except:
+            crs = rasterio.crs.CRS.from_epsg(4326)
+        return {'crs': crs, 'transform': raster_trans.transform}
+
+
+def open_output(file, file_out, height, width, dtype, profile=None, compress=None, nodata=-9999):
+    """Open a new raster for writing with the crs and transform of file.
     
     Input parameters:
         file        the path to the file to reference on, mostly DEM on where 
                     Calculations were done
-        file_out    path for the outputfile, possible extends are .asc or .tif"""
-
-    raster_trans = rasterio.open(file)
-    try:
-        crs = rasterio.crs.CRS.from_dict(raster_trans.crs.data)
-    except:
-        crs = rasterio.crs.CRS.from_epsg(4326)
+        file_out    path for the outputfile, possible extends are .asc or .tif
+        height, width, dtype    shape and dtype of the raster data
+        profile     reference_profile of file, read from file if None
+        compress    None or compression of a .tif ('deflate', 'zstd', ...),
+                    the .tif is tiled (512x512) with predictor and BigTIFF if
+                    needed
+        nodata      No data value of the output"""
+
+    profile = profile or reference_profile(file)
     if file_out[-3:] == 'asc': 
-        new_dataset = rasterio.open(file_out, 'w', driver='AAIGrid', height = raster.shape[0], width = raster.shape[1], count=1,  dtype = raster.dtype, crs=crs, transform=raster_trans.transform, nodata=-9999)
-    if file_out[-3:] == 'tif': 
-        new_dataset = rasterio.open(file_out, 'w', driver='GTiff', height = raster.shape[0], width = raster.shape[1], count=1,  dtype = raster.dtype, crs=crs, transform=raster_trans.transform, nodata=-9999)
+        new_dataset = rasterio.open(file_out, 'w', driver='AAIGrid', height = height, width = width, count=1,  dtype = dtype, crs=profile['crs'], transform=profile['transform'], nodata=nodata)
+    if file_out[-3:] == 'tif' and compress is None: 
+        new_dataset = rasterio.open(file_out, 'w', driver='GTiff', height = height, width = width, count=1,  dtype = dtype, crs=profile['crs'], transform=profile['transform'], nodata=nodata)
+    elif file_out[-3:] == 'tif':
+        predictor = 3 if np.issubdtype(dtype, np.floating) else 2
+        new_dataset = rasterio.open(file_out, 'w', driver='GTiff', height = height, width = width, count=1,  dtype = dtype, crs=profile['crs'], transform=profile['transform'], nodata=nodata,
+                                    tiled=True, blockxsize=512, blockysize=512, compress=compress, predictor=predictor, bigtiff='IF_SAFER')
 # =============================================================================
 #     if file_out[-3:] != 'tif' & file_out[-3:] != 'asc':
 #         print('This Fileformat is not supported: .{}'.format(file_out[-3:]))
 #         return
 # =============================================================================
+    return new_dataset
+
+
+def output_raster(file, file_out, raster, profile=None, nodata=-9999):
+    """Input is the original file, path to new file, raster_data
+    
+    Input parameters:
+        file        the path to the file to reference on, mostly DEM on where 
+                    Calculations were done
+        file_out    path for the outputfile, possible extends are .asc or .tif
+        profile     reference_profile of file, read from file if None"""
+
+    new_dataset = open_output(file, file_out, raster.shape[0], raster.shape[1], raster.dtype, profile, nodata=nodata)
     new_dataset.write(raster, 1)
     new_dataset.close()
 
 
+def write_cog(file_in, file_out, compress='deflate'):
+    """Copy a GeoTIFF to a Cloud Optimized GeoTIFF (tiled, compressed with
+    predictor, overviews, BigTIFF if needed)"""
+    rasterio.shutil.copy(file_in, file_out, driver='COG', COMPRESS=compress.upper(), PREDICTOR='YES',
+                         BIGTIFF='IF_SAFER', OVERVIEWS='AUTO', RESAMPLING='NEAREST')
+
+
 #path = '/home/lawinenforschung/Desktop/PAR6_ValsGries_AUT/dhm_10_6.tif'
 #output = 'example.asc'
 #raster, header = read_raster(path)
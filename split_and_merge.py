@@ -2,179 +2,488 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import math
+import os
 import pickle
-import gc
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
-import raster_io as io
 
+# raster_io (rasterio) is imported by the functions that read or write the
+# rasters, the workers only need the tiles (sharedTile) and LAYER_REDUCE
+
+# How overlapping result tiles (and batches of a tile, see flow_pool) are
+# reduced, per result layer
+LAYER_REDUCE = {'z_delta': np.maximum, 'flux': np.maximum, 'count': np.add, 'z_delta_sum': np.add,
+                'fp': np.maximum, 'sl': np.maximum, 'backcalc': np.maximum}
+# Max. value of the bounded result layers (for quantizedType)
+LAYER_BOUNDS = {'flux': 1., 'fp': 90., 'sl': 90.}
+
+
+def tileSize(demPath, releasePath, alpha, processes=1, infra_bool=False, maxTile=None):
+    """Tile size and overlap for tileRaster derived from the DEM and the
+    release layer instead of fixed 15 km tiles with 5 km overlap.
+
+    The energy line height of a path only grows with the drop of the
+    altitude minus tan(alpha) times the travelled distance (max_z_delta can
+    only cut it), so no path gets further than (altitude of the highest
+    release pixel - lowest altitude of the DEM) / tan(alpha). That plus one
+    cell for the border is the overlap U.
+
+    Without infrastructure a tile is split into batches of release pixels
+    (flow_pool), so the tiles are as large as maxTile allows to keep the 
+    overlap small. With infrastructure a tile is calculated by one process, 
+    the tiles get smaller until about every process gets a tile with 
+    release pixels (see releaseTiles), but the core of a tile is never
+    smaller than 2U.
+
+    The DEM and the release layer are read in blocks of rows.
+
+    Input parameters:
+        demPath     Path to the digital elevation model
+        releasePath Path to the release layer, release pixels need value > 0
+        alpha       Alpha angle in degree
+        processes   Number of worker processes
+        infra_bool  True if the calculation is with infrastructure
+        maxTile     Size of a tile in cells (memory), default 15 km. A
+                    target, not a maximum: the core of a tile is at least
+                    2U, so a tile has at least 6U cells if U is large
+
+    Output parameters:
+        xDim, yDim, U   Tile size (cols, rows) and overlap in cells
+    """
+    import raster_io as io
+    header = io.read_header(demPath)
+    blocks = ((sY, dem, release) for (sY, dem), (_, release) in zip(io.read_blocks(demPath),
+                                                                    io.read_blocks(releasePath)))
+    return tileSizeBlocks(blocks, (header['nrows'], header['ncols']), header['cellsize'], header['noDataValue'],
+                          alpha, processes, infra_bool, maxTile)
+
+
+def tileSizeArray(dem, release, cellsize, nodata, alpha, processes=1, infra_bool=False, maxTile=None):
+    """tileSize of a DEM and a release layer that are already in memory"""
+    return tileSizeBlocks([(0, dem, release)], np.shape(dem), cellsize, nodata, alpha, processes, infra_bool,
+                          maxTile)
+
+
+def tileSizeBlocks(blocks, shape, cellsize, nodata, alpha, processes=1, infra_bool=False, maxTile=None):
+    """tileSize from blocks of rows (sY, dem, release) of the DEM and the
+    release layer, shape is the shape of the whole raster"""
+    maxTile = maxTile or int(15000 / cellsize)
+    demMin, releaseTop = np.inf, -np.inf
+    rows, cols = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for sY, dem, release in blocks:
+        valid = dem != nodata
+        if valid.any():
+            demMin = min(demMin, float(dem[valid].min()))
+        blockRows, blockCols = np.nonzero(release > 0)
+        if len(blockRows) > 0:
+            releaseTop = max(releaseTop, float(dem[blockRows, blockCols].max()))
+            rows.append(blockRows + sY)
+            cols.append(blockCols)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    if len(rows) == 0 or demMin == np.inf:
+        U = 1
+    elif math.tan(math.radians(float(alpha))) <= 0:
+        U = max(shape)
+    else:
+        relief = max(releaseTop - demMin, 0)
+        U = int(math.ceil(relief / math.tan(math.radians(float(alpha))) / cellsize)) + 1
+
+    core = max(maxTile - 2 * U, 2 * U)
+    if infra_bool and processes > 1 and len(rows) > 0:
+        while core > 2 * U and releaseTiles(rows, cols, shape, core + 2 * U, U) < processes:
+            core = max(int(core / 1.25), 2 * U)
+    tile = core + 2 * U
+    logging.info("Tile size: %i cells, overlap: %i cells", tile, U)
+    return tile, tile, U
+
+
+def releaseTiles(rows, cols, shape, tile, U):
+    """Number of tiles of the layout of tileWindows (tile x tile cells,
+    overlap U) with release pixels at rows, cols. A release pixel belongs
+    to the tile whose window has it outside of the overlap masked by
+    maskInit."""
+    core = tile - 2 * U
+    windows, (imax, jmax) = tileWindows(shape[0], shape[1], tile, tile, U)
+    i = np.clip((rows - U) // core, 0, imax)
+    j = np.clip((cols - U) // core, 0, jmax)
+    return len(np.unique(i * (jmax + 1) + j))
+
+
+def tileWindows(nrows, ncols, xDim, yDim, U):
+    """Windows of the tiles of a raster, starting with the tile in the NW
+    corner, neighbouring tiles overlap by 2U.
+
+    Output parameters:
+        windows     dict (i, j) -> ((sY, eY), (sX, eX)), rows and cols of
+                    the tile, eY and eX can be larger than the raster
+        nTiles      (imax, jmax), index of the last tile
+    """
+    windows = {}
+    i, sY, eY = 0, 0, 0
+    # starte mit den tiles in der NW-Ecke sX,eX = cols; sY,eY = rows;
+    while eY < nrows:
+        eY = sY + yDim
+        j, sX, eX = 0, 0, 0
+        while eX < ncols:
+            eX = sX + xDim
+            windows[(i, j)] = ((sY, eY), (sX, eX))
+            sX = eX - 2 * U
+            j += 1
+        sY = eY - 2 * U
+        i += 1
+    return windows, (i - 1, j - 1)
+
+
+def tileLayout(dirName, nrows, ncols, xDim, yDim, U):
+    """Save the extent of the raster (extentLarge), the windows of the tiles
+    (ext_i_j) and the number of tiles (nTiles) for MergeRaster and return 
+    them like tileWindows."""
+    windows, nTiles = tileWindows(nrows, ncols, xDim, yDim, U)
+    pickle.dump((nrows, ncols), open(dirName + "extentLarge", "wb"))
+    for (i, j), rangeRowsCols in windows.items():
+        pickle.dump(rangeRowsCols, open(dirName + "ext_{}_{}".format(i, j), "wb"))
+    pickle.dump(nTiles, open("{}nTiles".format(dirName), "wb"))
+    return windows, nTiles
+
+
+def maskInit(initRas, i, j, nTiles, U):
+    """Set the release pixels in the overlap of tile i, j to -9999, they
+    belong to the neighbouring tile (except at the border of the raster)."""
+    if j != nTiles[1]:
+        initRas[:, -U:] = -9999  # Rand im Osten
+    if i != 0:
+        initRas[0:U, :] = -9999  # Rand im Norden
+    if j != 0:
+        initRas[:, 0:U] = -9999  # Rand im Westen
+    if i != nTiles[0]:
+        initRas[-U:, :] = -9999  # Rand im Sueden
+    return initRas
+
+
+def tileRaster(fNameIn, fNameOut, dirName, xDim, yDim, U, isInit=False, layout=None):
+    """Save the tiles of a raster as fNameOut_i_j.npy to dirName, every tile
+    is read directly from the file (one tile in memory at a time).
+
+    Input parameters:
+        fNameIn     Path to the raster
+        fNameOut    Name of the layer ("dem", "init", "infra")
+        dirName     Temp folder
+        xDim, yDim  Size of the tiles (cols, rows)
+        U           Overlap of the tiles
+        isInit      True for the release layer, the overlap is masked
+        layout      (windows, nTiles) of tileLayout, computed if None
+    """
+    import raster_io as io
+    if layout is None:
+        header = io.read_header(fNameIn)
+        layout = tileLayout(dirName, header['nrows'], header['ncols'], xDim, yDim, U)
+    windows, nTiles = layout
+
+    for (i, j), tile in io.read_windows(fNameIn, windows):
+        if isInit:
+            tile = maskInit(tile, i, j, nTiles, U)
+        np.save("{0}{1}_{2}_{3}".format(dirName, fNameOut, i, j), tile)
+        logging.info("saved %s - TileNr.: %i_%i", fNameOut, i, j)
+        del tile
 
-def tileRaster(fNameIn, fNameOut, dirName, xDim, yDim, U, isInit=False):
-
-    #if not os.path.exists(dirName):
-    #    os.makedirs(dirName)
-
-    #largeRaster, largeHeader = iof.f_readASC(fNameIn, dType='float')
-    largeRaster, largeHeader = io.read_raster(fNameIn)
-    # einlesen des Rasters und der Header
+    logging.info("finished tiling %s: nTiles=%s\n----------------------------",
+                 fNameOut, (nTiles[0]+1)*(nTiles[1]+1))
+
+
+def tileRasters(layers, dirName, xDim, yDim, U):
+    """tileRaster for several layers of the same extent, the tile layout is
+    computed once (from the first layer).
+
+    Input parameters:
+        layers      List of (fNameIn, fNameOut, isInit)
+    """
+    import raster_io as io
+    header = io.read_header(layers[0][0])
+    layout = tileLayout(dirName, header['nrows'], header['ncols'], xDim, yDim, U)
+    for fNameIn, fNameOut, isInit in layers:
+        tileRaster(fNameIn, fNameOut, dirName, xDim, yDim, U, isInit, layout)
+
+
+def shareRaster(fNameIn, fNameOut, dirName, xDim, yDim, U, isInit=False):
+    """Same as tileRaster, but instead of saving the tiles the whole raster is
+    copied once into a shared memory block (multiprocessing.shared_memory,
+    read in blocks of rows),
+    the workers get the tiles with sharedTile. Only extentLarge, ext_i_j and
+    nTiles are saved to dirName.
+
+    Output parameters:
+        block       The SharedMemory, to be released with releaseShared
+                    after the calculation
+        shared      Description of the block and the tiling for sharedTile
+    """
+    import raster_io as io
+    header = io.read_header(fNameIn)
+    shape = (header['nrows'], header['ncols'])
+    tileLayout(dirName, shape[0], shape[1], xDim, yDim, U)
+
+    block, largeRaster = None, None
+    for sY, rows in io.read_blocks(fNameIn):
+        if block is None:
+            block = shared_memory.SharedMemory(create=True, size=max(shape[0] * shape[1] * rows.itemsize, 1))
+            largeRaster = np.ndarray(shape, dtype=rows.dtype, buffer=block.buf)
+        largeRaster[sY:sY + rows.shape[0]] = rows
+    shared = {'name': block.name, 'shape': shape, 'dtype': largeRaster.dtype.str,
+              'tiling': (xDim, yDim, U), 'isInit': isInit}
+    logging.info("shared %s: %s", fNameOut, block.name)
+    del largeRaster
+    return block, shared
+
+
+def shareArray(array, fNameOut, xDim, yDim, U, isInit=False):
+    """Same as shareRaster for a raster that is already in memory, the array
+    is copied into the shared memory block and nothing is saved (the 
+    windows of the tiles are given by tileWindows).
+
+    Output parameters:
+        block, shared   See shareRaster
+    """
+    array = np.asarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    largeRaster = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    largeRaster[:] = array
+    shared = {'name': block.name, 'shape': array.shape, 'dtype': largeRaster.dtype.str,
+              'tiling': (xDim, yDim, U), 'isInit': isInit}
+    logging.info("shared %s: %s", fNameOut, block.name)
+    del largeRaster
+    return block, shared
 
-    i, j, imax, jmax = 0, 0, 0, 0
-    sX, sY, eX, eY = 0, 0, 0, 0
-    # starte mit den tiles in der NW-Ecke sX,eX = cols; sY,eY = rows;
-    # cs=largeHeader['cellsize']
-    # xllc = largeHeader['xllcorner']
-    # yllc = largeHeader['yllcorner']
 
-    nrows, ncols = largeRaster.shape[0], largeRaster.shape[1]
-    pickle.dump((nrows, ncols), open(dirName + "extentLarge", "wb"))
+# Shared memory blocks attached by this process, name -> SharedMemory
+_attached = {}
 
-    # print ncols, nrows
 
-    I, J, IMAX, JMAX = 0, 0, 0, 0
+def sharedTile(shared, i, j):
+    """Tile i, j of a raster shared by shareRaster, a read only view into the
+    shared memory block (a masked copy for the release layer)."""
+    if shared['name'] not in _attached:
+        _attached[shared['name']] = shared_memory.SharedMemory(name=shared['name'])
+    largeRaster = np.ndarray(shared['shape'], dtype=shared['dtype'], buffer=_attached[shared['name']].buf)
+    windows, nTiles = tileWindows(shared['shape'][0], shared['shape'][1], *shared['tiling'])
+    (sY, eY), (sX, eX) = windows[(i, j)]
+    if shared['isInit']:
+        return maskInit(largeRaster[sY:eY, sX:eX].copy(), i, j, nTiles, shared['tiling'][2])
+    tile = largeRaster[sY:eY, sX:eX]
+    tile.flags.writeable = False
+    return tile
 
-    while eY < nrows:
-        eY = sY + yDim
-        while eX < ncols:
-            eX = sX+xDim
-
-    # rangeRowsCols = ((sY,eY),(sX,eX))
-    # pickle.dump(rangeRowsCols, open("%s/ext_%i_%i"%(dirName,i,j),"wb"))
-
-    # headerTile = {}
-    # headerTile['ncols'] = eX-sX
-    # headerTile['nrows'] = eY-sY
-    # headerTile['xllcorner'] = xllc + sX*cs
-    # headerTile['yllcorner'] = yllc + nrows*cs - eY*cs
-    # headerTile['cellsize'] = cs
-    # headerTile['noDataValue'] = largeHeader['noDataValue']
-
-    # pickle.dump( headerTile, open( "temp/header%d_%d.p"%(i,j), "wb" ) )
-    # np.save("%s/%s_%i_%i"%(dirName,fNameOut, i, j), largeRaster[sY:eY,sX:eX])
-    # pickle.dump(, open( "temp/header_large.p"%(fNameOut, i,j), "wb" ) )
-    # logging.info("saved %s - TileNr.: %i_%i"%(fNameOut,i,j))
-
-            sX = eX-2*U
-            JMAX = max(J, JMAX)
-            J += 1
-        sX, J, eX = 0, 0, 0
-        sY = eY-2*U
-        IMAX = max(I, IMAX)
-        I += 1
-
-    sX, sY, eX, eY = 0, 0, 0, 0
-
-    if isInit is False:
-        while eY < nrows:
-            eY = sY+yDim
-            while eX < ncols:
-                eX = sX+xDim
-                rangeRowsCols = ((sY, eY), (sX, eX))
-                pickle.dump(rangeRowsCols,
-                            open(dirName + "ext_{}_{}".format(i, j), "wb"))
-
-                # headerTile = {}
-                # headerTile['ncols'] = eX-sX
-                # headerTile['nrows'] = eY-sY
-                # headerTile['xllcorner'] = xllc + sX*cs
-                # headerTile['yllcorner'] = yllc + nrows*cs - eY*cs
-                # headerTile['cellsize'] = cs
-                # headerTile['noDataValue'] = largeHeader['noDataValue']
-
-                # pickle.dump( headerTile,
-                # open( "temp/header%d_%d.p"%(i,j), "wb" ) )
-                np.save("{0}{1}_{2}_{3}".format(dirName, fNameOut, i, j),
-                        largeRaster[sY:eY, sX:eX])
-                # pickle.dump(,
-                # open( "temp/header_large.p"%(fNameOut, i,j), "wb" ) )
-                logging.info("saved %s - TileNr.: %i_%i", fNameOut, i, j)
-
-                sX = eX-2*U
-                jmax = max(j, jmax)
-                j += 1
-            sX, j, eX = 0, 0, 0
-            sY = eY-2*U
-            imax = max(i, imax)
-            i += 1
-    else:
-        while eY < nrows:
-            eY = sY+yDim
-            while eX < ncols:
-                eX = sX+xDim
-
-                rangeRowsCols = ((sY, eY), (sX, eX))
-                pickle.dump(rangeRowsCols,
-                            open("{0}ext_{1}_{2}".format(dirName, i, j), "wb"))
-
-                # headerTile = {}
-                # headerTile['ncols'] = eX-sX
-                # headerTile['nrows'] = eY-sY
-                # headerTile['xllcorner'] = xllc + sX*cs
-                # headerTile['yllcorner'] = yllc + nrows*cs - eY*cs
-                # headerTile['cellsize'] = cs
-                # headerTile['noDataValue'] = largeHeader['noDataValue']
-                # pickle.dump(headerTile,
-                # open( "temp/hd_%s%_d_%d.p"%(fNameOut, i,j), "wb" ) )
-
-                initRas = largeRaster[sY:eY, sX:eX].copy()
-                # shapeX = np.shape(initRas)[1]
-                # shapeY = np.shape(initRas)[0]
-                if j != JMAX:
-                    initRas[:, -U:] = -9999  # Rand im Osten
-                if i != 0:
-                    initRas[0:U, :] = -9999  # Rand im Norden
-                if j != 0:
-                    initRas[:, 0:U] = -9999  # Rand im Westen
-                if i != IMAX:
-                    initRas[-U:, :] = -9999  # Rand im Sueden
-
-                # logging.info("%i_%i"%(shapeX-U, shapeX))
-                np.save("{0}{1}_{2}_{3}".format(dirName, fNameOut, i, j), initRas)
-                del initRas
-                # pickle.dump(,
-                # open( "temp/header_large.p"%(fNameOut, i,j), "wb" ) )
-                logging.info("saved %s - TileNr.: %i_%i", fNameOut, i, j)
-
-                sX = eX-2*U
-                jmax = max(j, jmax)
-                j += 1
-            sX, j, eX = 0, 0, 0
-            sY = eY-2*U
-            imax = max(i, imax)
-            i += 1
-
-    pickle.dump((imax, jmax), open("{}nTiles".format(dirName), "wb"))
-    logging.info("finished tiling %s: nTiles=%s\n----------------------------",
-                 fNameOut, (imax+1)*(jmax+1))
 
-    # del largeRaster, largeHeader
-    del largeRaster
-    gc.collect()
-    # return largeRaster
+def releaseShared(blocks):
+    """Close and remove the shared memory blocks of shareRaster"""
+    for block in blocks:
+        attached = _attached.pop(block.name, None)
+        for shm in (attached, block):
+            if shm is not None:
+                try:
+                    shm.close()
+                except BufferError:  # a view of the block is still in use
+                    pass
+        block.unlink()
 
 
 def MergeRaster(inDirPath, fName):
+    """Merge the tiles fName_i_j of one layer to the whole raster, with the 
+    reduction and the dtype of the layer (see mergeLayers)."""
+    return mergeLayers(inDirPath, [fName[4:] if fName.startswith("res_") else fName])[0]
 
-    #os.chdir(inDirPath)
 
+def readLayout(inDirPath):
+    """Extent of the raster and windows of the tiles saved by tileLayout"""
     extL = pickle.load(open(inDirPath + "extentLarge", "rb"))
-    # print extL
     nTiles = pickle.load(open(inDirPath + "nTiles", "rb"))
-
-    mergedRas = np.zeros((extL[0], extL[1]))
-    # create Raster with original size
-    mergedRas[:, :] = np.NaN
-
+    windows = {}
     for i in range(nTiles[0]+1):
         for j in range(nTiles[1]+1):
-            smallRas = np.load(inDirPath + "%s_%i_%i.npy" % (fName, i, j))
-            # print smallRas
-            pos = pickle.load(open(inDirPath + "ext_%i_%i" % (i, j), "rb"))
-            # print pos
-
-            mergedRas[pos[0][0]:pos[0][1], pos[1][0]:pos[1][1]] =\
-                np.fmax(mergedRas[pos[0][0]:pos[0][1],
-                                  pos[1][0]:pos[1][1]], smallRas)
-            del smallRas
-            logging.info("appended result %s_%i_%i", fName, i, j)
-
-    return mergedRas
-    del mergedRas
+            windows[(i, j)] = pickle.load(open(inDirPath + "ext_%i_%i" % (i, j), "rb"))
+    return extL, windows
+
+
+def mergeInitial(layer, dtype):
+    """Neutral value of the reduction of a layer (LAYER_REDUCE), the merged
+    raster starts with it"""
+    if LAYER_REDUCE[layer] is np.add:
+        return 0
+    if np.issubdtype(dtype, np.integer):
+        return np.iinfo(dtype).min
+    return -np.inf
+
+
+def mergeArrays(shape, windows, tiles, layers):
+    """Merge result tiles that are in memory to the whole raster, like
+    mergeLayers.
+
+    Input parameters:
+        shape       (nrows, ncols) of the raster
+        windows     Windows of the tiles, see tileWindows
+        tiles       dict (i, j) -> dict layer -> result tile
+        layers      Names of the result layers (LAYER_REDUCE)
+
+    Output parameters:
+        rasters     dict layer -> whole raster
+    """
+    rasters = {}
+    for layer in layers:
+        dtype = next(iter(tiles.values()))[layer].dtype
+        raster = np.full(shape, mergeInitial(layer, dtype), dtype=dtype)
+        for (i, j), ((sY, eY), (sX, eX)) in windows.items():
+            part = raster[sY:eY, sX:eX]
+            LAYER_REDUCE[layer](part, tiles[(i, j)][layer], out=part)
+        rasters[layer] = raster
+    return rasters
+
+
+def mergeBlocks(inDirPath, layers, blockRows=256):
+    """Merge the result tiles res_<layer>_i_j of several layers in one pass,
+    block by block of blockRows rows. Only the rows of the tiles that 
+    overlap a block are read (np.load with mmap_mode), every layer keeps the
+    dtype of its tiles and is reduced by LAYER_REDUCE: the release pixels
+    are split between the tiles, so overlapping tiles hold different paths.
+
+    Output parameters:
+        Generator of (sY, blocks), blocks is a list with the merged raster 
+        of every layer from row sY on
+    """
+    extL, windows = readLayout(inDirPath)
+    first = [np.load(inDirPath + "res_%s_%i_%i.npy" % ((layer,) + min(windows)), mmap_mode='r') for layer in layers]
+    dtypes = [tile.dtype for tile in first]
+    del first
+    initial = [mergeInitial(layer, dtype) for layer, dtype in zip(layers, dtypes)]
+
+    for sY in range(0, extL[0], blockRows):
+        eY = min(sY + blockRows, extL[0])
+        blocks = [np.full((eY - sY, extL[1]), value, dtype=dtype) for value, dtype in zip(initial, dtypes)]
+        for (i, j), ((tsY, teY), (tsX, teX)) in windows.items():
+            teY, teX = min(teY, extL[0]), min(teX, extL[1])
+            if tsY >= eY or teY <= sY:
+                continue
+            rows = slice(max(sY, tsY), min(eY, teY))
+            for layer, block in zip(layers, blocks):
+                smallRas = np.load(inDirPath + "res_%s_%i_%i.npy" % (layer, i, j), mmap_mode='r')
+                part = block[rows.start - sY:rows.stop - sY, tsX:teX]
+                LAYER_REDUCE[layer](part, smallRas[rows.start - tsY:rows.stop - tsY], out=part)
+                del smallRas
+        yield sY, blocks
+
+
+def mergeLayers(inDirPath, layers):
+    """Merge the result tiles of several layers in one pass (see 
+    mergeBlocks), list with the whole raster of every layer"""
+    extL = pickle.load(open(inDirPath + "extentLarge", "rb"))
+    for sY, blocks in mergeBlocks(inDirPath, layers, max(extL[0], 1)):
+        return blocks
+
+
+def quantizedType(layer, scale):
+    """Integer dtype for a layer stored in steps of scale (see mergeToFiles),
+    uint16 if the values of the layer are bounded small enough"""
+    if layer in LAYER_BOUNDS and LAYER_BOUNDS[layer] / scale <= np.iinfo(np.uint16).max:
+        return np.dtype(np.uint16)
+    return np.dtype(np.int32)
+
+
+def timedBlocks(blocks, timings):
+    """Iterate over the blocks of mergeBlocks and add the time spent merging
+    them to timings['merge']"""
+    blocks = iter(blocks)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(blocks)
+        except StopIteration:
+            return
+        finally:
+            timings['merge'] += time.perf_counter() - start
+        yield item
+
+
+def mergeToFiles(inDirPath, layers, reference, filesOut, blockRows=256, cog=False, compress=None, quantize=None,
+                 timings=None):
+    """Merge the result tiles of several layers in one pass and write every
+    layer to its file in filesOut with crs and transform of reference (read
+    once). If all files are .tif they are written block by block (see 
+    mergeBlocks), so only blockRows rows of the rasters are in memory, 
+    otherwise (.asc) the layers are merged completely first.
+
+    Input parameters:
+        inDirPath   Temp folder with the result tiles
+        layers      Names of the result layers (LAYER_REDUCE)
+        reference   Path to the raster with crs and transform, the DEM
+        filesOut    Output file of every layer (.tif or .asc)
+        blockRows   Rows merged and written at once
+        cog         Write Cloud Optimized GeoTIFFs with overviews, the 
+                    layers are converted in parallel
+        compress    Compression of the .tif, e.g. 'deflate' or 'zstd',
+                    default none ('deflate' for cog)
+        quantize    dict layer -> scale, the layer is saved as integer 
+                    steps of scale (quantizedType) with scale as GDAL scale
+                    factor, e.g. {'flux': 0.0001}
+        timings     dict, the seconds spent merging and writing the files
+                    are added to timings['merge'] and timings['output']
+    """
+    from rasterio.windows import Window
+    import raster_io as io
+    start = time.perf_counter()
+    timings = timings if timings is not None else {}
+    timings.setdefault('merge', 0.)
+    timings.setdefault('output', 0.)
+    merge = timings['merge']
+    profile = io.reference_profile(reference)
+    quantize = quantize or {}
+    if cog:
+        compress = compress or 'deflate'
+        blockRows = max(blockRows // 512, 1) * 512  # whole tiles of the .tif
+
+    def prepare(layer, block):
+        # Scaled integers, nodata doesn't occur in the results
+        if layer not in quantize:
+            return block
+        dtype = quantizedType(layer, quantize[layer])
+        info = np.iinfo(dtype)
+        return np.clip(np.round(block / quantize[layer]), info.min, info.max).astype(dtype)
+
+    def nodata(layer):
+        return None if layer in quantize and quantizedType(layer, quantize[layer]).kind == 'u' else -9999
+
+    if any(fileOut[-3:] != 'tif' for fileOut in filesOut):
+        rasters = mergeLayers(inDirPath, layers)
+        timings['merge'] += time.perf_counter() - start
+        for layer, raster, fileOut in zip(layers, rasters, filesOut):
+            io.output_raster(reference, fileOut, prepare(layer, raster), profile, nodata(layer))
+        timings['output'] += time.perf_counter() - start - (timings['merge'] - merge)
+        return
+
+    extL = pickle.load(open(inDirPath + "extentLarge", "rb"))
+    written = [fileOut[:-4] + ".part.tif" if cog else fileOut for fileOut in filesOut]
+    datasets = []
+
+    def write(dataset, layer, block, sY):
+        dataset.write(prepare(layer, block), 1, window=Window(0, sY, extL[1], block.shape[0]))
+
+    # GDAL releases the GIL while compressing, the layers are written in threads
+    with ThreadPoolExecutor(len(layers)) as executor:
+        try:
+            for sY, blocks in timedBlocks(mergeBlocks(inDirPath, layers, blockRows), timings):
+                if not datasets:
+                    for layer, block, fileOut in zip(layers, blocks, written):
+                        datasets.append(io.open_output(reference, fileOut, extL[0], extL[1],
+                                                       prepare(layer, block[:0]).dtype, profile, compress,
+                                                       nodata(layer)))
+                        if layer in quantize:
+                            datasets[-1].scales = (quantize[layer],)
+                list(executor.map(write, datasets, layers, blocks, [sY] * len(layers)))
+        finally:
+            for dataset in datasets:
+                dataset.close()
+        if cog:
+            list(executor.map(io.write_cog, written, filesOut, [compress] * len(layers)))
+            for fileOut in written:
+                os.remove(fileOut)
+    timings['output'] += time.perf_counter() - start - (timings['merge'] - merge)
+    logging.info("merged %s", ", ".join(layers))